@@ -1,6 +1,9 @@
 from bs4 import BeautifulSoup
+import csv
+from datetime import datetime, timedelta, timezone
 import functools
 import getpass
+import io
 import os
 import re
 import requests
@@ -26,7 +29,11 @@ class TurkleClient(object):
     ADD_PROJECT_URL = "/admin/turkle/project/add/"
     ADD_BATCH_URL = "/admin/turkle/batch/add/"
     LIST_BATCH_URL = "/admin/turkle/batch/"
+    RESULTS_SINCE_URL = "/admin/turkle/batch/results-since.json"
     AUTOCOMPLETE_URL = "/admin/autocomplete/"
+    # Incremental downloads start this long before the previous watermark,
+    # to pick up Task Assignments that were committed after it was taken
+    RESULTS_SINCE_OVERLAP = timedelta(minutes=10)
 
     def __init__(self, server, admin, password=None):
         # prefix is for when the app is not run in the base of the web server
@@ -81,6 +88,61 @@ class TurkleClient(object):
                         fh.write(resp.content)
         return True
 
+    @exception_handler
+    def download_since(self, directory, since=None, watermark=None):
+        """Download the Task Assignments completed since a time or watermark
+
+        When continuing from the watermark returned by a previous call,
+        the download starts RESULTS_SINCE_OVERLAP before the watermark's
+        time, and the Task Assignments already downloaded are skipped.
+
+        Returns the watermark for the next download as a dict with
+        'until' and 'assignment_ids' keys, or False on failure.
+        """
+        seen_ids = set()
+        if watermark:
+            since = (datetime.fromisoformat(watermark['until']) -
+                     self.RESULTS_SINCE_OVERLAP).isoformat()
+            seen_ids = set(str(i) for i in watermark.get('assignment_ids', []))
+        with requests.Session() as session:
+            if not self.login(session):
+                return False
+            params = {}
+            if since:
+                params['since'] = since
+            resp = session.get(self.format_url(self.RESULTS_SINCE_URL), params=params)
+            if resp.status_code != requests.codes.ok:
+                print("Error: {}".format(resp.json().get('error', 'listing new results failed')))
+                return False
+            results = resp.json()
+            suffix = '_until_' + re.sub(r'[^0-9T]', '', results['until'][:19])
+            # The Task Assignments that the next download will request again.
+            # SubmitTimes are truncated to the second.
+            overlap_start = datetime.fromisoformat(results['until']) - \
+                self.RESULTS_SINCE_OVERLAP - timedelta(seconds=1)
+            overlap_ids = set()
+            for batch in results['batches']:
+                resp = session.get(self.format_url(batch['download_url']))
+                info = resp.headers['content-disposition']
+                filename = re.findall(r'filename="(.+)"', info)[0]
+                base, ext = os.path.splitext(filename)
+                filename = os.path.join(directory, base + suffix + ext)
+                reader = csv.DictReader(io.StringIO(resp.content.decode('utf-8'), newline=''))
+                rows = []
+                for row in reader:
+                    submit_time = self.parse_submit_time(row['SubmitTime'])
+                    if submit_time is None or submit_time >= overlap_start:
+                        overlap_ids.add(row['AssignmentId'])
+                    if row['AssignmentId'] not in seen_ids:
+                        rows.append(row)
+                if not rows:
+                    continue
+                with open(filename, 'w', newline='', encoding='utf-8') as fh:
+                    writer = csv.DictWriter(fh, reader.fieldnames, quoting=csv.QUOTE_ALL)
+                    writer.writeheader()
+                    writer.writerows(rows)
+        return {'until': results['until'], 'assignment_ids': sorted(overlap_ids, key=int)}
+
     @exception_handler
     def upload(self, options):
 
@@ -207,6 +269,15 @@ class TurkleClient(object):
     def extract_name(filename):
         return os.path.splitext(os.path.basename(filename))[0]
 
+    @staticmethod
+    def parse_submit_time(value):
+        # returns None if the SubmitTime of a results row is not in UTC
+        try:
+            return datetime.strptime(value, '%a %b %d %H:%M:%S UTC %Y').replace(
+                tzinfo=timezone.utc)
+        except ValueError:
+            return None
+
     @staticmethod
     def extract_error_message(resp):
         # returns None if no error message
@@ -2,22 +2,41 @@
 
 import argparse
 from client import TurkleClient
+import json
+import os
 import sys
 
 
 parser = argparse.ArgumentParser(
     description="Downloads all the batches from Turkle",
-    epilog="A batch must have at least one completed Task",
+    epilog="A batch must have at least one completed Task. "
+           "With --since or --watermark-file, only the Task Assignments "
+           "completed after the watermark are downloaded.",
     formatter_class=argparse.ArgumentDefaultsHelpFormatter
 )
 parser.add_argument("-u", help="admin username", required=True)
 parser.add_argument("-p", help="admin password")
 parser.add_argument("--server", help="protocol://hostname:port", default="http://localhost:8000")
 parser.add_argument("--dir", help="directory to save files", default=".")
+parser.add_argument("--since", help="ISO 8601 time of the previous download")
+parser.add_argument("--watermark-file",
+                    help="JSON file that stores the watermark between incremental downloads")
 args = parser.parse_args()
 
 client = TurkleClient(args.server, args.u, args.p)
-result = client.download(args.dir)
+if args.since or args.watermark_file:
+    watermark = None
+    if args.watermark_file and not args.since and os.path.exists(args.watermark_file):
+        with open(args.watermark_file) as fh:
+            watermark = json.load(fh)
+    result = client.download_since(args.dir, since=args.since, watermark=watermark)
+    if result:
+        if args.watermark_file:
+            with open(args.watermark_file, 'w') as fh:
+                json.dump(result, fh)
+        print("Downloaded results until {}".format(result['until']))
+else:
+    result = client.download(args.dir)
 if result:
     print("Success")
 else:
@@ -26,6 +26,10 @@ setuptools.setup(
     packages=setuptools.find_packages(exclude=['scripts', 'turkle_site', 'turkle.tests']),
     include_package_data=True,
     install_requires=requirements,
+    extras_require={
+        # Parquet and Arrow results exports
+        'arrow': ['pyarrow'],
+    },
     python_requires=">=3.6",
     classifiers=[
         "Development Status :: 5 - Production/Stable",
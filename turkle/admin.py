@@ -1,12 +1,12 @@
 import csv
-import json
 import logging
-import statistics
-import requests
-from bisect import bisect_left
+import tempfile
 from collections import defaultdict
+from contextlib import contextmanager
 from datetime import timedelta
-from io import StringIO
+from io import StringIO, TextIOWrapper
+from itertools import chain
+from urllib.parse import urlencode
 import humanfriendly
 from djaa_list_filter.admin import AjaxAutocompleteListFilterModelAdmin
 from django.contrib import admin, messages
@@ -18,32 +18,117 @@ from django.contrib.auth.admin import GroupAdmin, UserAdmin
 from django.contrib.auth.models import Group
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
-from django.db.models import DurationField, ExpressionWrapper, F
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
 from django.forms import (FileField, FileInput, HiddenInput, IntegerField, Media,
                           ModelForm, ModelMultipleChoiceField, TextInput, ValidationError, Widget)
-from django.http import HttpResponse, JsonResponse
+from django.http import (FileResponse, Http404, HttpResponse, JsonResponse,
+                         StreamingHttpResponse)
 from django.shortcuts import redirect, render
 from django.templatetags.static import static
 from django.urls import path, reverse
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.utils.html import format_html, format_html_join
 from django.utils.translation import ngettext
 from guardian.admin import GuardedModelAdmin
 from guardian.shortcuts import (assign_perm, get_groups_with_perms, get_users_with_perms,
                                 remove_perm)
 
-from .models import ActiveUser, ActiveProject, Batch, Project, TaskAssignment
-from .utils import are_anonymous_tasks_allowed, get_turkle_template_limit
-from django.views.decorators.csrf import csrf_exempt
+from . import exports, jobs
+from .caching import invalidate_batch_lists
+from .models import (ActiveUser, ActiveProject, Batch, DailyActivity, Job, Project,
+                     StatisticsSnapshot, TaskAssignment)
+from .utils import (are_anonymous_tasks_allowed, are_background_jobs_enabled,
+                    get_turkle_template_limit)
+from .views import activity_json_response
 User = get_user_model()
 
 logger = logging.getLogger(__name__)
 
 
+@contextmanager
+def _open_csv_upload(uploaded_file):
+    """Open an uploaded CSV file as a text stream
+
+    The file is decoded as UTF-8 incrementally while it is read, instead
+    of decoding the entire upload in memory.  Large uploads are stored in
+    temporary files by Django's upload handlers.
+
+    Args:
+        uploaded_file (UploadedFile):
+
+    Yields:
+        Text file handle positioned at the start of the file
+    """
+    uploaded_file.seek(0)
+    csv_fh = TextIOWrapper(uploaded_file, encoding='utf-8', newline='')
+    try:
+        yield csv_fh
+    finally:
+        # Detach so that the uploaded file is not closed along with the wrapper
+        csv_fh.detach()
+
+
+def _results_file_response(results_format, csv_filename, fieldnames, records):
+    """Return a response with results in a non-CSV format as an attachment
+
+    The results are written to a temporary file that is deleted when the
+    response is closed.
+    """
+    fh = tempfile.TemporaryFile()
+    exports.write_results(fh, results_format, fieldnames, records)
+    fh.seek(0)
+    return FileResponse(fh, as_attachment=True,
+                        filename=exports.results_filename(csv_filename, results_format),
+                        content_type=exports.RESULTS_FORMATS[results_format].content_type)
+
+
+def _parse_results_window(params):
+    """Parse the parameters that limit a results export to recent Task Assignments
+
+    Args:
+        params (QueryDict): May contain `since` and `until` ISO 8601 times
+
+    Returns:
+        A dict with `since` and `until` keys, whose values are None for
+        missing parameters
+
+    Raises:
+        ValueError if a parameter cannot be parsed
+    """
+    window = {'since': None, 'until': None}
+    for name in ('since', 'until'):
+        if params.get(name):
+            value = parse_datetime(params[name])
+            if value is None:
+                raise ValueError('Invalid {} time: {}'.format(name, params[name]))
+            if timezone.is_naive(value):
+                value = timezone.make_aware(value)
+            window[name] = value
+    return window
+
+
 def _format_timespan(sec):
     return '{} ({:,}s)'.format(humanfriendly.format_timespan(sec, max_units=6), sec)
 
 
+def _snapshot_stats(snapshot, stats):
+    """Add the statistics in a StatisticsSnapshot to a dict for a stats page table row"""
+    has_completed_assignments = snapshot.completed > 0
+    stats.update({
+        'has_completed_assignments': has_completed_assignments,
+        'assignments_completed': snapshot.completed,
+        'last_finished_time': snapshot.last_finished_at if has_completed_assignments else 'N/A',
+    })
+    for name, value in (('mean_work_time', snapshot.mean_work_time()),
+                        ('median_work_time', snapshot.median_work_time()),
+                        ('p90_work_time', snapshot.work_time_quantile(0.9)),
+                        ('p99_work_time', snapshot.work_time_quantile(0.99))):
+        stats[name] = int(value) if has_completed_assignments else 'N/A'
+    return stats
+
+
 class UserFullnameMultipleChoiceField(ModelMultipleChoiceField):
     """MultipleChoiceField that displays User's username and full name
     """
@@ -339,35 +424,33 @@ class BatchForm(ModelForm):
 
         validation_errors = []
 
-        # django InMemoryUploadedFile returns bytes and we need strings
-        rows = csv.reader(StringIO(csv_file.read().decode('utf-8')))
-        header = next(rows)
-
-        csv_fields = set(header)
-        template_fields = set(project.fieldnames)
-        if csv_fields != template_fields:
-            template_but_not_csv = template_fields.difference(csv_fields)
-            if template_but_not_csv:
-                validation_errors.append(
-                    ValidationError(
-                        'The CSV file is missing fields that are in the HTML template. '
-                        'These missing fields are: %s' %
-                        ', '.join(template_but_not_csv)))
-
-        expected_fields = len(header)
-        for (i, row) in enumerate(rows):
-            if len(row) != expected_fields:
-                validation_errors.append(
-                    ValidationError(
-                        'The CSV file header has %d fields, but line %d has %d fields' %
-                        (expected_fields, i+2, len(row))))
+        # Django's UploadedFile returns bytes and we need strings
+        with _open_csv_upload(csv_file) as csv_fh:
+            rows = csv.reader(csv_fh)
+            header = next(rows)
+
+            csv_fields = set(header)
+            template_fields = set(project.fieldnames)
+            if csv_fields != template_fields:
+                template_but_not_csv = template_fields.difference(csv_fields)
+                if template_but_not_csv:
+                    validation_errors.append(
+                        ValidationError(
+                            'The CSV file is missing fields that are in the HTML template. '
+                            'These missing fields are: %s' %
+                            ', '.join(template_but_not_csv)))
+
+            expected_fields = len(header)
+            for (i, row) in enumerate(rows):
+                if len(row) != expected_fields:
+                    validation_errors.append(
+                        ValidationError(
+                            'The CSV file header has %d fields, but line %d has %d fields' %
+                            (expected_fields, i+2, len(row))))
 
         if validation_errors:
             raise ValidationError(validation_errors)
 
-        # Rewind file, so it can be re-read
-        csv_file.seek(0)
-
     def clean_allotted_assignment_time(self):
         """Clean 'allotted_assignment_time' form field
 
@@ -388,6 +471,7 @@ class BatchForm(ModelForm):
 
 def activate_batches(modeladmin, request, queryset):
     queryset.update(active=True)
+    invalidate_batch_lists()
 
 
 activate_batches.short_description = "Activate selected Batches"
@@ -395,6 +479,7 @@ activate_batches.short_description = "Activate selected Batches"
 
 def activate_projects(modeladmin, request, queryset):
     queryset.update(active=True)
+    invalidate_batch_lists()
 
 
 activate_projects.short_description = "Activate selected Projects"
@@ -402,6 +487,7 @@ activate_projects.short_description = "Activate selected Projects"
 
 def deactivate_batches(modeladmin, request, queryset):
     queryset.update(active=False)
+    invalidate_batch_lists()
 
 
 deactivate_batches.short_description = "Deactivate selected Batches"
@@ -409,6 +495,7 @@ deactivate_batches.short_description = "Deactivate selected Batches"
 
 def deactivate_projects(modeladmin, request, queryset):
     queryset.update(active=False)
+    invalidate_batch_lists()
 
 
 deactivate_projects.short_description = "Deactivate selected Projects"
@@ -429,14 +516,25 @@ class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
     search_fields = ['name']
     autocomplete_fields = ['project']
 
+    # Maximum number of Task IDs returned per request when reviewing a Batch
+    TASK_IDS_PAGE_SIZE = 1000
+    # Task Assignments are listed by results-since.json once they were
+    # submitted this long ago, so that transactions that were still being
+    # committed when a watermark was taken are not skipped
+    RESULTS_SINCE_LAG = timedelta(minutes=1)
+
     class Media:
         css = {
             'all': ('turkle/css/admin-turkle.css',),
         }
 
     def assignments_completed(self, obj):
-        tfa = obj.total_finished_task_assignments()
-        ta = obj.assignments_per_task * obj.total_tasks()
+        # Use the count annotated by get_queryset() on changelist pages
+        if hasattr(obj, 'finished_assignment_count'):
+            tfa = obj.finished_assignment_count
+        else:
+            tfa = obj.total_finished_task_assignments()
+        ta = obj.assignments_per_task * obj.task_count
         h = format_html(
             '<progress value="{0}" max="{1}" title="Completed {0}/{1} Task Assignments">'
             '</progress> '.format(tfa, ta))
@@ -447,23 +545,27 @@ class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
         h += format_html(' {} / {}'.format(tfa, ta))
         return h
 
+    def get_queryset(self, request):
+        # Count the completed Task Assignments of every Batch on a changelist
+        # page with one subquery on the statistics snapshots, instead of
+        # running a COUNT query for each Batch in assignments_completed()
+        finished_assignment_counts = StatisticsSnapshot.objects.\
+            filter(batch_id=OuterRef('pk')).\
+            order_by().\
+            values('batch_id').\
+            annotate(completed=Sum('completed')).\
+            values('completed')
+        return super().get_queryset(request).annotate(
+            finished_assignment_count=Coalesce(
+                Subquery(finished_assignment_counts, output_field=models.IntegerField()), 0))
+
     def activity_json(self, request, batch_id):
         try:
             batch = Batch.objects.get(id=batch_id)
         except ObjectDoesNotExist:
             return JsonResponse({})
 
-        # Create dictionary mapping timestamp (in seconds) to number of TaskAssignments
-        # completed at that timestamp
-        completed_at = TaskAssignment.objects.\
-            filter(completed=True).\
-            filter(task__batch=batch).\
-            values_list('updated_at', flat=True)
-        timestamp_counts = defaultdict(int)
-        for ca in completed_at:
-            timestamp_counts[int(ca.timestamp())] += 1
-
-        return JsonResponse(timestamp_counts)
+        return activity_json_response(request, batch_id=batch.id)
 
     def batch_stats(self, request, batch_id):
         try:
@@ -472,61 +574,43 @@ class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
             messages.error(request, 'Cannot find Batch with ID {}'.format(batch_id))
             return redirect(reverse('admin:turkle_batch_changelist'))
 
-        tasks = batch.finished_task_assignments()\
-            .annotate(duration=ExpressionWrapper(F('updated_at') - F('created_at'),
-                                                 output_field=DurationField()))\
-            .order_by('updated_at')\
-            .values('assigned_to',  'duration', 'updated_at')
-
-        tasks_updated_at = [t['updated_at'] for t in tasks]
-        tasks_duration = [t['duration'].total_seconds() for t in tasks]
-        task_duration_by_user = defaultdict(list)
-        task_updated_at_by_user = defaultdict(list)
-        for t in tasks:
-            duration = t['duration'].total_seconds()
-            task_duration_by_user[t['assigned_to']].append(duration)
-            task_updated_at_by_user[t['assigned_to']].append(t['updated_at'])
-
-        user_ids = task_duration_by_user.keys()
-        stats_users = []
-        for user in User.objects.filter(id__in=user_ids).order_by('username'):
-            has_completed_assignments = user.id in task_duration_by_user
-            if has_completed_assignments:
-                last_finished_time = task_updated_at_by_user[user.id][-1]
-                mean_work_time = int(statistics.mean(task_duration_by_user[user.id]))
-                median_work_time = int(statistics.median(task_duration_by_user[user.id]))
-            else:
-                last_finished_time = 'N/A'
-                mean_work_time = 'N/A'
-                median_work_time = 'N/A'
-            stats_users.append({
-                'username': user.username,
-                'full_name': user.get_full_name(),
-                'has_completed_assignments': has_completed_assignments,
-                'assignments_completed': len(task_duration_by_user[user.id]),
-                'mean_work_time': mean_work_time,
-                'median_work_time': median_work_time,
-                'last_finished_time': last_finished_time,
-            })
+        snapshots_by_user = defaultdict(list)
+        for snapshot in batch.statistics_snapshots():
+            snapshots_by_user[snapshot.user_id].append(snapshot)
+        batch_snapshot = StatisticsSnapshot.merge(chain.from_iterable(snapshots_by_user.values()))
 
-        if tasks:
-            first_finished_time = tasks_updated_at[0]
-            last_finished_time = tasks_updated_at[-1]
-            total_work_time = _format_timespan(int(sum(tasks_duration)))
-            mean_work_time = _format_timespan(int(statistics.mean(tasks_duration)))
-            median_work_time = _format_timespan(int(statistics.median(tasks_duration)))
+        stats_users = []
+        for user in User.objects.filter(id__in=snapshots_by_user.keys()).order_by('username'):
+            stats_users.append(_snapshot_stats(
+                StatisticsSnapshot.merge(snapshots_by_user[user.id]), {
+                    'username': user.username,
+                    'full_name': user.get_full_name(),
+                }))
+
+        if batch_snapshot.completed > 0:
+            first_finished_time = batch_snapshot.first_finished_at
+            last_finished_time = batch_snapshot.last_finished_at
+            total_work_time = _format_timespan(int(batch_snapshot.total_work_time))
+            mean_work_time = _format_timespan(int(batch_snapshot.mean_work_time()))
+            median_work_time = _format_timespan(int(batch_snapshot.median_work_time()))
+            p90_work_time = _format_timespan(int(batch_snapshot.work_time_quantile(0.9)))
+            p99_work_time = _format_timespan(int(batch_snapshot.work_time_quantile(0.99)))
         else:
             first_finished_time = 'N/A'
             last_finished_time = 'N/A'
             total_work_time = 'N/A'
             mean_work_time = 'N/A'
             median_work_time = 'N/A'
+            p90_work_time = 'N/A'
+            p99_work_time = 'N/A'
 
         return render(request, 'admin/turkle/batch_stats.html', {
             'batch': batch,
             'batch_total_work_time': total_work_time,
             'batch_mean_work_time': mean_work_time,
             'batch_median_work_time': median_work_time,
+            'batch_p90_work_time': p90_work_time,
+            'batch_p99_work_time': p99_work_time,
             'first_finished_time': first_finished_time,
             'last_finished_time': last_finished_time,
             'unsubmitted_task_assignments': batch.unfinished_task_assignments(),
@@ -563,6 +647,15 @@ class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
         review_url = reverse('admin:turkle_review_batch_admin', kwargs={'batch_id': obj.id})
         return format_html('<a href="{}" class="button">review results</a>'.format(review_url))
 
+    def download_results(self, obj):
+        download_url = reverse('admin:turkle_download_batch', kwargs={'batch_id': obj.id})
+        links = [(download_url, 'CSV')]
+        for results_format, fmt in exports.RESULTS_FORMATS.items():
+            if exports.is_format_available(results_format):
+                links.append(('{}?format={}'.format(download_url, results_format), fmt.name))
+        return format_html_join(' ', '<a href="{}" class="button">{}</a>', links)
+    download_results.short_description = 'Download results'
+
     def download_input(self, obj):
         download_url = reverse('admin:turkle_download_batch_input', kwargs={'batch_id': obj.id})
         return format_html('<a href="{}" class="button">CSV input</a>'.format(download_url))
@@ -597,6 +690,9 @@ class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
                 ('Status', {
                     'fields': ('active', 'published')
                 }),
+                ('Results', {
+                    'fields': ('download_results',)
+                }),
                 ('Task Assignment Settings', {
                     'fields': ('assignments_per_task', 'allotted_assignment_time')
                 }),
@@ -618,7 +714,7 @@ class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
         if not obj:
             return []
         else:
-            return ('assignments_per_task', 'filename', 'published')
+            return ('assignments_per_task', 'download_results', 'filename', 'published')
 
     def get_urls(self):
         urls = super().get_urls()
@@ -641,6 +737,12 @@ class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
                  name='turkle_batch_activity_json'),
             path('<int:batch_id>/stats/',
                  self.admin_site.admin_view(self.batch_stats), name='turkle_batch_stats'),
+            path('<int:batch_id>/task-ids.json',
+                 self.admin_site.admin_view(self.task_ids_json),
+                 name='turkle_batch_task_ids_json'),
+            path('results-since.json',
+                 self.admin_site.admin_view(self.results_since_json),
+                 name='turkle_batch_results_since_json'),
             path('update_csv_line_endings',
                  self.admin_site.admin_view(self.update_csv_line_endings),
                  name='turkle_update_csv_line_endings'),
@@ -660,54 +762,123 @@ class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
 
     def download_batch(self, request, batch_id):
         batch = Batch.objects.get(id=batch_id)
-        csv_output = StringIO()
+        results_format = request.GET.get('format', 'csv')
+        if results_format != 'csv' and not exports.is_format_available(results_format):
+            messages.error(request, 'Results format {} is not available'.format(results_format))
+            return redirect(reverse('admin:turkle_batch_changelist'))
+        try:
+            window = _parse_results_window(request.GET)
+        except ValueError as e:
+            messages.error(request, str(e))
+            return redirect(reverse('admin:turkle_batch_changelist'))
+        # Incremental downloads are small and are requested by scripts
+        # that need the results file in the response, so they never run as jobs
+        incremental = any(value is not None for value in window.values())
+        if are_background_jobs_enabled() and not incremental:
+            job = jobs.enqueue(
+                'export_batch', created_by=request.user, batch_id=batch.id,
+                results_format=results_format,
+                lineterminator='\n' if request.session.get('csv_unix_line_endings', False)
+                else '\r\n')
+            return redirect(reverse('admin:turkle_job_progress', kwargs={'job_id': job.id}))
+        if results_format != 'csv':
+            fieldnames, records = exports.batch_results(batch, **window)
+            return _results_file_response(
+                results_format, batch.csv_results_filename(), fieldnames, records)
         if request.session.get('csv_unix_line_endings', False):
-            batch.to_csv(csv_output, lineterminator='\n')
+            csv_lines = batch.iter_csv(lineterminator='\n', **window)
         else:
-            batch.to_csv(csv_output)
-        csv_string = csv_output.getvalue()
-        response = HttpResponse(csv_string, content_type='text/csv')
+            csv_lines = batch.iter_csv(**window)
+        response = StreamingHttpResponse(csv_lines, content_type='text/csv')
         response['Content-Disposition'] = 'attachment; filename="{}"'.format(
             batch.csv_results_filename())
         return response
 
-    @csrf_exempt
+    def task_ids_json(self, request, batch_id):
+        """Return one page of the IDs of a Batch's Tasks, in order, for reviewing the Batch"""
+        try:
+            batch = Batch.objects.get(id=batch_id)
+        except ObjectDoesNotExist:
+            return JsonResponse({'error': 'Cannot find Batch with ID {}'.format(batch_id)},
+                                status=404)
+        try:
+            offset = max(int(request.GET.get('offset', 0)), 0)
+            limit = min(max(int(request.GET.get('limit', self.TASK_IDS_PAGE_SIZE)), 1),
+                        self.TASK_IDS_PAGE_SIZE)
+        except ValueError:
+            return JsonResponse({'error': 'offset and limit must be integers'}, status=400)
+        task_ids = batch.task_set.order_by('id').values_list('id', flat=True)
+        return JsonResponse({
+            'offset': offset,
+            'task_ids': list(task_ids[offset:offset + limit]),
+            'total': batch.task_set.count(),
+        })
+
+    def results_since_json(self, request):
+        """List the Batches with Task Assignments completed since a watermark
+
+        The `since` time from a previous response's `until` value limits
+        the list to Batches with new results.  Each Batch's download URL
+        exports only the new Task Assignments, up to this response's
+        `until` time, which is RESULTS_SINCE_LAG before the request.
+
+        A Task Assignment's submit time is set before its transaction
+        commits, so a Task Assignment that commits more than
+        RESULTS_SINCE_LAG after it is submitted can still be missed.
+        Clients should request results from a little before the previous
+        `until` time and skip the AssignmentIds they already downloaded.
+        """
+        try:
+            window = _parse_results_window(request.GET)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        if window['until'] is None:
+            window['until'] = timezone.now() - self.RESULTS_SINCE_LAG
+
+        task_assignments = TaskAssignment.objects.\
+            filter(completed=True).\
+            filter(updated_at__lte=window['until'])
+        if window['since'] is not None:
+            task_assignments = task_assignments.filter(updated_at__gt=window['since'])
+        batch_counts = task_assignments.\
+            values('task__batch_id', 'task__batch__name').\
+            annotate(assignments=Count('id')).\
+            order_by('task__batch_id')
+
+        params = {'until': window['until'].isoformat()}
+        if window['since'] is not None:
+            params['since'] = window['since'].isoformat()
+        batches = []
+        for batch_count in batch_counts:
+            download_url = reverse('admin:turkle_download_batch',
+                                   kwargs={'batch_id': batch_count['task__batch_id']})
+            batches.append({
+                'id': batch_count['task__batch_id'],
+                'name': batch_count['task__batch__name'],
+                'assignments': batch_count['assignments'],
+                'download_url': '{}?{}'.format(download_url, urlencode(params)),
+            })
+        return JsonResponse({
+            'since': params.get('since'),
+            'until': params['until'],
+            'batches': batches,
+        })
+
     def review_batch_admin_implement(self, request, batch_id):
-        batch = Batch.objects.get(id=batch_id)
-        project_id = batch.project_id
-        headers = request.headers
-        add_batch_url = 'http://localhost:8000/admin/turkle/batch/add/'
-        payload = {'project': project_id,
-                   'name': batch.name + '_review',
-                   'assignments_per_task': batch.assignments_per_task,
-                   'active': 1,
-                   'login_required': 1,
-                   'csrfmiddlewaretoken': request.COOKIES['csrftoken'],
-                   'can_work_on_user': batch
-                   }
-        csv_output = StringIO()
-        batch.to_csv_without_quoting(csv_output)
-        csv = batch.name + '_review.csv'
-        csv_data = csv_output.getvalue()
-        files = {'csv_file': (csv, csv_data)}
-        headers = dict(headers)
-        headers['X-CSRFToken'] = request.COOKIES['csrftoken']
-        headers['Referer'] = add_batch_url
-        session = requests.Session()
-        session.cookies.set('csrftoken', request.COOKIES['csrftoken'])
-        session.cookies.set('sessionid', request.COOKIES['sessionid'])
-        session.get(add_batch_url)
-        resp = session.post(add_batch_url, data=payload, files=files)
-        if b'correct the error' in resp.content:
-            print("Error: the csv file is invalid. Try uploading using the admin UI.")
-        url = resp.url.replace('review', 'publish')
-        payload = {
-            'csrfmiddlewaretoken': session.cookies.get_dict()['csrftoken'],
-        }
-        resp = session.post(url, data=payload)
-        if resp.status_code != requests.codes.ok:
-            print("Error: uploading the csv failed")
-        return redirect('/admin/turkle/batch/')
+        try:
+            batch = Batch.objects.get(id=batch_id)
+        except ObjectDoesNotExist:
+            messages.error(request, 'Cannot find Batch with ID {}'.format(batch_id))
+            return redirect(reverse('admin:turkle_batch_changelist'))
+        if are_background_jobs_enabled():
+            job = jobs.enqueue('create_review_batch', created_by=request.user, batch_id=batch.id)
+            return redirect(reverse('admin:turkle_job_progress', kwargs={'job_id': job.id}))
+        review_batch = batch.create_review_batch(created_by=request.user)
+        logger.info("User(%i) creating review Batch(%i) %s",
+                    request.user.id, review_batch.id, review_batch.name)
+        messages.success(request, 'Created review Batch {} with {} Tasks'.format(
+            review_batch.name, review_batch.task_count))
+        return redirect(reverse('admin:turkle_batch_changelist'))
 
     def download_batch_input(self, request, batch_id):
         batch = Batch.objects.get(id=batch_id)
@@ -723,6 +894,8 @@ class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
         return response
 
     def response_add(self, request, obj, post_url_continue=None):
+        if hasattr(obj, '_job'):
+            return redirect(reverse('admin:turkle_job_progress', kwargs={'job_id': obj._job.id}))
         return redirect(reverse('admin:turkle_review_batch', kwargs={'batch_id': obj.id}))
 
     def response_change(self, request, obj):
@@ -739,12 +912,14 @@ class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
             messages.error(request, 'Cannot find Batch with ID {}'.format(batch_id))
             return redirect(reverse('admin:turkle_batch_changelist'))
 
-        task_ids = list(batch.task_set.values_list('id', flat=True))
-        task_ids_as_json = json.dumps(task_ids)
+        first_task_id = batch.task_set.order_by('id').values_list('id', flat=True).first()
+        if first_task_id is None:
+            messages.error(request, 'Batch {} does not have any Tasks'.format(batch.name))
+            return redirect(reverse('admin:turkle_batch_changelist'))
         return render(request, 'admin/turkle/review_batch.html', {
             'batch_id': batch_id,
-            'first_task_id': task_ids[0],
-            'task_ids_as_json': task_ids_as_json,
+            'first_task_id': first_task_id,
+            'task_ids_page_size': self.TASK_IDS_PAGE_SIZE,
             'site_header': self.admin_site.site_header,
             'site_title': self.admin_site.site_title,
             'title': 'Review Batch',
@@ -763,24 +938,36 @@ class BatchAdmin(AjaxAutocompleteListFilterModelAdmin):
             obj.published = False
             # Only use CSV file when adding Batch, not when changing
             obj.filename = request.FILES['csv_file']._name
-            csv_text = request.FILES['csv_file'].read()
             super().save_model(request, obj, form, change)
             logger.info("User(%i) creating Batch(%i) %s", request.user.id, obj.id, obj.name)
 
-            csv_fh = StringIO(csv_text.decode('utf-8'))
-            csv_fields = set(next(csv.reader(csv_fh)))
-            csv_fh.seek(0)
-
-            template_fields = set(obj.project.fieldnames)
-            if csv_fields != template_fields:
-                csv_but_not_template = csv_fields.difference(template_fields)
-                if csv_but_not_template:
-                    messages.warning(
-                        request,
-                        'The CSV file contained fields that are not in the HTML template. '
-                        'These extra fields are: %s' %
-                        ', '.join(csv_but_not_template))
-            obj.create_tasks_from_csv(csv_fh)
+            errors = []
+            with _open_csv_upload(request.FILES['csv_file']) as csv_fh:
+                csv_fields = set(next(csv.reader(csv_fh)))
+                csv_fh.seek(0)
+
+                template_fields = set(obj.project.fieldnames)
+                if csv_fields != template_fields:
+                    csv_but_not_template = csv_fields.difference(template_fields)
+                    if csv_but_not_template:
+                        messages.warning(
+                            request,
+                            'The CSV file contained fields that are not in the HTML template. '
+                            'These extra fields are: %s' %
+                            ', '.join(csv_but_not_template))
+                if are_background_jobs_enabled():
+                    # Tasks are created by the run_jobs command, and
+                    # response_add() redirects to the Job progress page
+                    obj._job = jobs.enqueue('create_tasks', created_by=request.user,
+                                            input_file=request.FILES['csv_file'],
+                                            batch_id=obj.id)
+                else:
+                    obj.create_tasks_from_csv(csv_fh, errors=errors)
+            if errors:
+                messages.warning(
+                    request,
+                    'Skipped %i rows of the CSV file: %s' %
+                    (len(errors), '; '.join('line %i: %s' % error for error in errors[:10])))
         else:
             super().save_model(request, obj, form, change)
             logger.info("User(%i) updating Batch(%i) %s", request.user.id, obj.id, obj.name)
@@ -939,17 +1126,7 @@ class ProjectAdmin(GuardedModelAdmin, AjaxAutocompleteListFilterModelAdmin):
         except ObjectDoesNotExist:
             return JsonResponse({})
 
-        # Create dictionary mapping timestamp (in seconds) to number of TaskAssignments
-        # completed at that timestamp
-        completed_at = TaskAssignment.objects.\
-            filter(completed=True).\
-            filter(task__batch__project=project).\
-            values_list('updated_at', flat=True)
-        timestamp_counts = defaultdict(int)
-        for ca in completed_at:
-            timestamp_counts[int(ca.timestamp())] += 1
-
-        return JsonResponse(timestamp_counts)
+        return activity_json_response(request, batch__project_id=project.id)
 
     def get_urls(self):
         urls = super().get_urls()
@@ -1039,59 +1216,35 @@ class ProjectAdmin(GuardedModelAdmin, AjaxAutocompleteListFilterModelAdmin):
             messages.error(request, 'Cannot find Project with ID {}'.format(project_id))
             return redirect(reverse('admin:turkle_project_changelist'))
 
-        tasks = project.finished_task_assignments()\
-            .annotate(duration=ExpressionWrapper(F('updated_at') - F('created_at'),
-                                                 output_field=DurationField()))\
-            .order_by('updated_at')\
-            .values('assigned_to', 'task__batch_id', 'duration', 'updated_at')
-
-        tasks_updated_at = [t['updated_at'] for t in tasks]
-        tasks_duration = [t['duration'].total_seconds() for t in tasks]
-        task_duration_by_batch = defaultdict(list)
-        task_updated_at_by_batch = defaultdict(list)
-        task_duration_by_user = defaultdict(list)
-        task_updated_at_by_user = defaultdict(list)
-        for t in tasks:
-            duration = t['duration'].total_seconds()
-            task_duration_by_batch[t['task__batch_id']].append(duration)
-            task_updated_at_by_batch[t['task__batch_id']].append(t['updated_at'])
-            task_duration_by_user[t['assigned_to']].append(duration)
-            task_updated_at_by_user[t['assigned_to']].append(t['updated_at'])
+        snapshots_by_batch = defaultdict(list)
+        snapshots_by_user = defaultdict(list)
+        for snapshot in StatisticsSnapshot.objects.filter(batch__project_id=project.id):
+            snapshots_by_batch[snapshot.batch_id].append(snapshot)
+            if snapshot.user_id is not None:
+                snapshots_by_user[snapshot.user_id].append(snapshot)
+        project_snapshot = StatisticsSnapshot.merge(
+            chain.from_iterable(snapshots_by_batch.values()))
 
         uncompleted_tas_active_batches = 0
         uncompleted_tas_inactive_batches = 0
 
         stats_batches = []
         for batch in project.batch_set.order_by('name'):
-            has_completed_assignments = batch.id in task_duration_by_batch
-            if has_completed_assignments:
-                assignments_completed = len(task_duration_by_batch[batch.id])
-                last_finished_time = task_updated_at_by_batch[batch.id][-1]
-                mean_work_time = int(statistics.mean(task_duration_by_batch[batch.id]))
-                median_work_time = int(statistics.median(task_duration_by_batch[batch.id]))
-            else:
-                assignments_completed = 0
-                last_finished_time = 'N/A'
-                mean_work_time = 'N/A'
-                median_work_time = 'N/A'
-            total_task_assignments = batch.total_task_assignments()
+            snapshot = StatisticsSnapshot.merge(snapshots_by_batch[batch.id])
+            assignments_completed = snapshot.completed
+            total_task_assignments = batch.assignments_per_task * batch.task_count
             if total_task_assignments != 0:
                 assignments_completed_percentage = '%.1f' % \
                     (100.0 * assignments_completed / total_task_assignments)
             else:
                 assignments_completed_percentage = 'N/A'
-            stats_batches.append({
+            stats_batches.append(_snapshot_stats(snapshot, {
                 'batch_id': batch.id,
                 'name': batch.name,
                 'active': batch.active,
-                'has_completed_assignments': has_completed_assignments,
-                'assignments_completed': assignments_completed,
                 'total_task_assignments': total_task_assignments,
                 'assignments_completed_percentage': assignments_completed_percentage,
-                'mean_work_time': mean_work_time,
-                'median_work_time': median_work_time,
-                'last_finished_time': last_finished_time,
-            })
+            }))
 
             # We use max(0, x) to ensure the # of remaining Task
             # Assignments for each Batch is never negative.
@@ -1107,41 +1260,30 @@ class ProjectAdmin(GuardedModelAdmin, AjaxAutocompleteListFilterModelAdmin):
                 uncompleted_tas_inactive_batches += \
                     max(0, total_task_assignments - assignments_completed)
 
-        user_ids = task_duration_by_user.keys()
         stats_users = []
-        for user in User.objects.filter(id__in=user_ids).order_by('username'):
-            has_completed_assignments = user.id in task_duration_by_user
-            if has_completed_assignments:
-                last_finished_time = task_updated_at_by_user[user.id][-1]
-                mean_work_time = int(statistics.mean(task_duration_by_user[user.id]))
-                median_work_time = int(statistics.median(task_duration_by_user[user.id]))
-            else:
-                last_finished_time = 'N/A'
-                mean_work_time = 'N/A'
-                median_work_time = 'N/A'
-            stats_users.append({
-                'username': user.username,
-                'full_name': user.get_full_name(),
-                'has_completed_assignments': has_completed_assignments,
-                'assignments_completed': len(task_duration_by_user[user.id]),
-                'mean_work_time': mean_work_time,
-                'median_work_time': median_work_time,
-                'last_finished_time': last_finished_time,
-            })
-
-        if tasks:
-            now = timezone.now()
-            tca_1_day = len(tasks) - bisect_left(tasks_updated_at, now - timedelta(days=1))
-            tca_7_day = len(tasks) - bisect_left(tasks_updated_at, now - timedelta(days=7))
-            tca_30_day = len(tasks) - bisect_left(tasks_updated_at, now - timedelta(days=30))
-            tca_90_day = len(tasks) - bisect_left(tasks_updated_at, now - timedelta(days=90))
-            tca_180_day = len(tasks) - bisect_left(tasks_updated_at, now - timedelta(days=180))
-            tca_365_day = len(tasks) - bisect_left(tasks_updated_at, now - timedelta(days=365))
-            first_finished_time = tasks_updated_at[0]
-            last_finished_time = tasks_updated_at[-1]
-            total_work_time = _format_timespan(int(sum(tasks_duration)))
-            mean_work_time = _format_timespan(int(statistics.mean(tasks_duration)))
-            median_work_time = _format_timespan(int(statistics.median(tasks_duration)))
+        for user in User.objects.filter(id__in=snapshots_by_user.keys()).order_by('username'):
+            stats_users.append(_snapshot_stats(
+                StatisticsSnapshot.merge(snapshots_by_user[user.id]), {
+                    'username': user.username,
+                    'full_name': user.get_full_name(),
+                }))
+
+        if project_snapshot.completed > 0:
+            trailing_counts = DailyActivity.trailing_counts(
+                (1, 7, 30, 90, 180, 365), batch__project_id=project.id)
+            tca_1_day = trailing_counts[1]
+            tca_7_day = trailing_counts[7]
+            tca_30_day = trailing_counts[30]
+            tca_90_day = trailing_counts[90]
+            tca_180_day = trailing_counts[180]
+            tca_365_day = trailing_counts[365]
+            first_finished_time = project_snapshot.first_finished_at
+            last_finished_time = project_snapshot.last_finished_at
+            total_work_time = _format_timespan(int(project_snapshot.total_work_time))
+            mean_work_time = _format_timespan(int(project_snapshot.mean_work_time()))
+            median_work_time = _format_timespan(int(project_snapshot.median_work_time()))
+            p90_work_time = _format_timespan(int(project_snapshot.work_time_quantile(0.9)))
+            p99_work_time = _format_timespan(int(project_snapshot.work_time_quantile(0.99)))
         else:
             tca_1_day = 'N/A'
             tca_7_day = 'N/A'
@@ -1154,10 +1296,12 @@ class ProjectAdmin(GuardedModelAdmin, AjaxAutocompleteListFilterModelAdmin):
             total_work_time = 'N/A'
             mean_work_time = 'N/A'
             median_work_time = 'N/A'
+            p90_work_time = 'N/A'
+            p99_work_time = 'N/A'
 
         return render(request, 'admin/turkle/project_stats.html', {
             'project': project,
-            'project_total_completed_assignments': len(tasks),
+            'project_total_completed_assignments': project_snapshot.completed,
             'project_total_completed_assignments_1_day': tca_1_day,
             'project_total_completed_assignments_7_day': tca_7_day,
             'project_total_completed_assignments_30_day': tca_30_day,
@@ -1167,6 +1311,8 @@ class ProjectAdmin(GuardedModelAdmin, AjaxAutocompleteListFilterModelAdmin):
             'project_total_work_time': total_work_time,
             'project_mean_work_time': mean_work_time,
             'project_median_work_time': median_work_time,
+            'project_p90_work_time': p90_work_time,
+            'project_p99_work_time': p99_work_time,
             'first_finished_time': first_finished_time,
             'last_finished_time': last_finished_time,
             'stats_users': stats_users,
@@ -1189,23 +1335,26 @@ class ProjectAdmin(GuardedModelAdmin, AjaxAutocompleteListFilterModelAdmin):
         except ObjectDoesNotExist:
             messages.error(request, 'Cannot find Project with ID {}'.format(project_id))
             return redirect(reverse('admin:turkle_project_changelist'))
-        res_rows = []
-        fieldnames = None
+        results_format = request.GET.get('format', 'csv')
+        if results_format != 'csv' and not exports.is_format_available(results_format):
+            messages.error(request, 'Results format {} is not available'.format(results_format))
+            return redirect(reverse('admin:turkle_project_changelist'))
+        if are_background_jobs_enabled():
+            job = jobs.enqueue('export_project_results', created_by=request.user,
+                               project_id=project.id, results_format=results_format)
+            return redirect(reverse('admin:turkle_job_progress', kwargs={'job_id': job.id}))
+        if results_format != 'csv':
+            results = exports.project_reviewed_results(project)
+            if results is None:
+                messages.error(request, 'Cannot find reviewed Batch')
+                return redirect(reverse('admin:turkle_project_changelist'))
+            return _results_file_response(
+                results_format, project.name + '_final_results.csv', *results)
         csv_fh = StringIO()
-        for batch in project.batch_set.order_by('name'):
-            if not batch.name.endswith('_review'):
-                continue
-            fieldnames, rows = batch._results_data(batch.task_set.all())
-            res_rows += rows
-        if fieldnames is None:
+        if not project.reviewed_results_to_csv(csv_fh):
             messages.error(request, 'Cannot find reviewed Batch')
             return redirect(reverse('admin:turkle_project_changelist'))
 
-        writer = csv.DictWriter(csv_fh, fieldnames, lineterminator='\r\n',
-                                quoting=csv.QUOTE_ALL)
-        writer.writeheader()
-        for row in res_rows:
-            writer.writerow(row)
         response = HttpResponse(csv_fh.getvalue(), content_type='text/csv')
         response['Content-Disposition'] = 'attachment; filename="{}"'.format(
             project.name + '_final_results.csv')
@@ -1312,6 +1461,89 @@ class TaskAssignmentAdmin(ViewOnlyAdminMixin, admin.ModelAdmin):
         return my_urls + urls
 
 
+class JobAdmin(ViewOnlyAdminMixin, admin.ModelAdmin):
+    """View for monitoring background jobs run by the run_jobs command"""
+    list_display = ('id', 'job_type', 'status', 'progress', 'created_by', 'created_at',
+                    'finished_at', 'progress_page')
+    list_filter = ('status', 'job_type')
+
+    class Media:
+        css = {
+            'all': ('turkle/css/admin-turkle.css',),
+        }
+
+    def download_job_result(self, request, job_id):
+        job = self._get_job(job_id)
+        if not job.result_file:
+            raise Http404('Job {} has no result file'.format(job_id))
+        return FileResponse(job.result_file.open('rb'), as_attachment=True,
+                            filename=job.result_filename)
+
+    def get_urls(self):
+        urls = super().get_urls()
+        my_urls = [
+            path('<int:job_id>/progress/',
+                 self.admin_site.admin_view(self.job_progress), name='turkle_job_progress'),
+            path('<int:job_id>/status.json',
+                 self.admin_site.admin_view(self.job_status_json),
+                 name='turkle_job_status_json'),
+            path('<int:job_id>/download/',
+                 self.admin_site.admin_view(self.download_job_result),
+                 name='turkle_download_job_result'),
+        ]
+        return my_urls + urls
+
+    def job_progress(self, request, job_id):
+        request.current_app = self.admin_site.name
+        job = self._get_job(job_id)
+        return render(request, 'admin/turkle/job_progress.html', {
+            'job': job,
+            'site_header': self.admin_site.site_header,
+            'site_title': self.admin_site.site_title,
+            'title': 'Job {}'.format(job.id),
+            'media': Media(self.Media),
+            # below is for the breadcrumbs
+            'opts': self.model._meta,
+            'has_view_permission': self.has_view_permission(request, job),
+        })
+
+    def job_status_json(self, request, job_id):
+        job = self._get_job(job_id)
+        progress, total = job.get_progress()
+        status = {
+            'id': job.id,
+            'job_type': job.job_type,
+            'status': job.status,
+            'status_display': job.get_status_display(),
+            'progress': progress,
+            'total': total,
+            'message': job.message,
+            'finished': job.is_finished(),
+            'download_url': None,
+            'next_url': None,
+        }
+        if job.status == Job.SUCCEEDED:
+            if job.result_file:
+                status['download_url'] = reverse('admin:turkle_download_job_result',
+                                                 kwargs={'job_id': job.id})
+            if job.job_type == 'create_tasks':
+                status['next_url'] = reverse('admin:turkle_review_batch',
+                                             kwargs={'batch_id': job.parameters['batch_id']})
+        return JsonResponse(status)
+
+    def progress_page(self, obj):
+        progress_url = reverse('admin:turkle_job_progress', kwargs={'job_id': obj.id})
+        return format_html('<a href="{}" class="button">Progress</a>'.format(progress_url))
+    progress_page.short_description = 'Progress'
+
+    @staticmethod
+    def _get_job(job_id):
+        try:
+            return Job.objects.get(id=job_id)
+        except ObjectDoesNotExist:
+            raise Http404('Cannot find Job with ID {}'.format(job_id))
+
+
 class ActiveObjectPeriodListFilter(admin.SimpleListFilter):
     """Filter active objects by period of activity"""
     title = 'active period'
@@ -1420,5 +1652,6 @@ admin.site.register(User, CustomUserAdmin)
 admin.site.register(ActiveUser, ActiveUserAdmin)
 admin.site.register(ActiveProject, ActiveProjectAdmin)
 admin.site.register(Batch, BatchAdmin)
+admin.site.register(Job, JobAdmin)
 admin.site.register(Project, ProjectAdmin)
 admin.site.register(TaskAssignment, TaskAssignmentAdmin)
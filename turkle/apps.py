@@ -1,7 +1,16 @@
 from django.apps import AppConfig
+from django.core import checks
+
 from .utils import get_site_name
 
 
 class TurkleAppConfig(AppConfig):
     name = 'turkle'
     verbose_name = get_site_name()
+
+    def ready(self):
+        # Connect signal receivers
+        from . import signals  # noqa: F401
+
+        from .caching import check_shared_cache
+        checks.register(check_shared_cache, checks.Tags.caches)
@@ -0,0 +1,189 @@
+"""Caching for the Batch listings shown on the index page and for Task pages
+
+Cached values are never deleted.  Instead, each cache key embeds a
+version number, and invalidating a value increments the version so
+that the old entry is never read again and eventually expires:
+
+- the *Batch list version* covers which Batches each user can access,
+  and is bumped whenever a Batch, Project or permission changes
+- each Batch has a *Batch version* that covers the number of Tasks
+  available in the Batch, and is bumped whenever Tasks or Task
+  Assignments in the Batch are written
+
+Versions are bumped immediately and again when the current transaction
+commits, so that a request that reads the database before the commit
+cannot leave stale values cached under the new version.
+
+A version bumped by one process is only seen by the others when the
+cache is shared between them, so the Batch lists and available Task
+counts are not cached in a per-process in-memory cache.
+
+The populated HTML templates of Tasks are also cached.  A Task's input
+fields never change, so those cache keys embed the revision of the
+Project template instead of a version number.
+"""
+import time
+
+from django.conf import settings
+from django.core import checks
+from django.db import transaction
+
+from .utils import get_turkle_cache, get_turkle_cache_timeout, is_turkle_cache_shared
+
+BATCH_LIST_VERSION_KEY = 'turkle:batch-list-version'
+
+
+def _batch_version_key(batch_id):
+    return 'turkle:batch-version:{}'.format(batch_id)
+
+
+def _new_version():
+    # A time-based initial version avoids reusing the version numbers of
+    # entries that may still be cached after a version key was evicted
+    return time.time_ns()
+
+
+def _bump_versions(keys):
+    cache = get_turkle_cache()
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _new_version(), None)
+
+
+def _get_versions(keys):
+    cache = get_turkle_cache()
+    versions = cache.get_many(keys)
+    missing = {key: _new_version() for key in keys if key not in versions}
+    if missing:
+        cache.set_many(missing, None)
+        versions.update(missing)
+    return versions
+
+
+def _user_key(user):
+    return str(user.id) if user.is_authenticated else 'anonymous'
+
+
+def check_shared_cache(app_configs, **kwargs):
+    """System check that warns when the Batch lists cannot be cached"""
+    if getattr(settings, 'TURKLE_CACHE_SHARED', None) is None and not is_turkle_cache_shared():
+        return [checks.Warning(
+            'The Turkle cache is a per-process in-memory cache, so the Batch lists '
+            'on the index page are not cached.',
+            hint='Configure a shared cache such as memcached or Redis, or set '
+                 'TURKLE_CACHE_SHARED = True if Turkle runs in a single process.',
+            id='turkle.W001',
+        )]
+    return []
+
+
+def invalidate_batch_lists():
+    """Invalidate the cached lists of Batches each user can access"""
+    _bump_versions([BATCH_LIST_VERSION_KEY])
+    transaction.on_commit(lambda: _bump_versions([BATCH_LIST_VERSION_KEY]))
+
+
+def invalidate_available_task_counts(batch_ids):
+    """Invalidate the cached available Task counts for the specified Batches
+
+    Args:
+        batch_ids (iterable): Batch IDs (int)
+    """
+    keys = [_batch_version_key(batch_id) for batch_id in set(batch_ids)]
+    if keys:
+        _bump_versions(keys)
+        transaction.on_commit(lambda: _bump_versions(keys))
+
+
+def get_batch_list(user, compute):
+    """Return the cached list of Batch rows the user can access
+
+    Args:
+        user (User|AnonymousUser):
+        compute (callable): Called with no arguments to build the list
+            when it is not cached.  The list must be picklable.
+
+    Returns:
+        The list returned by `compute`
+    """
+    if not is_turkle_cache_shared():
+        return compute()
+    cache = get_turkle_cache()
+    version = _get_versions([BATCH_LIST_VERSION_KEY])[BATCH_LIST_VERSION_KEY]
+    key = 'turkle:batch-list:{}:{}'.format(version, _user_key(user))
+    batch_list = cache.get(key)
+    if batch_list is None:
+        batch_list = compute()
+        cache.set(key, batch_list, get_turkle_cache_timeout())
+    return batch_list
+
+
+def get_available_task_counts(batch_rows, user, compute):
+    """Return cached available Task counts for a list of Batches
+
+    The number of available Tasks in a Batch with one Assignment per
+    Task is the same for every user who can access the Batch, so those
+    counts are shared between users.
+
+    Args:
+        batch_rows (list): Dicts with 'id' and 'assignments_per_task' keys
+        user (User|AnonymousUser):
+        compute (callable): Called with a list of Batch IDs whose counts
+            are not cached.  Returns a dict mapping Batch IDs to counts.
+
+    Returns:
+        Dict where keys are Batch IDs (int) and values are the total
+        number of tasks in the batch available for the specified user.
+    """
+    if not batch_rows:
+        return {}
+    if not is_turkle_cache_shared():
+        return compute([row['id'] for row in batch_rows])
+    cache = get_turkle_cache()
+    versions = _get_versions([_batch_version_key(row['id']) for row in batch_rows])
+    count_keys = {}
+    for row in batch_rows:
+        user_key = 'all' if row['assignments_per_task'] == 1 else _user_key(user)
+        count_keys[row['id']] = 'turkle:available-tasks:{}:{}:{}'.format(
+            row['id'], versions[_batch_version_key(row['id'])], user_key)
+
+    cached_counts = cache.get_many(count_keys.values())
+    available_task_counts = {}
+    missing_batch_ids = []
+    for batch_id, key in count_keys.items():
+        if key in cached_counts:
+            available_task_counts[batch_id] = cached_counts[key]
+        else:
+            missing_batch_ids.append(batch_id)
+
+    if missing_batch_ids:
+        computed_counts = compute(missing_batch_ids)
+        cache.set_many({count_keys[batch_id]: computed_counts[batch_id]
+                        for batch_id in missing_batch_ids},
+                       get_turkle_cache_timeout())
+        available_task_counts.update(computed_counts)
+    return available_task_counts
+
+
+def get_task_html(task, project):
+    """Return the cached HTML template of the Task's Project, populated with the Task's fields
+
+    The cache backend bounds the number of cached pages, evicting the
+    least recently used entries.
+
+    Args:
+        task (Task):
+        project (Project): The Project of the Task's Batch
+
+    Returns:
+        String returned by task.populate_html_template()
+    """
+    cache = get_turkle_cache()
+    key = 'turkle:task-html:{}:{}'.format(task.id, project.updated_at.timestamp())
+    html = cache.get(key)
+    if html is None:
+        html = task.populate_html_template()
+        cache.set(key, html, get_turkle_cache_timeout())
+    return html
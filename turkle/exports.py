@@ -0,0 +1,158 @@
+"""Results exports in columnar and JSON Lines formats
+
+CSV results are written by Batch.to_csv().  This module writes the same
+results records as typed columns, with times as timestamps and IDs and
+work times as integers:
+
+- 'jsonl.gz': gzip-compressed JSON Lines, one object per Task Assignment
+- 'parquet': Apache Parquet
+- 'arrow': Apache Arrow IPC file format
+
+The Parquet and Arrow formats require the optional pyarrow package,
+which is installed with `pip install turkle[arrow]`.
+
+Records are written in chunks of RESULTS_CHUNK_SIZE Task Assignments,
+so the results are never held in memory all at once.
+"""
+from collections import namedtuple
+import datetime
+import gzip
+from itertools import chain, islice
+import json
+import os.path
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from .models import RESULTS_CHUNK_SIZE
+
+ResultsFormat = namedtuple('ResultsFormat', ['name', 'extension', 'content_type',
+                                             'requires_pyarrow'])
+
+RESULTS_FORMATS = {
+    'jsonl.gz': ResultsFormat('JSON Lines', '.jsonl.gz', 'application/gzip', False),
+    'parquet': ResultsFormat('Parquet', '.parquet', 'application/vnd.apache.parquet', True),
+    'arrow': ResultsFormat('Arrow', '.arrow', 'application/vnd.apache.arrow.file', True),
+}
+
+INTEGER_FIELDS = ('HITId', 'HITTypeId', 'MaxAssignments', 'AssignmentDurationInSeconds',
+                  'AssignmentId', 'WorkerId', 'WorkTimeInSeconds')
+TIME_FIELDS = ('CreationTime', 'AcceptTime', 'SubmitTime')
+
+
+def is_format_available(results_format):
+    """Return True if results can be exported in the format on this server"""
+    return results_format in RESULTS_FORMATS and \
+        (pyarrow is not None or not RESULTS_FORMATS[results_format].requires_pyarrow)
+
+
+def batch_results(batch, since=None, until=None):
+    """
+    Args:
+        batch (Batch):
+        since (datetime): Only include Task Assignments completed after this time
+        until (datetime): Only include Task Assignments completed at or before this time
+
+    Returns:
+        A tuple of (fieldnames, iterator of records) for the Batch's results
+    """
+    records = batch._iter_results_records(batch.task_set.all(), since=since, until=until)
+    return batch._get_csv_fieldnames(), records
+
+
+def project_reviewed_results(project):
+    """
+    Args:
+        project (Project):
+
+    Returns:
+        A tuple of (fieldnames, iterator of records) for the results of
+        the Project's review Batches, or None if it has no review Batches
+    """
+    batches = list(project.batch_set.filter(name__endswith='_review').order_by('name'))
+    if not batches:
+        return None
+    fieldnames = []
+    for batch in batches:
+        fieldnames += [f for f in batch._get_csv_fieldnames() if f not in fieldnames]
+    records = chain.from_iterable(
+        batch._iter_results_records(batch.task_set.all()) for batch in batches)
+    return fieldnames, records
+
+
+def results_filename(basename, results_format):
+    """Replace the extension of a results filename with the format's extension"""
+    return os.path.splitext(basename)[0] + RESULTS_FORMATS[results_format].extension
+
+
+def write_results(fh, results_format, fieldnames, records):
+    """Write results records to a binary file handle
+
+    Args:
+        fh (file-like object): Binary file handle for output
+        results_format (str): Key of RESULTS_FORMATS
+        fieldnames (list): Column names, in order
+        records (iterable): Dicts whose keys are a subset of fieldnames
+
+    Raises:
+        ValueError if the format is unknown or not available on this server
+    """
+    if results_format not in RESULTS_FORMATS:
+        raise ValueError('Unknown results format: {}'.format(results_format))
+    if not is_format_available(results_format):
+        raise ValueError('The {} results format requires the pyarrow package'.format(
+            RESULTS_FORMATS[results_format].name))
+
+    if results_format == 'jsonl.gz':
+        _write_jsonl_gz(fh, records)
+    elif results_format == 'parquet':
+        schema = _arrow_schema(fieldnames)
+        with pyarrow.parquet.ParquetWriter(fh, schema) as writer:
+            _write_arrow_tables(writer, schema, records)
+    elif results_format == 'arrow':
+        schema = _arrow_schema(fieldnames)
+        with pyarrow.ipc.new_file(fh, schema) as writer:
+            _write_arrow_tables(writer, schema, records)
+
+
+def _json_default(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(value).__name__))
+
+
+def _write_jsonl_gz(fh, records):
+    with gzip.GzipFile(fileobj=fh, mode='wb') as gzip_fh:
+        for record in records:
+            gzip_fh.write(json.dumps(record, default=_json_default).encode('utf-8'))
+            gzip_fh.write(b'\n')
+
+
+def _arrow_schema(fieldnames):
+    def field_type(fieldname):
+        if fieldname in INTEGER_FIELDS:
+            return pyarrow.int64()
+        elif fieldname in TIME_FIELDS:
+            return pyarrow.timestamp('us', tz='UTC')
+        else:
+            return pyarrow.string()
+    return pyarrow.schema([(fieldname, field_type(fieldname)) for fieldname in fieldnames])
+
+
+def _write_arrow_tables(writer, schema, records):
+    string_fields = [f.name for f in schema if pyarrow.types.is_string(f.type)]
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, RESULTS_CHUNK_SIZE))
+        if not chunk:
+            break
+        columns = {name: [record.get(name) for record in chunk] for name in schema.names}
+        for name in string_fields:
+            # Input and answer values are usually strings, but any JSON value is allowed
+            columns[name] = [v if v is None or isinstance(v, str) else json.dumps(v)
+                             for v in columns[name]]
+        writer.write_table(pyarrow.Table.from_pydict(columns, schema=schema))
@@ -0,0 +1,184 @@
+"""Background jobs for long-running admin operations
+
+When the TURKLE_BACKGROUND_JOBS setting is enabled, the admin queues
+Batch creation and results exports as Job objects instead of running
+them in the web request.  Queued Jobs are executed by the `run_jobs`
+management command.
+
+Each job type is implemented by a function that takes a Job and is
+registered with the `job_type` decorator.  The function reports progress
+with `Job.update_progress()`, may store its output in `Job.result_file`,
+and returns a message that is shown on the Job progress page.  Raising
+an exception marks the Job as failed.
+"""
+from io import TextIOWrapper
+import logging
+import tempfile
+
+from django.core.files import File
+from django.db import connections
+
+from . import exports
+from .models import RESULTS_CHUNK_SIZE, Batch, Job, Project
+
+logger = logging.getLogger(__name__)
+
+JOB_TYPES = {}
+
+
+def job_type(name):
+    """Decorator that registers a function as the implementation of a job type"""
+    def register(func):
+        JOB_TYPES[name] = func
+        return func
+    return register
+
+
+def enqueue(name, created_by=None, input_file=None, **parameters):
+    """Queue a Job
+
+    Args:
+        name (str): Registered job type
+        created_by (User): User who requested the Job
+        input_file (File): Optional file that is copied to Job.input_file
+        **parameters: JSON serializable parameters for the job type
+
+    Returns:
+        Job
+    """
+    if name not in JOB_TYPES:
+        raise ValueError('Unknown job type: {}'.format(name))
+    if created_by is not None and not created_by.is_authenticated:
+        created_by = None
+    job = Job(job_type=name, parameters=parameters, created_by=created_by)
+    if input_file is not None:
+        job.input_file.save(input_file.name, input_file, save=False)
+    job.save()
+    logger.info('Queued Job(%i) %s', job.id, name)
+    return job
+
+
+def run_job(job):
+    """Execute a claimed Job and record its final status
+
+    Args:
+        job (Job): Job with status Job.RUNNING
+    """
+    logger.info('Running Job(%i) %s', job.id, job.job_type)
+    try:
+        message = JOB_TYPES[job.job_type](job)
+    except Exception as e:
+        logger.exception('Job(%i) %s failed', job.id, job.job_type)
+        job.finish(Job.FAILED, str(e) or e.__class__.__name__)
+    else:
+        if job.finish(Job.SUCCEEDED, message or ''):
+            logger.info('Job(%i) %s succeeded', job.id, job.job_type)
+        else:
+            logger.warning('Job(%i) %s finished after it was marked as failed',
+                           job.id, job.job_type)
+    finally:
+        if job.input_file:
+            job.input_file.delete(save=False)
+            Job.objects.filter(id=job.id).update(input_file='')
+
+
+def run_job_by_id(job_id):
+    """Execute a claimed Job in a worker process"""
+    try:
+        run_job(Job.objects.get(id=job_id))
+    finally:
+        connections.close_all()
+
+
+def _save_result(job, filename, write):
+    # Results are written to a temporary file and then copied to storage,
+    # so that they are never held in memory
+    with tempfile.TemporaryFile() as fh:
+        write(fh)
+        fh.seek(0)
+        job.result_file.save(filename, File(fh), save=False)
+        job.result_filename = filename
+
+
+def _report_progress(job, records):
+    # Reports progress every RESULTS_CHUNK_SIZE records, which also keeps
+    # the Job from being failed by Job.fail_stale()
+    num_records = 0
+    for num_records, record in enumerate(records, 1):
+        yield record
+        if num_records % RESULTS_CHUNK_SIZE == 0:
+            job.update_progress(num_records)
+    job.update_progress(num_records)
+
+
+def _csv_writer(write_csv):
+    def write(fh):
+        csv_fh = TextIOWrapper(fh, encoding='utf-8', newline='')
+        write_csv(csv_fh)
+        csv_fh.detach()
+    return write
+
+
+@job_type('create_tasks')
+def create_tasks(job):
+    batch = Batch.objects.get(id=job.parameters['batch_id'])
+    errors = []
+    with job.input_file.open('rb') as fh:
+        csv_fh = TextIOWrapper(fh, encoding='utf-8', newline='')
+        num_created = batch.create_tasks_from_csv(
+            csv_fh, progress=job.update_progress, errors=errors)
+        csv_fh.detach()
+    job.progress = num_created
+    message = 'Created {} Tasks for Batch {}'.format(num_created, batch.name)
+    if errors:
+        message += '. Skipped {} rows of the CSV file: {}'.format(
+            len(errors), '; '.join('line %i: %s' % error for error in errors[:10]))
+    return message
+
+
+@job_type('create_review_batch')
+def create_review_batch(job):
+    batch = Batch.objects.get(id=job.parameters['batch_id'])
+    job.update_progress(0, total=batch.total_finished_task_assignments())
+    review_batch = batch.create_review_batch(created_by=job.created_by,
+                                             progress=job.update_progress)
+    job.progress = review_batch.task_count
+    return 'Created review Batch {} with {} Tasks'.format(review_batch.name,
+                                                          review_batch.task_count)
+
+
+@job_type('export_batch')
+def export_batch(job):
+    batch = Batch.objects.get(id=job.parameters['batch_id'])
+    job.update_progress(0, total=batch.total_finished_task_assignments())
+    results_format = job.parameters.get('results_format', 'csv')
+    if results_format == 'csv':
+        lineterminator = job.parameters.get('lineterminator', '\r\n')
+        _save_result(job, batch.csv_results_filename(), _csv_writer(
+            lambda csv_fh: batch.to_csv(csv_fh, lineterminator=lineterminator,
+                                        progress=job.update_progress)))
+    else:
+        fieldnames, records = exports.batch_results(batch)
+        records = _report_progress(job, records)
+        _save_result(job, exports.results_filename(batch.csv_results_filename(), results_format),
+                     lambda fh: exports.write_results(fh, results_format, fieldnames, records))
+    return 'Exported results for Batch {}'.format(batch.name)
+
+
+@job_type('export_project_results')
+def export_project_results(job):
+    project = Project.objects.get(id=job.parameters['project_id'])
+    if not project.batch_set.filter(name__endswith='_review').exists():
+        raise ValueError('Cannot find reviewed Batch')
+    results_format = job.parameters.get('results_format', 'csv')
+    filename = project.name + '_final_results.csv'
+    if results_format == 'csv':
+        _save_result(job, filename, _csv_writer(
+            lambda csv_fh: project.reviewed_results_to_csv(csv_fh,
+                                                           progress=job.update_progress)))
+    else:
+        fieldnames, records = exports.project_reviewed_results(project)
+        records = _report_progress(job, records)
+        _save_result(job, exports.results_filename(filename, results_format),
+                     lambda fh: exports.write_results(fh, results_format, fieldnames, records))
+    return 'Exported reviewed results for Project {}'.format(project.name)
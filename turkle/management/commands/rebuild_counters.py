@@ -0,0 +1,34 @@
+from datetime import datetime
+import logging
+
+from django.core.management.base import BaseCommand
+
+from turkle.models import ActivityRollup, Batch, DailyActivity, StatisticsSnapshot, Task
+
+
+class Command(BaseCommand):
+    help = 'Recompute the denormalized counters, activity rollups and statistics ' \
+           'snapshots maintained when Task Assignments are written'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, dest='batch_id',
+                            help='Only rebuild counters for the Batch with this ID')
+
+    def handle(self, *args, **options):
+        t0 = datetime.now()
+        batches = Batch.objects.all()
+        tasks = Task.objects.all()
+        if options['batch_id']:
+            batches = batches.filter(id=options['batch_id'])
+            tasks = tasks.filter(batch_id=options['batch_id'])
+        total_tasks = Task.rebuild_assignment_counts(tasks)
+        total_batches = Batch.rebuild_task_counts(batches)
+        Batch.rebuild_fieldnames(batches)
+        ActivityRollup.rebuild(batches if options['batch_id'] else None)
+        DailyActivity.rebuild(batches if options['batch_id'] else None)
+        StatisticsSnapshot.rebuild(batches if options['batch_id'] else None)
+        t = datetime.now()
+        dt = (t - t0).total_seconds()
+        logging.basicConfig(format="%(asctime)-15s %(message)s", level=logging.INFO)
+        logging.info('TURKLE: Rebuilt counters for {0} Tasks and {1} Batches in {2:.3f} seconds'.
+                     format(total_tasks, total_batches, dt))
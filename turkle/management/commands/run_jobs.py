@@ -0,0 +1,72 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import logging
+import multiprocessing
+import time
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from turkle.jobs import run_job, run_job_by_id
+from turkle.models import Job
+
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs, and delete old finished jobs and their files'
+
+    # Seconds between deletions of old finished Jobs
+    PURGE_INTERVAL = 3600
+    last_purge = None
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1,
+                            help='Number of Jobs run in parallel by a pool of worker processes')
+        parser.add_argument('--poll-interval', type=float, default=5.0,
+                            help='Seconds to wait between checks for queued Jobs')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit when no Jobs are queued instead of waiting for more')
+
+    def handle(self, *args, **options):
+        logging.basicConfig(format="%(asctime)-15s %(message)s", level=logging.INFO)
+        if options['processes'] > 1:
+            self._run_pool(options['processes'], options['poll_interval'], options['once'])
+        else:
+            self._run_inline(options['poll_interval'], options['once'])
+
+    def _purge_finished_jobs(self):
+        if self.last_purge is None or time.monotonic() - self.last_purge >= self.PURGE_INTERVAL:
+            Job.purge_finished()
+            self.last_purge = time.monotonic()
+
+    def _run_inline(self, poll_interval, once):
+        while True:
+            self._purge_finished_jobs()
+            job = Job.claim_next()
+            if job:
+                run_job(job)
+            elif once:
+                return
+            else:
+                time.sleep(poll_interval)
+
+    def _run_pool(self, processes, poll_interval, once):
+        # Worker processes are spawned rather than forked, so that they
+        # do not share this process's database connections
+        connections.close_all()
+        pool = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=django.setup)
+        with pool:
+            running = set()
+            while True:
+                self._purge_finished_jobs()
+                while len(running) < processes:
+                    job = Job.claim_next()
+                    if not job:
+                        break
+                    running.add(pool.submit(run_job_by_id, job.id))
+                if not running:
+                    if once:
+                        return
+                    time.sleep(poll_interval)
+                    continue
+                _, running = wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
@@ -2,12 +2,14 @@
 
 from django.db import migrations, models
 
-from turkle.models import Batch
-
 
 def update_existing_batches(apps, schema_editor):
+    # Use the historical model, since the current Batch model may have
+    # fields that have not been added to the database yet
+    Batch = apps.get_model('turkle', 'Batch')
     for batch in Batch.objects.all():
-        batch.update_completed_status()
+        batch.completed = not batch.task_set.filter(completed=False).exists()
+        batch.save()
 
 
 class Migration(migrations.Migration):
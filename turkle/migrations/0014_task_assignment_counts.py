@@ -0,0 +1,47 @@
+# Generated by Django 3.2.25 on 2026-10-18 04:28
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_task_assignments(apps, schema_editor):
+    Task = apps.get_model('turkle', 'Task')
+    TaskAssignment = apps.get_model('turkle', 'TaskAssignment')
+
+    def count_subquery(assignments):
+        return Coalesce(Subquery(
+            assignments
+            .filter(task=OuterRef('pk'))
+            .order_by().values('task').annotate(count=Count('pk')).values('count'),
+            output_field=IntegerField()), 0)
+
+    Task.objects.update(
+        assignment_count=count_subquery(TaskAssignment.objects.all()),
+        completed_assignment_count=count_subquery(TaskAssignment.objects.filter(completed=True)),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turkle', '0013_activeproject_activeuser'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='assignment_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='completed_assignment_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['batch', 'completed', 'assignment_count'], name='turkle_task_batch_i_77e720_idx'),
+        ),
+        migrations.RunPython(count_task_assignments, migrations.RunPython.noop),
+    ]
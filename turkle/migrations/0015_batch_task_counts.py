@@ -0,0 +1,43 @@
+# Generated by Django 3.2.25 on 2026-10-18 04:30
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_batch_tasks(apps, schema_editor):
+    Batch = apps.get_model('turkle', 'Batch')
+    Task = apps.get_model('turkle', 'Task')
+
+    def count_subquery(tasks):
+        return Coalesce(Subquery(
+            tasks
+            .filter(batch=OuterRef('pk'))
+            .order_by().values('batch').annotate(count=Count('pk')).values('count'),
+            output_field=IntegerField()), 0)
+
+    Batch.objects.update(
+        task_count=count_subquery(Task.objects.all()),
+        completed_task_count=count_subquery(Task.objects.filter(completed=True)),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turkle', '0014_task_assignment_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='batch',
+            name='completed_task_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='batch',
+            name='task_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_batch_tasks, migrations.RunPython.noop),
+    ]
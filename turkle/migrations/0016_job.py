@@ -0,0 +1,44 @@
+# Generated by Django 3.2.25 on 2026-10-18 04:44
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('turkle', '0015_batch_task_counts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_type', models.CharField(max_length=64)),
+                ('parameters', jsonfield.fields.JSONField(blank=True, default=dict)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='queued', max_length=16)),
+                ('progress', models.IntegerField(default=0)),
+                ('total', models.IntegerField(blank=True, null=True)),
+                ('message', models.TextField(blank=True)),
+                ('input_file', models.FileField(blank=True, upload_to='turkle/jobs/input/')),
+                ('result_file', models.FileField(blank=True, upload_to='turkle/jobs/results/')),
+                ('result_filename', models.CharField(blank=True, max_length=1024)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Job',
+                'ordering': ['-id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['status', 'id'], name='turkle_job_status_a1d3be_idx'),
+        ),
+    ]
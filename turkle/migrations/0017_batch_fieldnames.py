@@ -0,0 +1,47 @@
+# Generated by Django 3.2.25 on 2026-10-18 04:50
+
+from django.db import migrations
+import jsonfield.fields
+
+
+def collect_batch_fieldnames(apps, schema_editor):
+    Batch = apps.get_model('turkle', 'Batch')
+    Task = apps.get_model('turkle', 'Task')
+    TaskAssignment = apps.get_model('turkle', 'TaskAssignment')
+
+    for batch_id in Batch.objects.values_list('id', flat=True):
+        input_fieldnames = set()
+        for fields in Task.objects.filter(batch_id=batch_id). \
+                values_list('input_csv_fields', flat=True).iterator():
+            if isinstance(fields, dict):
+                input_fieldnames.update(fields.keys())
+        answer_fieldnames = set()
+        for answers in TaskAssignment.objects.filter(task__batch_id=batch_id). \
+                filter(completed=True).values_list('answers', flat=True).iterator():
+            if isinstance(answers, dict):
+                answer_fieldnames.update(answers.keys())
+        Batch.objects.filter(id=batch_id).update(
+            input_fieldnames=sorted(input_fieldnames),
+            answer_fieldnames=sorted(answer_fieldnames),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turkle', '0016_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='batch',
+            name='answer_fieldnames',
+            field=jsonfield.fields.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='batch',
+            name='input_fieldnames',
+            field=jsonfield.fields.JSONField(blank=True, default=list),
+        ),
+        migrations.RunPython(collect_batch_fieldnames, migrations.RunPython.noop),
+    ]
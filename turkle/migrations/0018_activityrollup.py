@@ -0,0 +1,56 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:17
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import TruncMinute
+import django.db.models.deletion
+
+
+def collect_activity_rollups(apps, schema_editor):
+    ActivityRollup = apps.get_model('turkle', 'ActivityRollup')
+    TaskAssignment = apps.get_model('turkle', 'TaskAssignment')
+
+    rows = TaskAssignment.objects.filter(completed=True). \
+        annotate(bucket=TruncMinute('updated_at')). \
+        values('task__batch_id', 'assigned_to_id', 'bucket'). \
+        annotate(completed=Count('id')). \
+        order_by()
+    ActivityRollup.objects.bulk_create(
+        (ActivityRollup(batch_id=row['task__batch_id'], user_id=row['assigned_to_id'],
+                        bucket=row['bucket'], completed=row['completed'])
+         for row in rows.iterator()),
+        batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('turkle', '0017_batch_fieldnames'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivityRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField()),
+                ('completed', models.IntegerField(default=0)),
+                ('batch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='turkle.batch')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Activity Rollup',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='activityrollup',
+            index=models.Index(fields=['batch', 'bucket'], name='turkle_acti_batch_i_542718_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='activityrollup',
+            index=models.Index(fields=['user', 'bucket'], name='turkle_acti_user_id_9e9476_idx'),
+        ),
+        migrations.RunPython(collect_activity_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:22
+
+from collections import defaultdict
+import math
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+
+# Copy of the turkle.sketches constants when this migration was written
+RELATIVE_ACCURACY = 0.01
+MIN_VALUE = 0.001
+LOG_GAMMA = math.log((1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY))
+
+
+def collect_statistics_snapshots(apps, schema_editor):
+    StatisticsSnapshot = apps.get_model('turkle', 'StatisticsSnapshot')
+    TaskAssignment = apps.get_model('turkle', 'TaskAssignment')
+
+    snapshots = {}
+    bins = defaultdict(lambda: defaultdict(int))
+    rows = TaskAssignment.objects.filter(completed=True). \
+        values_list('task__batch_id', 'assigned_to_id', 'created_at', 'updated_at'). \
+        order_by()
+    for batch_id, user_id, created_at, updated_at in rows.iterator():
+        if (batch_id, user_id) not in snapshots:
+            snapshots[(batch_id, user_id)] = StatisticsSnapshot(
+                batch_id=batch_id, user_id=user_id,
+                work_time_sketch={'bins': {}, 'zero_count': 0})
+        snapshot = snapshots[(batch_id, user_id)]
+        work_time = (updated_at - created_at).total_seconds()
+        if work_time <= MIN_VALUE:
+            snapshot.work_time_sketch['zero_count'] += 1
+        else:
+            bins[(batch_id, user_id)][int(math.ceil(math.log(work_time) / LOG_GAMMA))] += 1
+        snapshot.completed += 1
+        snapshot.total_work_time += work_time
+        if snapshot.first_finished_at is None or updated_at < snapshot.first_finished_at:
+            snapshot.first_finished_at = updated_at
+        if snapshot.last_finished_at is None or updated_at > snapshot.last_finished_at:
+            snapshot.last_finished_at = updated_at
+    for key, snapshot in snapshots.items():
+        snapshot.work_time_sketch['bins'] = {
+            str(i): count for i, count in sorted(bins[key].items())}
+    StatisticsSnapshot.objects.bulk_create(snapshots.values(), batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('turkle', '0018_activityrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatisticsSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('completed', models.IntegerField(default=0)),
+                ('total_work_time', models.FloatField(default=0)),
+                ('work_time_sketch', jsonfield.fields.JSONField(blank=True, default=dict)),
+                ('first_finished_at', models.DateTimeField(null=True)),
+                ('last_finished_at', models.DateTimeField(null=True)),
+                ('batch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='turkle.batch')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Statistics Snapshot',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='statisticssnapshot',
+            index=models.Index(fields=['batch', 'user'], name='turkle_stat_batch_i_5cef28_idx'),
+        ),
+        migrations.RunPython(collect_statistics_snapshots, migrations.RunPython.noop),
+    ]
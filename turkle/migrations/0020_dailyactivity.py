@@ -0,0 +1,59 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:29
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max
+from django.db.models.functions import TruncDate
+import django.db.models.deletion
+
+
+def collect_daily_activity(apps, schema_editor):
+    DailyActivity = apps.get_model('turkle', 'DailyActivity')
+    TaskAssignment = apps.get_model('turkle', 'TaskAssignment')
+
+    rows = TaskAssignment.objects.filter(completed=True). \
+        annotate(day=TruncDate('updated_at')). \
+        values('task__batch_id', 'assigned_to_id', 'day'). \
+        annotate(completed=Count('id'), last_finished_at=Max('updated_at')). \
+        order_by()
+    DailyActivity.objects.bulk_create(
+        (DailyActivity(batch_id=row['task__batch_id'], user_id=row['assigned_to_id'],
+                       day=row['day'], completed=row['completed'],
+                       last_finished_at=row['last_finished_at'])
+         for row in rows.iterator()),
+        batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('turkle', '0019_statisticssnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyActivity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('completed', models.IntegerField(default=0)),
+                ('last_finished_at', models.DateTimeField(null=True)),
+                ('batch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='turkle.batch')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Daily Activity',
+                'verbose_name_plural': 'Daily Activity',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='dailyactivity',
+            index=models.Index(fields=['batch', 'day'], name='turkle_dail_batch_i_93ec30_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dailyactivity',
+            index=models.Index(fields=['user', 'day'], name='turkle_dail_user_id_387c47_idx'),
+        ),
+        migrations.RunPython(collect_daily_activity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:58
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def set_heartbeat_at(apps, schema_editor):
+    Job = apps.get_model('turkle', 'Job')
+    Job.objects.filter(status='running').update(heartbeat_at=F('started_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turkle', '0020_dailyactivity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(set_heartbeat_at, migrations.RunPython.noop),
+    ]
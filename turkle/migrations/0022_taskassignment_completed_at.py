@@ -0,0 +1,26 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:15
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def set_completed_at(apps, schema_editor):
+    TaskAssignment = apps.get_model('turkle', 'TaskAssignment')
+    # updated_at is the best record of when existing assignments were completed
+    TaskAssignment.objects.filter(completed=True).update(completed_at=F('updated_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('turkle', '0021_job_heartbeat_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='taskassignment',
+            name='completed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(set_completed_at, migrations.RunPython.noop),
+    ]
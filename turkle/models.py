@@ -1,32 +1,56 @@
+from collections import defaultdict
 import csv
 import ctypes
-from datetime import timedelta
+from datetime import datetime, time, timedelta
+from itertools import islice
 import logging
 import os.path
 import re
-import statistics
 import sys
 
-import pandas as pd
 from bs4 import BeautifulSoup
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models import Count, IntegerField, Max, Q, OuterRef, Prefetch, Subquery
-from django.db.models.functions import Coalesce
+from django.db import DEFAULT_DB_ALIAS, connection, connections, models, transaction
+from django.db.models import (Avg, Case, Count, DurationField, Exists, ExpressionWrapper, F,
+                              IntegerField, Max, Q, OuterRef, Subquery, Sum, Value, When)
+from django.db.models.functions import Cast, Coalesce, Trunc, TruncDate, TruncMinute
 from django.utils import timezone
 from guardian.core import ObjectPermissionChecker
-from guardian.models import GroupObjectPermission
-from guardian.shortcuts import assign_perm, get_group_perms, get_groups_with_perms
+from guardian.utils import get_anonymous_user
+from guardian.models import GroupObjectPermission, UserObjectPermission
+from guardian.shortcuts import (assign_perm, get_group_perms, get_groups_with_perms,
+                                get_users_with_perms)
 from jsonfield import JSONField
 
-from .utils import get_turkle_template_limit
+from .caching import invalidate_available_task_counts, invalidate_batch_lists
+from .sketches import QuantileSketch
+from .utils import (get_job_heartbeat_timeout, get_job_retention_days, get_turkle_cache,
+                    get_turkle_cache_timeout, get_turkle_task_chunk_size,
+                    get_turkle_template_limit)
 
 User = get_user_model()
 
 logger = logging.getLogger(__name__)
 
+# Number of candidate Tasks fetched per query when claiming the next available Task
+TASK_DISPATCH_WINDOW = 20
+
+# Number of Task Assignments fetched per query when exporting results
+RESULTS_CHUNK_SIZE = 2000
+
+# Time between accepting and submitting a Task Assignment
+WORK_TIME = ExpressionWrapper(F('updated_at') - F('created_at'), output_field=DurationField())
+
+# Template variables such as ${foo} in Project HTML templates
+TEMPLATE_VARIABLE_RE = re.compile(r'\${(\w+)}')
+
+# Compiled Project HTML templates, mapping Project IDs to tuples of
+# (updated_at, segments)
+_compiled_templates = {}
+
 C_LONG_NUM_BITS = 8 * ctypes.sizeof(ctypes.c_long)
 C_LONG_MAX = 2 ** (C_LONG_NUM_BITS - 1) - 1
 
@@ -36,6 +60,15 @@ C_LONG_MAX = 2 ** (C_LONG_NUM_BITS - 1) - 1
 csv.field_size_limit(min(C_LONG_MAX, sys.maxsize))
 
 
+class Echo:
+    """File-like object that returns what is written to it
+
+    Used with csv writers to generate CSV output one line at a time.
+    """
+    def write(self, value):
+        return value
+
+
 def process_quote(s: str) -> str:
     res = s
     if s.startswith('\'') :
@@ -47,23 +80,21 @@ def process_quote(s: str) -> str:
 
 
 class ActiveUserManager(models.Manager):
-    """Query users by activity on assignments"""
+    """Query users by activity on assignments
+
+    Activity is read from the DailyActivity rollups, so the period
+    covers whole days: the last `n_days` days, including today.
+    """
 
     def get_queryset(self, **kwargs):
         # adds annotations for number of assignments and most recent assignment time
         n_days = int(kwargs.get('n_days', 7))
-        time_cutoff = timezone.now() - timedelta(days=n_days)
-        active_users = super().get_queryset(). \
-            filter(Q(taskassignment__updated_at__gt=time_cutoff) &
-                   Q(taskassignment__completed=True)). \
-            distinct(). \
-            annotate(
-            total_assignments=Count('taskassignment',
-                                    filter=(Q(taskassignment__updated_at__gt=time_cutoff) &
-                                            Q(taskassignment__completed=True)))). \
-            annotate(last_finished_time=Max('taskassignment__updated_at',
-                                            filter=Q(taskassignment__completed=True)))
-        return active_users
+        day_cutoff = timezone.localdate() - timedelta(days=n_days)
+        return super().get_queryset(). \
+            filter(dailyactivity__day__gt=day_cutoff). \
+            annotate(total_assignments=Sum('dailyactivity__completed'),
+                     last_finished_time=Max('dailyactivity__last_finished_at')). \
+            filter(total_assignments__gt=0)
 
 
 class ActiveUser(User):
@@ -93,11 +124,31 @@ class ActiveUser(User):
     most_recent.admin_order_field = 'last_finished_time'
 
 
+class MaintainedFieldsMixin(object):
+    """Mixin class for models with denormalized fields that are updated with queries
+
+    Assumes that the inheriting class has a `maintained_fields` tuple
+    naming the fields, such as counters updated with F() expressions.
+    Since an instance's copy of these fields may be stale, saving an
+    existing instance does not write them unless they are explicitly
+    listed in `update_fields`.
+    """
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in self.maintained_fields]
+        super().save(*args, **kwargs)
+
+
 class TaskAssignmentStatistics(object):
     """Mixin class for Batch/Project that computes TaskAssignment statistics
 
     Assumes that the inheriting class has a finished_task_assignments()
-    method that returns a QuerySet of TaskAssignments.
+    method that returns a QuerySet of TaskAssignments, and a
+    statistics_snapshots() method that returns a QuerySet of
+    StatisticsSnapshots.
     """
 
     def mean_work_time_in_seconds(self):
@@ -105,46 +156,146 @@ class TaskAssignmentStatistics(object):
         Returns:
             Float for mean work time (in seconds) for completed Tasks in this Batch
         """
-        finished_assignments = self.finished_task_assignments()
-        if finished_assignments.count() > 0:
-            return statistics.mean(
-                [ta.work_time_in_seconds() for ta in self.finished_task_assignments()])
-        else:
-            return 0
+        return self.work_time_statistics()['mean']
 
     def median_work_time_in_seconds(self):
         """
         Returns:
-            Integer for median work time (in seconds) for completed Tasks in this Batch
+            Integer for median work time (in seconds) for completed Tasks in this Batch,
+            estimated from the work time sketches in the StatisticsSnapshots
         """
-        if self.finished_task_assignments().count() > 0:
-            # np.median returns float but we convert back to int computed by work_time_in_seconds()
-            return int(statistics.median(
-                [ta.work_time_in_seconds() for ta in self.finished_task_assignments()]
-            ))
-        else:
-            return 0
+        return self.work_time_percentiles_in_seconds((50,))[50]
+
+    def work_time_percentiles_in_seconds(self, percentiles=(50, 90, 99)):
+        """Estimate work time percentiles from the StatisticsSnapshots
+
+        The estimates are within 1% of the true percentiles, and are
+        computed without reading the TaskAssignment table.
+
+        Args:
+            percentiles (tuple): Percentiles between 0 and 100
+
+        Returns:
+            Dict mapping each percentile to an integer work time in
+            seconds, which is 0 if no TaskAssignments have been completed
+        """
+        snapshot = StatisticsSnapshot.merge(self.statistics_snapshots())
+        return {p: int(round(snapshot.work_time_quantile(p / 100))) for p in percentiles}
 
     def total_work_time_in_seconds(self):
         """
         Returns:
-            Integer sum of work_time_in_seconds() for all completed
+            Integer sum of work times (in seconds) for all completed
             TaskAssignments in this Batch
         """
-        return sum([ta.work_time_in_seconds() for ta in self.finished_task_assignments()])
+        return self.work_time_statistics()['total']
+
+    def work_time_statistics(self):
+        """Compute work time statistics for completed TaskAssignments
 
+        The count, total and mean are computed with one aggregate query.
+        Use median_work_time_in_seconds() or
+        work_time_percentiles_in_seconds() for the median, which are
+        estimated without sorting the work times.
 
-class Task(models.Model):
+        Returns:
+            Dict with keys 'count' (number of completed TaskAssignments),
+            'total' (int seconds) and 'mean' (float seconds).  The times
+            are 0 if no TaskAssignments have been completed.
+        """
+        totals = self.finished_task_assignments().order_by().aggregate(
+            count=Count('id'), total=Sum(WORK_TIME), mean=Avg(WORK_TIME))
+        if not totals['count']:
+            return {'count': 0, 'total': 0, 'mean': 0}
+        return {
+            'count': totals['count'],
+            'total': int(totals['total'].total_seconds()),
+            'mean': totals['mean'].total_seconds(),
+        }
+
+
+class Task(MaintainedFieldsMixin, models.Model):
     """Human Intelligence Task
     """
 
     class Meta:
         verbose_name = "Task"
+        indexes = [
+            models.Index(fields=['batch', 'completed', 'assignment_count']),
+        ]
 
     batch = models.ForeignKey('Batch', on_delete=models.CASCADE)
     completed = models.BooleanField(default=False)
     input_csv_fields = JSONField()
 
+    # Denormalized counts of this Task's TaskAssignments, maintained by
+    # TaskAssignment.save() and TaskAssignment.decrement_counts().  Because
+    # these fields are updated with F() expressions, a Task instance may
+    # hold stale values.
+    assignment_count = models.IntegerField(default=0)
+    completed_assignment_count = models.IntegerField(default=0)
+
+    maintained_fields = ('assignment_count', 'completed_assignment_count')
+
+    @classmethod
+    def rebuild_assignment_counts(cls, task_queryset=None):
+        """Recompute the denormalized TaskAssignment counts from the TaskAssignment table
+
+        Args:
+            task_queryset (QuerySet): Tasks to update.  Defaults to all Tasks.
+
+        Returns:
+            Number of Tasks updated
+        """
+        if task_queryset is None:
+            task_queryset = cls.objects.all()
+
+        def count_subquery(assignments):
+            return Coalesce(Subquery(
+                assignments
+                .filter(task=OuterRef('pk'))
+                .order_by().values('task').annotate(count=Count('pk')).values('count'),
+                output_field=IntegerField()), 0)
+
+        total_tasks = task_queryset.update(
+            assignment_count=count_subquery(TaskAssignment.objects.all()),
+            completed_assignment_count=count_subquery(
+                TaskAssignment.objects.filter(completed=True)),
+        )
+        invalidate_available_task_counts(task_queryset.values_list('batch_id', flat=True))
+        return total_tasks
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored completed status, so that save() can maintain Batch counters
+        instance._completed_in_db = instance.completed
+        return instance
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            Batch.increment_task_counts(
+                self.batch_id, tasks=-1,
+                completed_tasks=-int(getattr(self, '_completed_in_db', self.completed)))
+        return result
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        completed_delta = int(self.completed) - int(getattr(self, '_completed_in_db', False))
+        if adding or completed_delta:
+            with transaction.atomic():
+                super().save(*args, **kwargs)
+                Batch.increment_task_counts(
+                    self.batch_id, tasks=int(adding), completed_tasks=completed_delta)
+                # If the input_csv_fields JSONField is empty, it evaluates as a string
+                if adding and isinstance(self.input_csv_fields, dict):
+                    Batch.add_fieldnames(self.batch_id,
+                                         input_fieldnames=self.input_csv_fields.keys())
+        else:
+            super().save(*args, **kwargs)
+        self._completed_in_db = self.completed
+
     def __str__(self):
         return 'Task id:{}'.format(self.id)
 
@@ -156,13 +307,30 @@ class Task(models.Model):
             this Task, with all template variables replaced with the template
             variable values stored in this Task's input_csv_fields.
         """
-        result = self.batch.project.html_template
-        for field in self.input_csv_fields.keys():
-            result = result.replace(
-                r'${' + field + r'}',
-                self.input_csv_fields[field]
-            )
-        return result
+        segments = self.batch.project.compiled_html_template()
+        parts = list(segments)
+        # Odd numbered segments are template variable names
+        for i in range(1, len(parts), 2):
+            if parts[i] in self.input_csv_fields:
+                parts[i] = self.input_csv_fields[parts[i]]
+            else:
+                parts[i] = '${' + parts[i] + '}'
+        return ''.join(parts)
+
+
+class TaskAssignmentQuerySet(models.QuerySet):
+    def delete(self):
+        """Delete the Task Assignments and update the counters of their Tasks
+
+        Task Assignments deleted by cascading from a Task, Batch or
+        Project are deleted without updating any counters, since the
+        Tasks are deleted too.  Those deleted by cascading from a User
+        are handled by the User pre_delete signal handler in
+        turkle.signals.
+        """
+        with transaction.atomic():
+            TaskAssignment.decrement_counts(self)
+            return super().delete()
 
 
 class TaskAssignment(models.Model):
@@ -172,6 +340,8 @@ class TaskAssignment(models.Model):
     class Meta:
         verbose_name = "Task Assignment"
 
+    objects = TaskAssignmentQuerySet.as_manager()
+
     answers = JSONField(blank=True)
     assigned_to = models.ForeignKey(settings.AUTH_USER_MODEL, db_index=True, null=True,
                                     on_delete=models.CASCADE)
@@ -180,16 +350,75 @@ class TaskAssignment(models.Model):
     expires_at = models.DateTimeField(null=True)
     task = models.ForeignKey(Task, on_delete=models.CASCADE)
     updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    # Time the assignment was completed.  Unlike updated_at, it does not
+    # change when a completed assignment is saved again, so the activity
+    # rollups and statistics snapshots are added to and subtracted from
+    # with the same time.
+    completed_at = models.DateTimeField(null=True, blank=True)
 
     @classmethod
     def expire_all_abandoned(cls):
-        result = cls.objects. \
-            filter(completed=False). \
-            filter(expires_at__lt=timezone.now()). \
-            delete()
+        with transaction.atomic():
+            expired = cls.objects. \
+                filter(completed=False). \
+                filter(expires_at__lt=timezone.now())
+            # Lock the expired assignments so none of them can be completed
+            # before they are deleted and their Tasks' counters are decremented
+            list(expired.select_for_update().values_list('id', flat=True))
+            result = expired.delete()
         logger.info('Expired %i task assignments', result[0])
         return result
 
+    @classmethod
+    def decrement_counts(cls, task_assignment_queryset, activity=True):
+        """Subtract Task Assignments that are about to be deleted from the maintained counts
+
+        The Task counters are updated with one UPDATE for each distinct
+        number of deleted Task Assignments per Task, which is usually
+        just one UPDATE.
+
+        Args:
+            task_assignment_queryset (QuerySet): Task Assignments to be deleted
+            activity (bool): Also subtract the completed Task Assignments
+                from the activity rollups and statistics snapshots.  False
+                when those are deleted along with the User.
+        """
+        counts = task_assignment_queryset.order_by(). \
+            values('task_id', 'task__batch_id'). \
+            annotate(assignments=Count('id'),
+                     completed_assignments=Count('id', filter=Q(completed=True)))
+        task_ids = defaultdict(list)
+        batch_ids = set()
+        total_completed = 0
+        for row in counts:
+            task_ids[(row['assignments'], row['completed_assignments'])].append(row['task_id'])
+            batch_ids.add(row['task__batch_id'])
+            total_completed += row['completed_assignments']
+        for (assignments, completed_assignments), ids in task_ids.items():
+            Task.objects.filter(id__in=ids).update(
+                assignment_count=F('assignment_count') - assignments,
+                completed_assignment_count=F('completed_assignment_count') -
+                completed_assignments,
+            )
+        if activity and total_completed:
+            completed = task_assignment_queryset.filter(completed=True).order_by(). \
+                values_list('task__batch_id', 'assigned_to_id', 'created_at', 'completed_at')
+            for batch_id, user_id, created_at, completed_at in completed:
+                cls._record_activity(batch_id, user_id, created_at, completed_at, delta=-1)
+        invalidate_available_task_counts(batch_ids)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored completed status, so that save() can maintain Task counters
+        instance._completed_in_db = instance.completed
+        return instance
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            TaskAssignment.decrement_counts(TaskAssignment.objects.filter(id=self.id))
+            return super().delete(*args, **kwargs)
+
     def save(self, *args, **kwargs):
         # set expires_at only when assignment is created
         if not self.id:
@@ -198,16 +427,72 @@ class TaskAssignment(models.Model):
 
         if 'csrfmiddlewaretoken' in self.answers:
             del self.answers['csrfmiddlewaretoken']
-        super().save(*args, **kwargs)
 
-        # Mark Task as completed if all Assignments have been completed
-        if self.task.taskassignment_set.filter(completed=True).count() >= \
-                self.task.batch.assignments_per_task:
-            self.task.completed = True
-            self.task.save()
+        adding = self._state.adding
+        completed_delta = int(self.completed) - int(getattr(self, '_completed_in_db', False))
+        uncompleted_at = None
+        if completed_delta > 0 and self.completed_at is None:
+            self.completed_at = timezone.now()
+        elif completed_delta < 0:
+            uncompleted_at, self.completed_at = self.completed_at, None
+        if adding or completed_delta:
+            with transaction.atomic():
+                super().save(*args, **kwargs)
+                Task.objects.filter(id=self.task_id).update(
+                    assignment_count=F('assignment_count') + int(adding),
+                    completed_assignment_count=F('completed_assignment_count') + completed_delta,
+                )
+                # Completion only propagates when the assignment goes from incomplete to complete
+                if completed_delta > 0:
+                    self._propagate_completion()
+                    if isinstance(self.answers, dict):
+                        Batch.add_fieldnames(self.task.batch_id,
+                                             answer_fieldnames=self.answers.keys())
+                    self._record_activity(self.task.batch_id, self.assigned_to_id,
+                                          self.created_at, self.completed_at)
+                elif completed_delta < 0 and uncompleted_at is not None:
+                    self._record_activity(self.task.batch_id, self.assigned_to_id,
+                                          self.created_at, uncompleted_at, delta=-1)
+            invalidate_available_task_counts([self.task.batch_id])
+        else:
+            super().save(*args, **kwargs)
+        self._completed_in_db = self.completed
+
+    @staticmethod
+    def _record_activity(batch_id, user_id, created_at, completed_at, delta=1):
+        # Adds a completed assignment to, or with a negative delta removes
+        # it from, the activity rollups and statistics snapshots
+        ActivityRollup.record(batch_id, user_id, completed_at, delta=delta)
+        DailyActivity.record(batch_id, user_id, completed_at, delta=delta)
+        StatisticsSnapshot.record(batch_id, user_id,
+                                  (completed_at - created_at).total_seconds(),
+                                  completed_at, delta=delta)
+
+    @classmethod
+    def work_time_totals(cls, task_assignment_queryset, fields):
+        """Count Task Assignments and total their work time, grouped by fields
+
+        The totals are computed with one grouped aggregate query.
+
+        Args:
+            task_assignment_queryset (QuerySet): Completed Task Assignments
+            fields (list): Names of the fields to group by, as accepted by
+                QuerySet.values()
 
-        # Mark Batch as completed if all Tasks have been completed
-        self.task.batch.update_completed_status()
+        Returns:
+            List of dicts, one for each group, with the `fields` keys plus
+            'total_completed' (number of Task Assignments) and
+            'elapsed_seconds' (total work time in seconds, int)
+        """
+        rows = task_assignment_queryset.order_by().values(*fields).annotate(
+            total_completed=Count('id'),
+            work_time=Sum(WORK_TIME))
+        totals = []
+        for row in rows:
+            work_time = row.pop('work_time')
+            row['elapsed_seconds'] = int(work_time.total_seconds()) if work_time else 0
+            totals.append(row)
+        return totals
 
     def work_time_in_seconds(self):
         """Return number of seconds elapsed between Task assignment and submission
@@ -231,8 +516,25 @@ class TaskAssignment(models.Model):
                 'Cannot compute work_time_in_seconds for incomplete TaskAssignment %d' %
                 self.id)
 
+    def _propagate_completion(self):
+        """Mark the Task, and then the Batch, as completed if all their work is done
 
-class Batch(TaskAssignmentStatistics, models.Model):
+        Both steps are conditional UPDATEs on the maintained counters, so
+        neither the Task's TaskAssignments nor the Batch's Tasks are re-counted.
+        """
+        batch = self.task.batch
+        task_completed = Task.objects. \
+            filter(id=self.task_id). \
+            filter(completed=False). \
+            filter(completed_assignment_count__gte=batch.assignments_per_task). \
+            update(completed=True)
+        if task_completed:
+            self.task.completed = True
+            self.task._completed_in_db = True
+            Batch.increment_task_counts(batch.id, completed_tasks=1)
+
+
+class Batch(MaintainedFieldsMixin, TaskAssignmentStatistics, models.Model):
     class Meta:
         permissions = (
             ('can_work_on_batch', 'Can work on Tasks for this Batch'),
@@ -255,28 +557,96 @@ class Batch(TaskAssignmentStatistics, models.Model):
     project = models.ForeignKey('Project', on_delete=models.CASCADE)
     published = models.BooleanField(db_index=True, default=True)
 
+    # Denormalized counts of this Batch's Tasks, maintained by Task.save(),
+    # Task.delete() and TaskAssignment.save().  The `completed` flag is
+    # derived from these counters.
+    task_count = models.IntegerField(default=0)
+    completed_task_count = models.IntegerField(default=0)
+
+    # Sorted lists of the keys of the Tasks' input_csv_fields and of the
+    # completed TaskAssignments' answers, used as the header of results
+    # CSV files.  Maintained by add_fieldnames().
+    input_fieldnames = JSONField(blank=True, default=list)
+    answer_fieldnames = JSONField(blank=True, default=list)
+
+    maintained_fields = ('task_count', 'completed_task_count',
+                         'input_fieldnames', 'answer_fieldnames')
+
     @classmethod
     def access_permitted_for(cls, user):
         """Retrieve the active Batches that the user has permission to access
 
         Both the Batch and the Project associated the Batch must be active.
 
+        The rules implemented by TurklePermissionChecker are expressed as
+        subqueries against django-guardian's object permission tables, so
+        the Batches are retrieved with a single SQL query.
+
         Args:
             user (User):
 
         Returns:
-            List of Batch objects this user can access
+            QuerySet of Batch objects this user can access
         """
         batches = cls.objects.filter(active=True).filter(published=True) \
             .filter(project__active=True)
         if not user.is_authenticated:
             batches = batches.filter(login_required=False)
+            # django-guardian assigns permissions for anonymous users
+            # to a special User object
+            user = get_anonymous_user()
+
+        if not user.is_active:
+            return batches.none()
+        if user.is_superuser:
+            return batches
+
+        content_type = ContentType.objects.get_for_model(cls)
+        batch_perms = {
+            'content_type': content_type,
+            'object_pk': Cast(OuterRef('pk'), models.CharField()),
+            'permission__codename': 'can_work_on_batch',
+            'permission__content_type': content_type,
+        }
+        user_perms = UserObjectPermission.objects.filter(user=user, **batch_perms)
+        group_perms = GroupObjectPermission.objects.filter(group__user=user, **batch_perms)
+        return batches.filter(
+            Exists(user_perms) | Exists(group_perms) | Q(custom_permissions=False))
+
+    @classmethod
+    def add_fieldnames(cls, batch_id, input_fieldnames=(), answer_fieldnames=()):
+        """Add input and answer fieldnames to a Batch's results CSV header
+
+        The fieldnames are first checked with a plain read, so the Batch
+        row is only locked, and written, when a fieldname is new.
+
+        Args:
+            batch_id (int):
+            input_fieldnames (iterable): Keys of a Task's input_csv_fields
+            answer_fieldnames (iterable): Keys of a TaskAssignment's answers
+        """
+        input_fieldnames = set(input_fieldnames)
+        answer_fieldnames = set(answer_fieldnames)
+        if not input_fieldnames and not answer_fieldnames:
+            return
 
-        # Can implement our own prefetch_perms() in future for efficiency
-        checker = TurklePermissionChecker(user)
-        checker.prefetch_perms(batches)
+        def has_new_fieldnames(batch):
+            return not (input_fieldnames.issubset(batch.input_fieldnames) and
+                        answer_fieldnames.issubset(batch.answer_fieldnames))
 
-        return [b for b in batches if checker.has_perm('can_work_on_batch', b)]
+        batches = cls.objects.only('input_fieldnames', 'answer_fieldnames')
+        if not has_new_fieldnames(batches.get(id=batch_id)):
+            return
+        with transaction.atomic():
+            # Check again with the row locked, in case a concurrent request
+            # added the same fieldnames
+            batch = batches.select_for_update().get(id=batch_id)
+            if not has_new_fieldnames(batch):
+                return
+            cls.objects.filter(id=batch_id).update(
+                input_fieldnames=sorted(input_fieldnames.union(batch.input_fieldnames)),
+                answer_fieldnames=sorted(answer_fieldnames.union(batch.answer_fieldnames)),
+            )
 
     @classmethod
     def available_task_counts_for(cls, batch_query, user):
@@ -306,7 +676,7 @@ class Batch(TaskAssignmentStatistics, models.Model):
         # For this case, the number of available tasks is the same for all users with
         # access to the batch.
         oneway_batch_query = batch_query.filter(assignments_per_task=1).filter(completed=False)
-        unassigned_tasks = Task.objects.filter(completed=False).filter(taskassignment=None)
+        unassigned_tasks = Task.objects.filter(completed=False).filter(assignment_count=0)
 
         # Django does not easily support aggregations (such as Count) using subqueries:
         #   https://code.djangoproject.com/ticket/28296
@@ -338,14 +708,8 @@ class Batch(TaskAssignmentStatistics, models.Model):
             .filter(completed=False)
         if user.is_authenticated:
             # Count number of tasks available for case where Batch.assignments_per_task > 1
-            ta_count_subquery = Subquery(
-                TaskAssignment.objects
-                .filter(task=OuterRef('pk'))
-                .order_by().values('task').annotate(count=Count('pk')).values('count'),
-                output_field=IntegerField())
             unassigned_tasks = Task.objects.filter(completed=False) \
-                .annotate(ac=Coalesce(ta_count_subquery, 0)) \
-                .filter(ac__lt=OuterRef('assignments_per_task')) \
+                .filter(assignment_count__lt=OuterRef('assignments_per_task')) \
                 .exclude(taskassignment__assigned_to=user)
             task_count_subquery = Subquery(
                 unassigned_tasks
@@ -366,6 +730,89 @@ class Batch(TaskAssignmentStatistics, models.Model):
 
         return available_task_counts
 
+    @classmethod
+    def increment_task_counts(cls, batch_id, tasks=0, completed_tasks=0):
+        """Atomically update the Task counters of a Batch and its `completed` flag
+
+        Args:
+            batch_id (int):
+            tasks (int): Change in the number of Tasks
+            completed_tasks (int): Change in the number of completed Tasks
+        """
+        # `completed` is computed from the old counters plus the changes,
+        # and is assigned first because MySQL evaluates the assignments
+        # of an UPDATE left to right against the new values
+        cls.objects.filter(id=batch_id).update(
+            completed=Case(
+                When(completed_task_count__gte=F('task_count') + (tasks - completed_tasks),
+                     then=Value(True)),
+                default=Value(False)),
+            task_count=F('task_count') + tasks,
+            completed_task_count=F('completed_task_count') + completed_tasks,
+        )
+        invalidate_available_task_counts([batch_id])
+
+    @classmethod
+    def rebuild_fieldnames(cls, batch_queryset=None):
+        """Recompute the results CSV header fieldnames from the Task and TaskAssignment tables
+
+        Args:
+            batch_queryset (QuerySet): Batches to update.  Defaults to all Batches.
+
+        Returns:
+            Number of Batches updated
+        """
+        if batch_queryset is None:
+            batch_queryset = cls.objects.all()
+
+        total_batches = 0
+        for batch_id in batch_queryset.values_list('id', flat=True):
+            input_fieldnames = set()
+            for fields in Task.objects.filter(batch_id=batch_id). \
+                    values_list('input_csv_fields', flat=True).iterator():
+                if isinstance(fields, dict):
+                    input_fieldnames.update(fields.keys())
+            answer_fieldnames = set()
+            for answers in TaskAssignment.objects.filter(task__batch_id=batch_id). \
+                    filter(completed=True). \
+                    values_list('answers', flat=True).iterator():
+                # If the answers JSONField is empty, it evaluates as a string instead of a dict
+                if isinstance(answers, dict):
+                    answer_fieldnames.update(answers.keys())
+            total_batches += cls.objects.filter(id=batch_id).update(
+                input_fieldnames=sorted(input_fieldnames),
+                answer_fieldnames=sorted(answer_fieldnames),
+            )
+        return total_batches
+
+    @classmethod
+    def rebuild_task_counts(cls, batch_queryset=None):
+        """Recompute the denormalized Task counts and `completed` flags from the Task table
+
+        Args:
+            batch_queryset (QuerySet): Batches to update.  Defaults to all Batches.
+
+        Returns:
+            Number of Batches updated
+        """
+        if batch_queryset is None:
+            batch_queryset = cls.objects.all()
+
+        def count_subquery(tasks):
+            return Coalesce(Subquery(
+                tasks
+                .filter(batch=OuterRef('pk'))
+                .order_by().values('batch').annotate(count=Count('pk')).values('count'),
+                output_field=IntegerField()), 0)
+
+        total_batches = batch_queryset.update(
+            task_count=count_subquery(Task.objects.all()),
+            completed_task_count=count_subquery(Task.objects.filter(completed=True)),
+        )
+        cls._update_completed_flags(batch_queryset)
+        invalidate_available_task_counts(batch_queryset.values_list('id', flat=True))
+        return total_batches
+
     def assignments_completed_by(self, user):
         """
         Returns:
@@ -416,11 +863,10 @@ class Batch(TaskAssignmentStatistics, models.Model):
                 hs = hs.exclude(taskassignment__assigned_to_id=user.id)
 
             # Only include Tasks when # of (possibly incomplete) assignments < assignments_per_task
-            hs = hs.annotate(ac=models.Count('taskassignment')). \
-                filter(ac__lt=self.assignments_per_task)
+            hs = hs.filter(assignment_count__lt=self.assignments_per_task)
         elif self.assignments_per_task == 1:
             # Only returns Tasks that have not been assigned to anyone (including this user)
-            hs = hs.filter(taskassignment=None)
+            hs = hs.filter(assignment_count=0)
 
         return hs
 
@@ -455,27 +901,130 @@ class Batch(TaskAssignmentStatistics, models.Model):
         # We are following Mechanical Turk's naming conventions for results files
         return "{}-Batch_{}_results{}".format(batch_filename, self.id, extension)
 
-    def create_tasks_from_csv(self, csv_fh):
+    def create_review_batch(self, created_by=None, chunk_size=None, progress=None):
+        """Create and publish a Batch for reviewing the results of this Batch
+
+        The review Batch belongs to the same Project and is named after
+        this Batch with a '_review' suffix.  It has one Task for each
+        completed Task Assignment of this Batch, whose input fields are
+        the columns from _iter_review_rows().  This Batch's access
+        permissions are copied to the review Batch.
+
+        Tasks are inserted with bulk_create() in chunks of `chunk_size`
+        rows inside a single transaction.
+
+        Args:
+            created_by (User): Creator of the review Batch
+            chunk_size (int): Number of Tasks per INSERT.  Defaults to
+                the TURKLE_TASK_CHUNK_SIZE setting.
+            progress (callable): Called with the number of Tasks created
+                so far after each chunk is inserted
+
+        Returns:
+            The review Batch
         """
+        if chunk_size is None:
+            chunk_size = get_turkle_task_chunk_size()
+        header, rows = self._iter_review_rows()
+
+        with transaction.atomic():
+            review_batch = Batch.objects.create(
+                active=True,
+                assignments_per_task=self.assignments_per_task,
+                created_by=created_by,
+                custom_permissions=self.custom_permissions,
+                filename=self.name + '_review.csv',
+                login_required=True,
+                name=self.name + '_review',
+                project_id=self.project_id,
+                published=False,
+            )
+            logger.info('Creating review Batch(%i) for Batch(%i) %s',
+                        review_batch.id, self.id, self.name)
+            if self.custom_permissions:
+                for group in get_groups_with_perms(self):
+                    if 'can_work_on_batch' in get_group_perms(group, self):
+                        assign_perm('can_work_on_batch', group, review_batch)
+                for user in get_users_with_perms(self, with_group_users=False,
+                                                 only_with_perms_in=['can_work_on_batch']):
+                    assign_perm('can_work_on_batch', user, review_batch)
+
+            Batch.add_fieldnames(review_batch.id, input_fieldnames=header)
+            num_created_tasks = 0
+            for chunk in iter(lambda: list(islice(rows, chunk_size)), []):
+                Task.objects.bulk_create(
+                    [Task(batch=review_batch, input_csv_fields=row) for row in chunk])
+                Batch.increment_task_counts(review_batch.id, tasks=len(chunk))
+                num_created_tasks += len(chunk)
+                if progress:
+                    progress(num_created_tasks)
+
+            review_batch.published = True
+            review_batch.save(update_fields=['published'])
+        review_batch.refresh_from_db(fields=review_batch.maintained_fields)
+        logger.info('Created %i tasks for review Batch(%i) %s',
+                    num_created_tasks, review_batch.id, review_batch.name)
+        return review_batch
+
+    def create_tasks_from_csv(self, csv_fh, chunk_size=None, progress=None, errors=None):
+        """Create a Task for each row of a CSV file
+
+        Tasks are inserted with bulk_create() in chunks of `chunk_size`
+        rows inside a single transaction, so either every valid row is
+        added to the Batch or none are.
+
+        Rows with a different number of fields than the header are
+        skipped.  Blank rows are ignored.
+
         Args:
             csv_fh (file-like object): File handle for CSV input
+            chunk_size (int): Number of Tasks per INSERT.  Defaults to
+                the TURKLE_TASK_CHUNK_SIZE setting.
+            progress (callable): Called with the number of Tasks created
+                so far after each chunk is inserted
+            errors (list): If provided, a (line number, error message)
+                tuple is appended for each skipped row
 
         Returns:
             Number of Tasks created from CSV file
         """
+        if chunk_size is None:
+            chunk_size = get_turkle_task_chunk_size()
         header, data_rows = self._parse_csv(csv_fh)
 
         logger.info('Creating tasks for Batch(%i) %s', self.id, self.name)
         num_created_tasks = 0
-        for row in data_rows:
-            if not row:
-                continue
-            task = Task(
-                batch=self,
-                input_csv_fields=dict(zip(header, row)),
-            )
-            task.save()
-            num_created_tasks += 1
+
+        def insert_chunk(tasks):
+            Task.objects.bulk_create(tasks)
+            Batch.increment_task_counts(self.id, tasks=len(tasks))
+            if progress:
+                progress(num_created_tasks)
+
+        with transaction.atomic():
+            Batch.add_fieldnames(self.id, input_fieldnames=header)
+            tasks = []
+            for row in data_rows:
+                if not row:
+                    continue
+                if len(row) != len(header):
+                    message = 'Row has {} fields, but the header has {} fields'.format(
+                        len(row), len(header))
+                    logger.warning('Skipping line %i of CSV file for Batch(%i): %s',
+                                   data_rows.line_num, self.id, message)
+                    if errors is not None:
+                        errors.append((data_rows.line_num, message))
+                    continue
+                tasks.append(Task(
+                    batch=self,
+                    input_csv_fields=dict(zip(header, row)),
+                ))
+                num_created_tasks += 1
+                if len(tasks) >= chunk_size:
+                    insert_chunk(tasks)
+                    tasks = []
+            if tasks:
+                insert_chunk(tasks)
         logger.info('Created %i tasks for Batch(%i) %s', num_created_tasks, self.id, self.name)
 
         return num_created_tasks
@@ -497,12 +1046,69 @@ class Batch(TaskAssignmentStatistics, models.Model):
         return TaskAssignment.objects.filter(task__batch_id=self.id) \
             .filter(completed=True)
 
+    def statistics_snapshots(self):
+        """
+        Returns:
+            QuerySet of the StatisticsSnapshots for this Batch
+        """
+        return StatisticsSnapshot.objects.filter(batch_id=self.id)
+
     def is_active(self):
         return self.active and self.published
 
     is_active.short_description = 'Active'
     is_active.boolean = True
 
+    def lock_first_task_id(self, task_ids):
+        """Lock and return the first Task ID from a QuerySet of available Task IDs
+
+        Must be called inside a transaction.  Instead of locking every
+        available Task in the Batch, candidate Tasks are locked one row
+        at a time.  On databases that support SKIP LOCKED, Tasks that are
+        locked by a concurrent transaction are passed over instead of
+        waited on.  Databases without row-level locking (SQLite) get the
+        database write lock by issuing a no-op UPDATE on the candidate
+        row, which serializes concurrent claims.
+
+        A locked Task is re-checked against ``task_ids`` because a
+        concurrent transaction may have claimed it before the lock
+        was acquired.  A skipped Task may still be available when the
+        transaction that locked it commits or rolls back, so if no other
+        Task can be locked, the skipped Tasks are locked by waiting.
+
+        Args:
+            task_ids (QuerySet): Task IDs available to a user, as returned
+                by available_task_ids_for()
+
+        Returns:
+            Task ID (int), or None if no Task could be locked
+        """
+        skip_locked = connection.features.has_select_for_update_skip_locked
+        tried_ids = []
+        skipped_ids = []
+        while True:
+            candidate_ids = list(
+                task_ids.exclude(id__in=tried_ids).order_by('id')[:TASK_DISPATCH_WINDOW])
+            if not candidate_ids:
+                break
+            for task_id in candidate_ids:
+                candidate = Task.objects.filter(id=task_id, completed=False)
+                if connection.features.has_select_for_update:
+                    # len() forces execution of query to create lock
+                    locked = len(candidate.select_for_update(skip_locked=skip_locked)) == 1
+                else:
+                    locked = candidate.update(completed=False) == 1
+                if locked and task_ids.filter(id=task_id).exists():
+                    return task_id
+                if skip_locked and not locked:
+                    skipped_ids.append(task_id)
+            tried_ids.extend(candidate_ids)
+        for task_id in skipped_ids:
+            candidate = Task.objects.filter(id=task_id, completed=False)
+            if len(candidate.select_for_update()) == 1 and task_ids.filter(id=task_id).exists():
+                return task_id
+        return None
+
     def next_available_task_for(self, user):
         """Returns next available Task for the user, or None if no Tasks available
 
@@ -559,32 +1165,56 @@ class Batch(TaskAssignmentStatistics, models.Model):
         """
         return self.users_that_completed_tasks().count()
 
-    def to_csv(self, csv_fh, lineterminator='\r\n'):
+    def iter_csv(self, lineterminator='\r\n', since=None, until=None):
+        """Generate CSV output for every Task in batch, one line at a time
+
+        Task Assignments are read from the database in chunks, so the
+        results for a Batch are never held in memory all at once.
+
+        Args:
+            since (datetime): Only include Task Assignments completed after this time
+            until (datetime): Only include Task Assignments completed at or before this time
+
+        Returns:
+            Iterator of strings, each containing one line of CSV output
+        """
+        fieldnames = self._get_csv_fieldnames()
+        writer = csv.DictWriter(Echo(), fieldnames, lineterminator=lineterminator,
+                                quoting=csv.QUOTE_ALL)
+        yield writer.writerow(dict(zip(fieldnames, fieldnames)))
+        for row in self._iter_results_rows(self.task_set.all(), since=since, until=until):
+            yield writer.writerow(row)
+
+    def to_csv(self, csv_fh, lineterminator='\r\n', progress=None):
         """Write CSV output to file handle for every Task in batch
 
         Args:
             csv_fh (file-like object): File handle for CSV output
+            progress (callable): Called with the number of Task Assignments
+                written, after each RESULTS_CHUNK_SIZE Task Assignments and
+                at the end
         """
-        fieldnames, rows = self._results_data(self.task_set.all())
-        writer = csv.DictWriter(csv_fh, fieldnames, lineterminator=lineterminator,
-                                quoting=csv.QUOTE_ALL)
-        writer.writeheader()
-        for row in rows:
-            writer.writerow(row)
+        lines = self.iter_csv(lineterminator=lineterminator)
+        csv_fh.write(next(lines))
+        num_written = 0
+        for num_written, line in enumerate(lines, 1):
+            csv_fh.write(line)
+            if progress and num_written % RESULTS_CHUNK_SIZE == 0:
+                progress(num_written)
+        if progress:
+            progress(num_written)
 
     def to_csv_without_quoting(self, csv_fh, lineterminator='\r\n'):
-        fieldnames, rows = self._results_data(self.task_set.all())
-        res_dict = {}
-        for fieldname in fieldnames:
-            if fieldname == 'Input.isUnderReview':
-                res_dict['isUnderReview'] = ['true' for _ in rows]
-            elif fieldname.startswith('Input') or fieldname.startswith('Answer'):
-                index = fieldname[fieldname.index('.') + 1:]
-                res_dict[index] = [process_quote(row[fieldname]) for row in rows]
-            elif fieldname == 'Turkle.Username':
-                res_dict['Annotator'] = [process_quote(row[fieldname]) for row in rows]
-        pd.DataFrame(res_dict).to_csv(csv_fh, index=False, quoting=csv.QUOTE_ALL)
-        return None
+        """Write the input CSV file of a review Batch for this Batch to file handle
+
+        Args:
+            csv_fh (file-like object): File handle for CSV output
+        """
+        header, rows = self._iter_review_rows()
+        writer = csv.DictWriter(csv_fh, header, lineterminator=lineterminator,
+                                quoting=csv.QUOTE_ALL)
+        writer.writeheader()
+        writer.writerows(rows)
 
     def to_input_csv(self, csv_fh, lineterminator='\r\n'):
         """Write (reconstructed) CSV input to file handle for every Task in Batch
@@ -635,7 +1265,7 @@ class Batch(TaskAssignmentStatistics, models.Model):
         completed_status = not self.unfinished_tasks().exists()
         if self.completed != completed_status:
             self.completed = completed_status
-            self.save()
+            self.save(update_fields=['completed'])
 
     def users_that_completed_tasks(self):
         """
@@ -663,39 +1293,140 @@ class Batch(TaskAssignmentStatistics, models.Model):
         header = next(rows)
         return header, rows
 
-    def _get_csv_fieldnames(self, task_queryset):
+    def _get_csv_fieldnames(self):
         """
-        Args:
-            task_queryset (QuerySet):
-
         Returns:
             A tuple of strings specifying the fieldnames to be used in
             in the header of a CSV file.
         """
-        input_field_set = set()
-        answer_field_set = set()
-        task_assignments = TaskAssignment.objects. \
-            filter(task__in=task_queryset). \
-            prefetch_related(Prefetch('task', queryset=task_queryset))
-        for task_assignment in task_assignments:
-            input_field_set.update(task_assignment.task.input_csv_fields.keys())
-
-            # If the answers JSONField is empty, it evaluates as a string instead of a dict
-            if task_assignment.answers != '':
-                answer_field_set.update(task_assignment.answers.keys())
+        # The fieldnames are maintained with queries, so this instance's copy may be stale
+        self.refresh_from_db(fields=['input_fieldnames', 'answer_fieldnames'])
+        if not self.input_fieldnames and self.task_set.exists():
+            # Tasks were added without maintaining the fieldnames, for
+            # example by loading a fixture
+            Batch.rebuild_fieldnames(Batch.objects.filter(id=self.id))
+            self.refresh_from_db(fields=['input_fieldnames', 'answer_fieldnames'])
         return tuple(
             ['HITId', 'HITTypeId', 'Title', 'CreationTime', 'MaxAssignments',
              'AssignmentDurationInSeconds', 'AssignmentId', 'WorkerId',
              'AcceptTime', 'SubmitTime', 'WorkTimeInSeconds'] +
-            ['Input.' + k for k in sorted(input_field_set)] +
-            ['Answer.' + k for k in sorted(answer_field_set)] +
+            ['Input.' + k for k in self.input_fieldnames] +
+            ['Answer.' + k for k in self.answer_fieldnames] +
             ['Turkle.Username']
         )
 
+    def _iter_results_records(self, task_queryset, since=None, until=None):
+        """
+        All completed Tasks must come from this Batch.
+
+        The Task Assignments, their Tasks and usernames are read with a
+        single joined query, and the values that are the same for every
+        record are only computed once.
+
+        Args:
+            task_queryset (QuerySet):
+            since (datetime): Only include Task Assignments completed after this time
+            until (datetime): Only include Task Assignments completed at or before this time
+
+        Returns:
+            Iterator of dicts, one for each completed Task Assignment,
+            where the keys are the fieldnames from _get_csv_fieldnames().
+            Times are datetimes and IDs are integers.
+        """
+        project = Project.objects.only('id', 'name').get(id=self.project_id)
+        batch_values = {
+            'HITTypeId': project.id,
+            'Title': project.name,
+            'CreationTime': self.created_at,
+            'MaxAssignments': self.assignments_per_task,
+            'AssignmentDurationInSeconds': self.allotted_assignment_time * 3600,
+        }
+        task_assignments = TaskAssignment.objects. \
+            filter(task__in=task_queryset). \
+            filter(completed=True)
+        # A completed Task Assignment is last updated when it is submitted
+        if since is not None:
+            task_assignments = task_assignments.filter(updated_at__gt=since)
+        if until is not None:
+            task_assignments = task_assignments.filter(updated_at__lte=until)
+        task_assignments = task_assignments. \
+            values('id', 'task_id', 'task__input_csv_fields', 'answers', 'assigned_to_id',
+                   'assigned_to__username', 'created_at', 'updated_at'). \
+            iterator(chunk_size=RESULTS_CHUNK_SIZE)
+        for task_assignment in task_assignments:
+            record = dict(batch_values)
+            record.update({
+                'HITId': task_assignment['task_id'],
+                'AssignmentId': task_assignment['id'],
+                'WorkerId': task_assignment['assigned_to_id'],
+                'AcceptTime': task_assignment['created_at'],
+                'SubmitTime': task_assignment['updated_at'],
+                'WorkTimeInSeconds': int((task_assignment['updated_at'] -
+                                          task_assignment['created_at']).total_seconds()),
+                'Turkle.Username': task_assignment['assigned_to__username'] or '',
+            })
+            record.update({'Input.' + k: v
+                           for k, v in task_assignment['task__input_csv_fields'].items()})
+            record.update({'Answer.' + k: v for k, v in task_assignment['answers'].items()})
+            yield record
+
+    def _iter_review_rows(self):
+        """
+        Input and answer fields keep their names without the 'Input.' and
+        'Answer.' prefixes, with answers replacing inputs of the same name.
+        The username is stored in an 'Annotator' field, and an
+        'isUnderReview' input is set to 'true'.
+
+        Returns:
+            A tuple where the first value is a list of the input fieldnames
+            of the review Batch, and the second value is an iterator of
+            dicts with the input fields of each review Task, one for each
+            completed Task Assignment of this Batch
+        """
+        # Maps review Batch fieldnames to results fieldnames
+        columns = {}
+        for fieldname in self._get_csv_fieldnames():
+            if fieldname == 'Input.isUnderReview':
+                columns['isUnderReview'] = None
+            elif fieldname.startswith('Input') or fieldname.startswith('Answer'):
+                columns[fieldname[fieldname.index('.') + 1:]] = fieldname
+            elif fieldname == 'Turkle.Username':
+                columns['Annotator'] = fieldname
+
+        def review_value(record, fieldname):
+            if fieldname is None:
+                return 'true'
+            value = record.get(fieldname)
+            return '' if value is None else process_quote(str(value))
+
+        def review_rows():
+            for record in self._iter_results_records(self.task_set.all()):
+                yield {column: review_value(record, fieldname)
+                       for column, fieldname in columns.items()}
+        return list(columns), review_rows()
+
+    def _iter_results_rows(self, task_queryset, since=None, until=None):
+        """
+        Args:
+            task_queryset (QuerySet):
+            since (datetime): See _iter_results_records()
+            until (datetime): See _iter_results_records()
+
+        Returns:
+            Iterator of the dicts from _iter_results_records(), with
+            times formatted for CSV output
+        """
+        time_format = '%a %b %d %H:%M:%S %Z %Y'
+        creation_time = self.created_at.strftime(time_format)
+        for record in self._iter_results_records(task_queryset, since=since, until=until):
+            record['CreationTime'] = creation_time
+            record['AcceptTime'] = record['AcceptTime'].strftime(time_format)
+            record['SubmitTime'] = record['SubmitTime'].strftime(time_format)
+            yield record
+
     def _results_data(self, task_queryset):
         """
-        All completed Tasks must come from the same project so that they have the
-        same field names.
+        All completed Tasks must come from this Batch.
 
         Args:
             task_queryset (QuerySet):
@@ -705,41 +1436,15 @@ class Batch(TaskAssignmentStatistics, models.Model):
             the second value is a list of dicts, where the keys to these
             dicts are the values of the fieldname strings.
         """
-        rows = []
-        time_format = '%a %b %d %H:%M:%S %Z %Y'
-        task_assignments = TaskAssignment.objects. \
-            filter(task__in=task_queryset). \
-            filter(completed=True). \
-            prefetch_related(Prefetch('task', queryset=task_queryset))
-        for task_assignment in task_assignments:
-            task = task_assignment.task
-            batch = task.batch
-            project = task.batch.project
+        rows = list(self._iter_results_rows(task_queryset))
+        return self._get_csv_fieldnames(), rows
 
-            if task_assignment.assigned_to:
-                username = task_assignment.assigned_to.username
-            else:
-                username = ''
-
-            row = {
-                'HITId': task.id,
-                'HITTypeId': project.id,
-                'Title': project.name,
-                'CreationTime': batch.created_at.strftime(time_format),
-                'MaxAssignments': batch.assignments_per_task,
-                'AssignmentDurationInSeconds': batch.allotted_assignment_time * 3600,
-                'AssignmentId': task_assignment.id,
-                'WorkerId': task_assignment.assigned_to_id,
-                'AcceptTime': task_assignment.created_at.strftime(time_format),
-                'SubmitTime': task_assignment.updated_at.strftime(time_format),
-                'WorkTimeInSeconds': task_assignment.work_time_in_seconds(),
-                'Turkle.Username': username,
-            }
-            row.update({'Input.' + k: v for k, v in task.input_csv_fields.items()})
-            row.update({'Answer.' + k: v for k, v in task_assignment.answers.items()})
-            rows.append(row)
-
-        return self._get_csv_fieldnames(task_queryset), rows
+    @staticmethod
+    def _update_completed_flags(batch_queryset):
+        # A Batch is completed IFF all of its Tasks are completed
+        batch_queryset.update(completed=Case(
+            When(completed_task_count__gte=F('task_count'), then=Value(True)),
+            default=Value(False)))
 
     def __str__(self):
         return 'Batch: {}'.format(self.name)
@@ -855,6 +1560,7 @@ class Project(TaskAssignmentStatistics, models.Model):
                     batches = self.batch_set.all()
                     GroupObjectPermission.objects.bulk_assign_perm(
                         'can_work_on_batch', group, batches)
+        invalidate_batch_lists()
 
     def finished_task_assignments(self):
         """
@@ -865,12 +1571,36 @@ class Project(TaskAssignmentStatistics, models.Model):
         return TaskAssignment.objects.filter(task__batch__project_id=self.id) \
             .filter(completed=True)
 
+    def statistics_snapshots(self):
+        """
+        Returns:
+            QuerySet of the StatisticsSnapshots for the Batches in this Project
+        """
+        return StatisticsSnapshot.objects.filter(batch__project_id=self.id)
+
+    def compiled_html_template(self):
+        """Return the HTML template split into literal text and template variables
+
+        The template is compiled once per revision of the Project and
+        cached in memory, keyed by the Project's ID and `updated_at` time.
+
+        Returns:
+            Tuple of strings alternating between literal text and template
+            variable names, starting and ending with literal text
+        """
+        compiled = _compiled_templates.get(self.id)
+        if compiled is None or compiled[0] != self.updated_at:
+            compiled = (self.updated_at, tuple(TEMPLATE_VARIABLE_RE.split(self.html_template)))
+            if self.id is not None:
+                _compiled_templates[self.id] = compiled
+        return compiled[1]
+
     def process_template(self):
         soup = BeautifulSoup(self.html_template, 'html.parser')
         self.html_template_has_submit_button = bool(soup.select('input[type=submit]'))
 
         # Extract fieldnames from html_template text, save fieldnames as keys of JSON dict
-        unique_fieldnames = set(re.findall(r'\${(\w+)}', self.html_template))
+        unique_fieldnames = set(TEMPLATE_VARIABLE_RE.findall(self.html_template))
         self.fieldnames = dict((fn, True) for fn in unique_fieldnames)
 
         # Matching mTurk we confirm at least one input, select, or textarea
@@ -882,6 +1612,41 @@ class Project(TaskAssignmentStatistics, models.Model):
                   "If so, add an unused hidden input."
             raise ValidationError({'html_template': msg}, code='invalid')
 
+    def reviewed_results_to_csv(self, csv_fh, lineterminator='\r\n', progress=None):
+        """Write CSV output to file handle for every Task in this Project's review Batches
+
+        Review Batches are the Batches whose names end with '_review'.
+
+        Args:
+            csv_fh (file-like object): File handle for CSV output
+            progress (callable): Called with the number of rows read
+                after each review Batch is read, and with the number of
+                rows written after each RESULTS_CHUNK_SIZE rows
+
+        Returns:
+            False if the Project has no review Batches, True otherwise
+        """
+        fieldnames = None
+        res_rows = []
+        for batch in self.batch_set.order_by('name'):
+            if not batch.name.endswith('_review'):
+                continue
+            fieldnames, rows = batch._results_data(batch.task_set.all())
+            res_rows += rows
+            if progress:
+                progress(len(res_rows))
+        if fieldnames is None:
+            return False
+
+        writer = csv.DictWriter(csv_fh, fieldnames, lineterminator=lineterminator,
+                                quoting=csv.QUOTE_ALL)
+        writer.writeheader()
+        for num_written, row in enumerate(res_rows, 1):
+            writer.writerow(row)
+            if progress and num_written % RESULTS_CHUNK_SIZE == 0:
+                progress(num_written)
+        return True
+
     def total_assignments_completed_by(self, user):
         """
         Returns:
@@ -906,22 +1671,20 @@ class Project(TaskAssignmentStatistics, models.Model):
 
 
 class ActiveProjectManager(models.Manager):
-    """Query projects by activity on assignments"""
+    """Query projects by activity on assignments
+
+    Like ActiveUserManager, activity is read from the DailyActivity
+    rollups of the Project's Batches.
+    """
 
     def get_queryset(self, **kwargs):
         n_days = int(kwargs.get('n_days', 7))
-        time_cutoff = timezone.now() - timedelta(days=n_days)
+        day_cutoff = timezone.localdate() - timedelta(days=n_days)
         return super().get_queryset(). \
-            filter(Q(batch__task__taskassignment__updated_at__gt=time_cutoff) &
-                   Q(batch__task__taskassignment__completed=True)). \
-            distinct(). \
-            annotate(assignments=Count(
-            'batch__task__taskassignment',
-            filter=(Q(batch__task__taskassignment__updated_at__gt=time_cutoff) &
-                    Q(batch__task__taskassignment__completed=True)))). \
-            annotate(last_finished_time=Max(
-            'batch__task__taskassignment__updated_at',
-            filter=Q(batch__task__taskassignment__completed=True)))
+            filter(batch__dailyactivity__day__gt=day_cutoff). \
+            annotate(assignments=Sum('batch__dailyactivity__completed'),
+                     last_finished_time=Max('batch__dailyactivity__last_finished_at')). \
+            filter(assignments__gt=0)
 
 
 class ActiveProject(Project):
@@ -941,3 +1704,600 @@ class ActiveProject(Project):
         return self.last_finished_time
 
     most_recent.admin_order_field = 'last_finished_time'
+
+
+class Job(models.Model):
+    """Long-running operation that is executed by the `run_jobs` management command
+
+    Job types and the functions that implement them are registered in
+    the `turkle.jobs` module.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    )
+
+    class Meta:
+        verbose_name = "Job"
+        ordering = ['-id']
+        indexes = [
+            models.Index(fields=['status', 'id']),
+        ]
+
+    job_type = models.CharField(max_length=64)
+    parameters = JSONField(blank=True, default=dict)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED)
+    # Number of items processed so far, and the total number of items if known
+    progress = models.IntegerField(default=0)
+    total = models.IntegerField(null=True, blank=True)
+    message = models.TextField(blank=True)
+    input_file = models.FileField(upload_to='turkle/jobs/input/', blank=True)
+    result_file = models.FileField(upload_to='turkle/jobs/results/', blank=True)
+    # Filename used when the result file is downloaded
+    result_filename = models.CharField(max_length=1024, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True,
+                                   on_delete=models.SET_NULL)
+    started_at = models.DateTimeField(null=True, blank=True)
+    # Last time a running Job was claimed or reported progress
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def claim_next(cls):
+        """Mark the oldest queued Job as running and return it
+
+        The status of a Job is changed with a conditional UPDATE, so a
+        Job is only claimed by one of several concurrent workers.
+        Running Jobs whose workers have stopped are failed first.
+
+        Returns:
+            Job, or None if no Jobs are queued
+        """
+        cls.fail_stale()
+        while True:
+            job_id = cls.objects.filter(status=cls.QUEUED).order_by('id') \
+                .values_list('id', flat=True).first()
+            if job_id is None:
+                return None
+            now = timezone.now()
+            claimed = cls.objects.filter(id=job_id, status=cls.QUEUED) \
+                .update(status=cls.RUNNING, started_at=now, heartbeat_at=now)
+            if claimed:
+                return cls.objects.get(id=job_id)
+
+    @classmethod
+    def fail_stale(cls):
+        """Mark running Jobs that have not reported progress recently as failed
+
+        A Job stays running when its worker is killed, so Jobs that have
+        not reported progress for TURKLE_JOB_HEARTBEAT_TIMEOUT minutes
+        are failed.  They are not queued again, because a Job that ran
+        its worker out of memory would stop the next worker the same way.
+
+        Returns:
+            Number of Jobs marked as failed
+        """
+        cutoff = timezone.now() - timedelta(minutes=get_job_heartbeat_timeout())
+        stale = cls.objects.filter(status=cls.RUNNING, heartbeat_at__lt=cutoff)
+        failed = 0
+        for job in stale.only('id', 'input_file'):
+            # Another worker may fail the same Job, or the Job may report progress
+            if not stale.filter(id=job.id).update(
+                    status=cls.FAILED, finished_at=timezone.now(),
+                    message='The Job stopped reporting progress and was interrupted'):
+                continue
+            failed += 1
+            logger.warning('Job(%i) stopped reporting progress and was marked as failed', job.id)
+            if job.input_file:
+                job.input_file.delete(save=False)
+                cls.objects.filter(id=job.id).update(input_file='')
+        return failed
+
+    @classmethod
+    def purge_finished(cls):
+        """Delete the Jobs that finished more than TURKLE_JOB_RETENTION_DAYS days ago
+
+        The input and result files of the Jobs are deleted too.
+
+        Returns:
+            Number of Jobs deleted
+        """
+        cutoff = timezone.now() - timedelta(days=get_job_retention_days())
+        finished = cls.objects.filter(status__in=(cls.SUCCEEDED, cls.FAILED),
+                                      finished_at__lt=cutoff)
+        job_ids = []
+        for job in finished.only('id', 'input_file', 'result_file'):
+            for file in (job.input_file, job.result_file):
+                if file:
+                    file.delete(save=False)
+            job_ids.append(job.id)
+        cls.objects.filter(id__in=job_ids).delete()
+        if job_ids:
+            logger.info('Deleted %i finished Jobs', len(job_ids))
+        return len(job_ids)
+
+    def finish(self, status, message=''):
+        """Record the final status of this Job
+
+        The status is only changed from Job.RUNNING, so a Job that
+        fail_stale() has already failed stays failed, and its result
+        file is deleted.
+
+        Args:
+            status (str): Job.SUCCEEDED or Job.FAILED
+            message (str): Summary shown on the Job progress page
+
+        Returns:
+            True if the status was recorded
+        """
+        finished_at = timezone.now()
+        finished = Job.objects.filter(id=self.id, status=Job.RUNNING).update(
+            status=status, message=message, finished_at=finished_at,
+            progress=self.progress, total=self.total,
+            result_file=self.result_file.name or '', result_filename=self.result_filename)
+        if not finished:
+            if self.result_file:
+                self.result_file.delete(save=False)
+            return False
+        self.status = status
+        self.message = message
+        self.finished_at = finished_at
+        return True
+
+    def is_finished(self):
+        return self.status in (self.SUCCEEDED, self.FAILED)
+
+    def get_progress(self):
+        """Return the most recently reported progress of this Job
+
+        Returns:
+            Tuple of (progress, total), where total may be None
+        """
+        cached = get_turkle_cache().get(self._progress_cache_key())
+        if cached is not None and not self.is_finished():
+            return tuple(cached)
+        return self.progress, self.total
+
+    def update_progress(self, progress, total=None):
+        """Record the number of items processed so far
+
+        Job handlers often report progress from inside a transaction,
+        where database writes are not visible to other workers or the
+        status page until the transaction commits.  Inside a transaction,
+        the progress and heartbeat are therefore written with a separate
+        database connection, so that Job.fail_stale() in another worker
+        sees that the Job is still running.  SQLite does not allow a
+        second connection to write during a transaction, so there the
+        heartbeat is only visible once the transaction commits.
+
+        Progress is also stored in the Turkle cache, which must be shared
+        between the web server and worker processes for live progress to
+        be displayed.
+
+        Args:
+            progress (int): Number of items processed
+            total (int): Total number of items, if known
+        """
+        self.progress = progress
+        if total is not None:
+            self.total = total
+        get_turkle_cache().set(self._progress_cache_key(), (self.progress, self.total),
+                               get_turkle_cache_timeout() * 60)
+        self.heartbeat_at = timezone.now()
+        values = {'progress': self.progress, 'total': self.total,
+                  'heartbeat_at': self.heartbeat_at}
+        if connection.in_atomic_block and connection.vendor != 'sqlite':
+            self._update_outside_transaction(values)
+        else:
+            Job.objects.filter(id=self.id).update(**values)
+
+    def _update_outside_transaction(self, values):
+        # Writes the field values with a new autocommit connection, since
+        # the ORM would write them in the current transaction
+        autocommit_connection = connections.create_connection(DEFAULT_DB_ALIAS)
+        try:
+            quote_name = autocommit_connection.ops.quote_name
+            fields = [self._meta.get_field(name) for name in values]
+            sql = 'UPDATE {} SET {} WHERE {} = %s'.format(
+                quote_name(self._meta.db_table),
+                ', '.join('{} = %s'.format(quote_name(field.column)) for field in fields),
+                quote_name(self._meta.pk.column))
+            params = [field.get_db_prep_value(values[field.name], autocommit_connection)
+                      for field in fields]
+            with autocommit_connection.cursor() as cursor:
+                cursor.execute(sql, params + [self.id])
+        finally:
+            autocommit_connection.close()
+
+    def _progress_cache_key(self):
+        return 'turkle:job-progress:{}'.format(self.id)
+
+    def __str__(self):
+        return 'Job {}: {}'.format(self.id, self.job_type)
+
+
+class ActivityRollup(models.Model):
+    """Number of Task Assignments completed by a User in a Batch during one minute
+
+    Rollups are maintained by TaskAssignment.save() and
+    TaskAssignment.decrement_counts(), so that activity can be
+    reported without reading every Task Assignment.  Concurrent requests
+    may add more than one row for the same Batch, User and minute, so
+    the counts must be summed when they are read.
+    """
+    BUCKET_SIZES = ('minute', 'hour', 'day')
+
+    class Meta:
+        verbose_name = "Activity Rollup"
+        indexes = [
+            models.Index(fields=['batch', 'bucket']),
+            models.Index(fields=['user', 'bucket']),
+        ]
+
+    batch = models.ForeignKey(Batch, on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, on_delete=models.CASCADE)
+    # Start of the minute in which the Task Assignments were completed
+    bucket = models.DateTimeField()
+    completed = models.IntegerField(default=0)
+
+    @classmethod
+    def record(cls, batch_id, user_id, completed_at, delta=1):
+        """Add to the number of Task Assignments completed during a minute
+
+        Args:
+            batch_id (int):
+            user_id (int): None for anonymous Users
+            completed_at (datetime): Time the Task Assignment was completed
+            delta (int): Number of Task Assignments, negative for deletions
+        """
+        bucket = completed_at.replace(second=0, microsecond=0)
+        rollups = cls.objects.filter(batch_id=batch_id, user_id=user_id, bucket=bucket)
+        if not rollups.update(completed=F('completed') + delta) and delta > 0:
+            cls.objects.create(batch_id=batch_id, user_id=user_id, bucket=bucket,
+                               completed=delta)
+
+    @classmethod
+    def rebuild(cls, batch_queryset=None):
+        """Recompute the rollups from the TaskAssignment table
+
+        Args:
+            batch_queryset (QuerySet): Batches to update.  Defaults to all Batches.
+
+        Returns:
+            Number of rollups created
+        """
+        rollups = cls.objects.all()
+        task_assignments = TaskAssignment.objects.filter(completed=True)
+        if batch_queryset is not None:
+            rollups = rollups.filter(batch__in=batch_queryset)
+            task_assignments = task_assignments.filter(task__batch__in=batch_queryset)
+        rows = task_assignments. \
+            annotate(bucket=TruncMinute('completed_at')). \
+            values('task__batch_id', 'assigned_to_id', 'bucket'). \
+            annotate(completed=Count('id')). \
+            order_by(). \
+            iterator(chunk_size=RESULTS_CHUNK_SIZE)
+        new_rollups = (cls(batch_id=row['task__batch_id'], user_id=row['assigned_to_id'],
+                           bucket=row['bucket'], completed=row['completed']) for row in rows)
+        total_rollups = 0
+        with transaction.atomic():
+            rollups.delete()
+            for chunk in iter(lambda: list(islice(new_rollups, RESULTS_CHUNK_SIZE)), []):
+                cls.objects.bulk_create(chunk)
+                total_rollups += len(chunk)
+        return total_rollups
+
+    @classmethod
+    def timestamp_counts(cls, bucket_size='minute', start=None, end=None, **filters):
+        """Count the Task Assignments completed in each time bucket
+
+        Args:
+            bucket_size (str): One of BUCKET_SIZES.  Hours and days start
+                in the current time zone.
+            start (datetime): Only count Task Assignments completed at or after this time
+            end (datetime): Only count Task Assignments completed before this time
+            **filters: Lookups that select the rollups, such as `batch_id`,
+                `batch__project_id` or `user_id`
+
+        Returns:
+            Dict mapping the start of each bucket (as a Unix timestamp in
+            seconds) to the number of Task Assignments completed in it
+
+        Raises:
+            ValueError if the bucket size is not in BUCKET_SIZES
+        """
+        if bucket_size not in cls.BUCKET_SIZES:
+            raise ValueError('Unknown bucket size: {}'.format(bucket_size))
+        rollups = cls.objects.filter(**filters)
+        if start is not None:
+            rollups = rollups.filter(bucket__gte=start)
+        if end is not None:
+            rollups = rollups.filter(bucket__lt=end)
+        if bucket_size == 'minute':
+            rollups = rollups.annotate(time=F('bucket'))
+        else:
+            rollups = rollups.annotate(time=Trunc('bucket', bucket_size))
+        rows = rollups.values('time').annotate(count=Sum('completed')).order_by('time')
+        return {int(row['time'].timestamp()): row['count'] for row in rows if row['count']}
+
+
+class DailyActivity(models.Model):
+    """Number of Task Assignments completed by a User in a Batch during one day
+
+    Days start at midnight in the current time zone.  Like ActivityRollup,
+    daily activity is maintained by TaskAssignment.save() and
+    TaskAssignment.decrement_counts(), and concurrent requests
+    may add more than one row for the same Batch, User and day.
+    """
+
+    class Meta:
+        verbose_name = "Daily Activity"
+        verbose_name_plural = "Daily Activity"
+        indexes = [
+            models.Index(fields=['batch', 'day']),
+            models.Index(fields=['user', 'day']),
+        ]
+
+    batch = models.ForeignKey(Batch, on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, on_delete=models.CASCADE)
+    day = models.DateField()
+    completed = models.IntegerField(default=0)
+    last_finished_at = models.DateTimeField(null=True)
+
+    @classmethod
+    def record(cls, batch_id, user_id, finished_at, delta=1):
+        """Add to the number of Task Assignments completed during a day
+
+        The last finish time is not changed when Task Assignments are removed.
+
+        Args:
+            batch_id (int):
+            user_id (int): None for anonymous Users
+            finished_at (datetime): Time the Task Assignment was completed
+            delta (int): Number of Task Assignments, negative for deletions
+        """
+        day = timezone.localdate(finished_at)
+        updates = {'completed': F('completed') + delta}
+        if delta > 0:
+            updates['last_finished_at'] = Case(
+                When(Q(last_finished_at__isnull=True) | Q(last_finished_at__lt=finished_at),
+                     then=Value(finished_at)),
+                default=F('last_finished_at'),
+                output_field=models.DateTimeField())
+        rows = cls.objects.filter(batch_id=batch_id, user_id=user_id, day=day)
+        if not rows.update(**updates) and delta > 0:
+            cls.objects.create(batch_id=batch_id, user_id=user_id, day=day, completed=delta,
+                               last_finished_at=finished_at)
+
+    @classmethod
+    def rebuild(cls, batch_queryset=None):
+        """Recompute the daily activity from the TaskAssignment table
+
+        Args:
+            batch_queryset (QuerySet): Batches to update.  Defaults to all Batches.
+
+        Returns:
+            Number of rows created
+        """
+        activity = cls.objects.all()
+        task_assignments = TaskAssignment.objects.filter(completed=True)
+        if batch_queryset is not None:
+            activity = activity.filter(batch__in=batch_queryset)
+            task_assignments = task_assignments.filter(task__batch__in=batch_queryset)
+        rows = task_assignments. \
+            annotate(day=TruncDate('completed_at')). \
+            values('task__batch_id', 'assigned_to_id', 'day'). \
+            annotate(completed=Count('id'), last_finished_at=Max('completed_at')). \
+            order_by(). \
+            iterator(chunk_size=RESULTS_CHUNK_SIZE)
+        new_activity = (cls(batch_id=row['task__batch_id'], user_id=row['assigned_to_id'],
+                            day=row['day'], completed=row['completed'],
+                            last_finished_at=row['last_finished_at']) for row in rows)
+        total_rows = 0
+        with transaction.atomic():
+            activity.delete()
+            for chunk in iter(lambda: list(islice(new_activity, RESULTS_CHUNK_SIZE)), []):
+                cls.objects.bulk_create(chunk)
+                total_rows += len(chunk)
+        return total_rows
+
+    @classmethod
+    def trailing_counts(cls, days, now=None, **filters):
+        """Count the Task Assignments completed in trailing windows
+
+        Each window covers the given number of days before `now`.  The
+        whole days in a window are counted from DailyActivity, and the
+        part of the first day that is in the window is counted, to the
+        minute, from ActivityRollup.  The counts are read with two
+        aggregate queries, however many windows are requested.
+
+        Args:
+            days (iterable): Lengths of the windows, in days
+            now (datetime): End of the windows.  Defaults to the current time.
+            **filters: Lookups that select the rows of both tables, such
+                as `batch_id`, `batch__project_id` or `user_id`
+
+        Returns:
+            Dict mapping each number of days to the number of Task
+            Assignments completed in that window
+        """
+        now = now or timezone.now()
+        daily_sums = {}
+        partial_sums = {}
+        for n_days in days:
+            cutoff = now - timedelta(days=n_days)
+            cutoff_day = timezone.localdate(cutoff)
+            next_midnight = timezone.make_aware(
+                datetime.combine(cutoff_day + timedelta(days=1), time()))
+            daily_sums[str(n_days)] = Sum('completed', filter=Q(day__gt=cutoff_day))
+            partial_sums[str(n_days)] = Sum(
+                'completed', filter=Q(bucket__gte=cutoff, bucket__lt=next_midnight))
+        daily = cls.objects.filter(**filters).aggregate(**daily_sums)
+        partial = ActivityRollup.objects.filter(**filters).aggregate(**partial_sums)
+        return {n_days: (daily[str(n_days)] or 0) + (partial[str(n_days)] or 0)
+                for n_days in days}
+
+
+class StatisticsSnapshot(models.Model):
+    """Work time statistics for the Task Assignments completed by a User in a Batch
+
+    Snapshots are maintained by TaskAssignment.save() and
+    TaskAssignment.decrement_counts(), so that Batch, Project and
+    User statistics can be computed from a few rows instead of reading
+    every Task Assignment.  Work times are counted in a QuantileSketch, which
+    estimates the median and tail percentiles of the work times.
+
+    Concurrent requests may add more than one snapshot for the same
+    Batch and User, so snapshots should be combined with merge().
+    """
+
+    class Meta:
+        verbose_name = "Statistics Snapshot"
+        indexes = [
+            models.Index(fields=['batch', 'user']),
+        ]
+
+    batch = models.ForeignKey(Batch, on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, on_delete=models.CASCADE)
+    completed = models.IntegerField(default=0)
+    # Sum of work times, in seconds
+    total_work_time = models.FloatField(default=0)
+    # QuantileSketch of work times, in seconds
+    work_time_sketch = JSONField(blank=True, default=dict)
+    first_finished_at = models.DateTimeField(null=True)
+    last_finished_at = models.DateTimeField(null=True)
+
+    @classmethod
+    def record(cls, batch_id, user_id, work_time, finished_at, delta=1):
+        """Add a completed Task Assignment to the snapshot for a Batch and User
+
+        Args:
+            batch_id (int):
+            user_id (int): None for anonymous Users
+            work_time (float): Work time in seconds
+            finished_at (datetime): Time the Task Assignment was completed
+            delta (int): Number of Task Assignments, negative for deletions
+        """
+        with transaction.atomic():
+            snapshot = cls.objects.select_for_update().\
+                filter(batch_id=batch_id, user_id=user_id).first()
+            if snapshot is None:
+                if delta < 0:
+                    return
+                snapshot = cls(batch_id=batch_id, user_id=user_id)
+            snapshot.add(work_time, finished_at, delta)
+            snapshot.save()
+
+    @classmethod
+    def merge(cls, snapshots):
+        """Combine snapshots into a new, unsaved snapshot
+
+        Args:
+            snapshots (iterable): StatisticsSnapshot instances
+
+        Returns:
+            StatisticsSnapshot with the counts, work times and finish
+            times of all of the snapshots
+        """
+        merged = cls()
+        sketch = QuantileSketch()
+        for snapshot in snapshots:
+            merged.completed += snapshot.completed
+            merged.total_work_time += snapshot.total_work_time
+            sketch.merge(QuantileSketch.from_json(snapshot.work_time_sketch))
+            for field, choose in (('first_finished_at', min), ('last_finished_at', max)):
+                times = [t for t in (getattr(merged, field), getattr(snapshot, field)) if t]
+                setattr(merged, field, choose(times) if times else None)
+        merged.work_time_sketch = sketch.to_json()
+        return merged
+
+    @classmethod
+    def rebuild(cls, batch_queryset=None):
+        """Recompute the snapshots from the TaskAssignment table
+
+        Args:
+            batch_queryset (QuerySet): Batches to update.  Defaults to all Batches.
+
+        Returns:
+            Number of snapshots created
+        """
+        snapshots = cls.objects.all()
+        task_assignments = TaskAssignment.objects.filter(completed=True)
+        if batch_queryset is not None:
+            snapshots = snapshots.filter(batch__in=batch_queryset)
+            task_assignments = task_assignments.filter(task__batch__in=batch_queryset)
+        rows = task_assignments.\
+            values_list('task__batch_id', 'assigned_to_id', 'created_at', 'completed_at').\
+            order_by().\
+            iterator(chunk_size=RESULTS_CHUNK_SIZE)
+        new_snapshots = {}
+        sketches = defaultdict(QuantileSketch)
+        for batch_id, user_id, created_at, completed_at in rows:
+            if (batch_id, user_id) not in new_snapshots:
+                new_snapshots[(batch_id, user_id)] = cls(batch_id=batch_id, user_id=user_id)
+            work_time = (completed_at - created_at).total_seconds()
+            new_snapshots[(batch_id, user_id)].add(work_time, completed_at, sketch=False)
+            sketches[(batch_id, user_id)].add(work_time)
+        for key, snapshot in new_snapshots.items():
+            snapshot.work_time_sketch = sketches[key].to_json()
+        with transaction.atomic():
+            snapshots.delete()
+            cls.objects.bulk_create(new_snapshots.values(), batch_size=RESULTS_CHUNK_SIZE)
+        return len(new_snapshots)
+
+    def add(self, work_time, finished_at, delta=1, sketch=True):
+        """Update this snapshot, without saving it, for a completed Task Assignment
+
+        The finish times are not changed when Task Assignments are removed.
+
+        Args:
+            work_time (float): Work time in seconds
+            finished_at (datetime): Time the Task Assignment was completed
+            delta (int): Number of Task Assignments, negative for removals
+            sketch (bool): If False, the work time sketch is not updated
+        """
+        if sketch:
+            work_time_sketch = QuantileSketch.from_json(self.work_time_sketch)
+            work_time_sketch.add(work_time, delta)
+            self.work_time_sketch = work_time_sketch.to_json()
+        self.completed += delta
+        self.total_work_time += delta * work_time
+        if delta > 0:
+            if self.first_finished_at is None or finished_at < self.first_finished_at:
+                self.first_finished_at = finished_at
+            if self.last_finished_at is None or finished_at > self.last_finished_at:
+                self.last_finished_at = finished_at
+
+    def mean_work_time(self):
+        """
+        Returns:
+            Float for mean work time in seconds, or 0 if no Task Assignments were completed
+        """
+        return self.total_work_time / self.completed if self.completed > 0 else 0
+
+    def median_work_time(self):
+        """
+        Returns:
+            Float estimate of the median work time in seconds, or 0 if no
+            Task Assignments were completed
+        """
+        return self.work_time_quantile(0.5)
+
+    def work_time_quantile(self, q):
+        """Estimate a quantile of the work times from the work time sketch
+
+        Args:
+            q (float): Quantile between 0 and 1, such as 0.9 for the 90th percentile
+
+        Returns:
+            Float estimate of the quantile in seconds, or 0 if no Task
+            Assignments were completed
+        """
+        return QuantileSketch.from_json(self.work_time_sketch).quantile(q)
@@ -0,0 +1,58 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from guardian.models import GroupObjectPermission, UserObjectPermission
+
+from .caching import invalidate_available_task_counts, invalidate_batch_lists
+from .models import Batch, Project, TaskAssignment
+
+User = get_user_model()
+
+
+@receiver(post_save, sender=Batch)
+@receiver(post_delete, sender=Batch)
+def batch_changed(sender, instance, **kwargs):
+    invalidate_batch_lists()
+    invalidate_available_task_counts([instance.id])
+
+
+@receiver(post_save, sender=Project)
+@receiver(post_delete, sender=Project)
+@receiver(post_save, sender=GroupObjectPermission)
+@receiver(post_delete, sender=GroupObjectPermission)
+@receiver(post_save, sender=UserObjectPermission)
+@receiver(post_delete, sender=UserObjectPermission)
+@receiver(m2m_changed, sender=User.groups.through)
+def permissions_changed(sender, **kwargs):
+    invalidate_batch_lists()
+
+
+# The User fields that change which Batches a User can access
+USER_ACCESS_FIELDS = ('is_active', 'is_superuser')
+
+
+@receiver(pre_save, sender=User)
+def user_changing(sender, instance, update_fields=None, **kwargs):
+    fields = [field for field in USER_ACCESS_FIELDS
+              if update_fields is None or field in update_fields]
+    instance._access_changed = False
+    if fields and instance.pk is not None:
+        saved = User.objects.filter(pk=instance.pk).values(*fields).first()
+        instance._access_changed = saved is not None and \
+            any(saved[field] != getattr(instance, field) for field in fields)
+
+
+@receiver(post_save, sender=User)
+def user_changed(sender, instance, **kwargs):
+    # New Users have no cached Batch lists, and logging in or changing a
+    # profile does not change which Batches a User can access
+    if getattr(instance, '_access_changed', False):
+        invalidate_batch_lists()
+
+
+@receiver(pre_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    # The User's Task Assignments, activity rollups and statistics snapshots
+    # are deleted by cascading, so only the Task counters are updated
+    TaskAssignment.decrement_counts(TaskAssignment.objects.filter(assigned_to=instance),
+                                    activity=False)
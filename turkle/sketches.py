@@ -0,0 +1,129 @@
+"""Mergeable quantile sketches for work time statistics
+
+QuantileSketch is a DDSketch: values are counted in logarithmically
+sized bins, so that any quantile can be estimated to within a fixed
+relative error without keeping the values.  Sketches of disjoint sets
+of values are merged by adding their bin counts, which lets Turkle
+store one sketch for each Batch and User and combine them into
+sketches for Batches, Projects and Users.
+
+See Masson, Rim and Lee, "DDSketch: A Fast and Fully-Mergeable
+Quantile Sketch with Relative-Error Guarantees" (VLDB 2019).
+"""
+import math
+
+# Estimated quantiles are within 1% of the true values
+RELATIVE_ACCURACY = 0.01
+
+# Maximum number of bins in a sketch.  With a 1% relative accuracy,
+# 2048 bins cover values from a millisecond to more than a year.
+MAX_BINS = 2048
+
+# Values at or below this are counted as zero
+MIN_VALUE = 0.001
+
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+
+
+class QuantileSketch(object):
+    """DDSketch of non-negative values, such as work times in seconds
+
+    Bin i counts the values in (GAMMA ** (i-1), GAMMA ** i].  When
+    there are more than MAX_BINS bins, the lowest bins are collapsed
+    into one, so only the lowest quantiles lose accuracy.
+    """
+
+    def __init__(self, bins=None, zero_count=0):
+        self.bins = dict(bins or {})
+        self.zero_count = zero_count
+
+    @classmethod
+    def from_json(cls, value):
+        """
+        Args:
+            value (dict): Dict created by to_json().  Any other value,
+                such as the empty string that an empty JSONField
+                evaluates to, creates an empty sketch.
+
+        Returns:
+            QuantileSketch
+        """
+        if not isinstance(value, dict):
+            return cls()
+        return cls({int(i): count for i, count in value.get('bins', {}).items()},
+                   value.get('zero_count', 0))
+
+    def to_json(self):
+        """
+        Returns:
+            Dict that can be stored in a JSONField
+        """
+        return {
+            'bins': {str(i): count for i, count in sorted(self.bins.items()) if count},
+            'zero_count': self.zero_count,
+        }
+
+    @property
+    def count(self):
+        return self.zero_count + sum(self.bins.values())
+
+    def add(self, value, count=1):
+        """Add a value to the sketch
+
+        Args:
+            value (float): Non-negative value
+            count (int): Number of times to add the value, negative to remove it
+        """
+        if value <= MIN_VALUE:
+            self.zero_count += count
+            return
+        i = int(math.ceil(math.log(value) / LOG_GAMMA))
+        self.bins[i] = self.bins.get(i, 0) + count
+        if not self.bins[i]:
+            del self.bins[i]
+        self._collapse()
+
+    def merge(self, other):
+        """Add the values counted by another sketch to this sketch
+
+        Args:
+            other (QuantileSketch):
+        """
+        for i, count in other.bins.items():
+            self.bins[i] = self.bins.get(i, 0) + count
+            if not self.bins[i]:
+                del self.bins[i]
+        self.zero_count += other.zero_count
+        self._collapse()
+
+    def quantile(self, q):
+        """Estimate a quantile of the values
+
+        Args:
+            q (float): Quantile between 0 and 1, such as 0.5 for the median
+
+        Returns:
+            Float estimate of the quantile, or 0 if the sketch is empty
+        """
+        count = self.count
+        if count <= 0:
+            return 0
+        rank = q * (count - 1)
+        seen = self.zero_count
+        if seen > rank:
+            return 0
+        for i in sorted(self.bins):
+            seen += self.bins[i]
+            if seen > rank:
+                # The midpoint, in relative terms, of (GAMMA ** (i-1), GAMMA ** i]
+                return 2 * GAMMA ** i / (GAMMA + 1)
+        return 2 * GAMMA ** max(self.bins) / (GAMMA + 1) if self.bins else 0
+
+    def _collapse(self):
+        if len(self.bins) <= MAX_BINS:
+            return
+        indexes = sorted(self.bins)
+        lowest = indexes[len(indexes) - MAX_BINS]
+        for i in indexes[:len(indexes) - MAX_BINS]:
+            self.bins[lowest] += self.bins.pop(i)
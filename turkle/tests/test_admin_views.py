@@ -1,14 +1,56 @@
 import datetime
+import gzip
+import json
 import os.path
+import shutil
+import tempfile
+from unittest import mock
 
 import django.test
 from django.contrib.auth.models import Group, User
 from django.contrib.messages import get_messages
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
-from .utility import save_model
+from .utility import save_model, set_completion_time
 
-from turkle.models import Batch, Project, Task, TaskAssignment
+from turkle.models import Batch, Job, Project, Task, TaskAssignment
+
+
+class TestBatchChangelist(django.test.TestCase):
+    def setUp(self):
+        User.objects.create_superuser('admin', 'foo@bar.foo', 'secret')
+        self.project = Project.objects.create(name='foo', html_template='<p>${foo}</p>')
+
+    def create_batches(self, count):
+        for i in range(count):
+            batch = Batch.objects.create(project=self.project, name='batch{}'.format(i),
+                                         assignments_per_task=2)
+            for _ in range(2):
+                task = Task.objects.create(batch=batch, input_csv_fields={'foo': 'bar'})
+                TaskAssignment.objects.create(completed=True, task=task)
+
+    def get_changelist(self):
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(reverse('admin:turkle_batch_changelist'))
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_assignments_completed(self):
+        self.create_batches(1)
+        response, _ = self.get_changelist()
+        self.assertContains(response, 'title="Completed 2/4 Task Assignments"')
+
+    def test_query_count(self):
+        self.create_batches(1)
+        _, query_count = self.get_changelist()
+        self.create_batches(10)
+        _, ten_more_query_count = self.get_changelist()
+        self.assertEqual(query_count, ten_more_query_count)
 
 
 class TestCancelOrPublishBatch(django.test.TestCase):
@@ -169,6 +211,128 @@ class TestBatchAdmin(django.test.TestCase):
         self.assertEqual(tasks[2].input_csv_fields['emoji'], '🤔')
         self.assertEqual(tasks[2].input_csv_fields['more_emoji'], '🤭')
 
+    @django.test.override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=0)
+    def test_batch_add_csv_temporary_file_upload(self):
+        project = Project(name='foo', html_template='<p>${emoji}: ${more_emoji}</p><textarea>')
+        project.save()
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        with open(os.path.abspath('turkle/tests/resources/emoji.csv')) as fp:
+            response = client.post(
+                '/admin/turkle/batch/add/',
+                {
+                    'assignments_per_task': 1,
+                    'project': project.id,
+                    'name': 'batch_save',
+                    'csv_file': fp
+                })
+        self.assertTrue(b'Please correct the error' not in response.content)
+        self.assertEqual(response.status_code, 302)
+        matching_batch = Batch.objects.filter(name='batch_save').last()
+        self.assertEqual(matching_batch.total_tasks(), 3)
+        tasks = matching_batch.task_set.order_by('id')
+        self.assertEqual(tasks[2].input_csv_fields['more_emoji'], '🤭')
+
+    def test_batch_download(self):
+        project = Project.objects.create(
+            name='foo', html_template='<p>${foo}: ${bar}</p><textarea>')
+        batch = Batch.objects.create(project=project, name='MY_BATCH_NAME')
+        for i in range(3):
+            task = Task.objects.create(batch=batch, input_csv_fields={'foo': i, 'bar': 'x'})
+            TaskAssignment.objects.create(answers={'combined': str(i)}, completed=True,
+                                          task=task)
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        response = client.get(
+            reverse('admin:turkle_download_batch', kwargs={'batch_id': batch.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename="{}"'.format(batch.csv_results_filename()))
+        lines = list(response.streaming_content)
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[0].endswith(b'"Answer.combined","Turkle.Username"\r\n'))
+        self.assertTrue(lines[3].endswith(b'"x","2","2",""\r\n'))
+
+    def test_batch_download_jsonl(self):
+        project = Project.objects.create(
+            name='foo', html_template='<p>${foo}: ${bar}</p><textarea>')
+        batch = Batch.objects.create(project=project, name='MY_BATCH_NAME', filename='foo.csv')
+        task = Task.objects.create(batch=batch, input_csv_fields={'foo': 'fizz', 'bar': 'x'})
+        TaskAssignment.objects.create(answers={'combined': 'fizz'}, completed=True, task=task)
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        response = client.get(
+            reverse('admin:turkle_download_batch', kwargs={'batch_id': batch.id}),
+            {'format': 'jsonl.gz'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertIn('foo-Batch_{}_results.jsonl.gz'.format(batch.id),
+                      response['Content-Disposition'])
+        content = gzip.decompress(b''.join(response.streaming_content))
+        self.assertEqual(json.loads(content)['Answer.combined'], 'fizz')
+
+        response = client.get(
+            reverse('admin:turkle_download_batch', kwargs={'batch_id': batch.id}),
+            {'format': 'xlsx'})
+        self.assertEqual(response.status_code, 302)
+        messages = list(get_messages(response.wsgi_request))
+        self.assertEqual(str(messages[0]), 'Results format xlsx is not available')
+
+    def test_batch_results_since(self):
+        project = Project.objects.create(
+            name='foo', html_template='<p>${foo}: ${bar}</p><textarea>')
+        batch = Batch.objects.create(project=project, name='MY_BATCH_NAME')
+        other_batch = Batch.objects.create(project=project, name='OTHER_BATCH')
+        task_assignments = []
+        for i in range(3):
+            task = Task.objects.create(batch=batch, input_csv_fields={'foo': i, 'bar': 'x'})
+            task_assignments.append(TaskAssignment.objects.create(
+                answers={'combined': str(i)}, completed=True, task=task))
+        task = Task.objects.create(batch=other_batch, input_csv_fields={'foo': 3, 'bar': 'x'})
+        other_task_assignment = TaskAssignment.objects.create(
+            answers={'combined': '3'}, completed=True, task=task)
+        watermark = timezone.now() - datetime.timedelta(hours=1)
+        set_completion_time(other_task_assignment, watermark - datetime.timedelta(hours=1))
+        set_completion_time(task_assignments[0], watermark - datetime.timedelta(hours=1))
+        set_completion_time(task_assignments[1], watermark + datetime.timedelta(minutes=30))
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        response = client.get(reverse('admin:turkle_batch_results_since_json'),
+                              {'since': watermark.isoformat()})
+        self.assertEqual(response.status_code, 200)
+        results = response.json()
+        self.assertEqual(len(results['batches']), 1)
+        self.assertEqual(results['batches'][0]['id'], batch.id)
+        # The Task Assignment that was just submitted is within RESULTS_SINCE_LAG
+        self.assertEqual(results['batches'][0]['assignments'], 1)
+
+        response = client.get(results['batches'][0]['download_url'])
+        lines = list(response.streaming_content)
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].endswith(b'"x","1","1",""\r\n'))
+
+        later = timezone.now() + datetime.timedelta(minutes=5)
+        with mock.patch('turkle.admin.timezone.now', return_value=later):
+            response = client.get(reverse('admin:turkle_batch_results_since_json'),
+                                  {'since': results['until']})
+        results = response.json()
+        self.assertEqual(len(results['batches']), 1)
+        self.assertEqual(results['batches'][0]['assignments'], 1)
+        response = client.get(results['batches'][0]['download_url'])
+        lines = list(response.streaming_content)
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].endswith(b'"x","2","2",""\r\n'))
+
+        response = client.get(reverse('admin:turkle_batch_results_since_json'),
+                              {'since': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'Invalid since time: yesterday')
+
     def test_batch_add_empty_allotted_assignment_time(self):
         project = Project(name='foo', html_template='<p>${foo}: ${bar}</p><textarea>')
         project.save()
@@ -740,6 +904,46 @@ class TestProjectAdmin(django.test.TestCase):
         self.assertTrue(batch_no_tasks.name in str(response.content))
         self.assertTrue(batch_no_completed_tasks.name in str(response.content))
 
+    def test_project_stats_view_work_times(self):
+        user = User.objects.create_user('worker', password='secret')
+        project = Project.objects.create(name='foo', html_template='<p>${foo}</p><textarea>')
+        batches = [Batch.objects.create(project=project, name='batch{}'.format(i))
+                   for i in range(2)]
+        for batch, work_times in zip(batches, [(10, 20), (60,)]):
+            for work_time in work_times:
+                task = Task.objects.create(batch=batch, input_csv_fields={})
+                ta = TaskAssignment(assigned_to=user, task=task)
+                ta.save()
+                TaskAssignment.objects.filter(id=ta.id).update(
+                    created_at=ta.created_at - datetime.timedelta(seconds=work_time))
+                ta = TaskAssignment.objects.get(id=ta.id)
+                ta.completed = True
+                ta.save()
+        Task.objects.create(batch=batches[1], input_csv_fields={})
+
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(reverse('admin:turkle_project_stats',
+                                          kwargs={'project_id': project.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([q for q in queries
+                          if 'turkle_taskassignment' in q['sql'] and 'COUNT' not in q['sql']])
+        self.assertEqual(response.context['project_total_completed_assignments'], 3)
+        self.assertEqual(response.context['project_total_completed_assignments_1_day'], 3)
+        self.assertEqual(response.context['project_total_work_time'],
+                         '1 minute and 30 seconds (90s)')
+        stats_batches = response.context['stats_batches']
+        self.assertEqual([b['assignments_completed'] for b in stats_batches], [2, 1])
+        self.assertEqual([b['total_task_assignments'] for b in stats_batches], [2, 2])
+        self.assertEqual(stats_batches[0]['mean_work_time'], 15)
+        self.assertIn(stats_batches[0]['p90_work_time'], (9, 10))
+        self.assertEqual(response.context['uncompleted_tas_active_batches'], 1)
+        stats_users = response.context['stats_users']
+        self.assertEqual(len(stats_users), 1)
+        self.assertEqual(stats_users[0]['assignments_completed'], 3)
+        self.assertEqual(stats_users[0]['mean_work_time'], 30)
+
 
 class TestReviewBatch(django.test.TestCase):
     def test_batch_review_bad_batch_id(self):
@@ -753,3 +957,177 @@ class TestReviewBatch(django.test.TestCase):
         messages = list(get_messages(response.wsgi_request))
         self.assertEqual(len(messages), 1)
         self.assertEqual(str(messages[0]), 'Cannot find Batch with ID 666')
+
+    def test_review_batch_admin(self):
+        User.objects.create_superuser('admin', 'foo@bar.foo', 'secret')
+        project = Project.objects.create(name='foo', html_template='<p>${foo}</p><textarea>')
+        batch = Batch.objects.create(project=project, name='foo')
+        task = Task.objects.create(batch=batch, input_csv_fields={'foo': 'bar'})
+        TaskAssignment.objects.create(answers={'combined': 'baz'}, completed=True, task=task)
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        response = client.get(reverse('admin:turkle_review_batch_admin',
+                                      kwargs={'batch_id': batch.id}))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'], reverse('admin:turkle_batch_changelist'))
+        messages = list(get_messages(response.wsgi_request))
+        self.assertEqual(str(messages[0]), 'Created review Batch foo_review with 1 Tasks')
+        review_batch = Batch.objects.get(name='foo_review')
+        self.assertTrue(review_batch.published)
+        self.assertEqual(review_batch.task_set.get().input_csv_fields,
+                         {'foo': 'bar', 'combined': 'baz', 'Annotator': ''})
+
+    def test_batch_review_no_tasks(self):
+        User.objects.create_superuser('admin', 'foo@bar.foo', 'secret')
+        project = Project.objects.create(name='foo', html_template='<p>${foo}</p><textarea>')
+        batch = Batch.objects.create(project=project, name='empty')
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+        response = client.get(reverse('admin:turkle_review_batch', kwargs={'batch_id': batch.id}))
+        self.assertEqual(response.status_code, 302)
+        messages = list(get_messages(response.wsgi_request))
+        self.assertEqual(str(messages[0]), 'Batch empty does not have any Tasks')
+
+    def test_batch_review_task_ids(self):
+        User.objects.create_superuser('admin', 'foo@bar.foo', 'secret')
+        project = Project.objects.create(name='foo', html_template='<p>${foo}</p><textarea>')
+        batch = Batch.objects.create(project=project, name='foo')
+        task_ids = [Task.objects.create(batch=batch, input_csv_fields={'foo': i}).id
+                    for i in range(5)]
+        client = django.test.Client()
+        client.login(username='admin', password='secret')
+
+        response = client.get(reverse('admin:turkle_review_batch', kwargs={'batch_id': batch.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['first_task_id'], task_ids[0])
+
+        url = reverse('admin:turkle_batch_task_ids_json', kwargs={'batch_id': batch.id})
+        response = client.get(url, {'offset': 2, 'limit': 2})
+        self.assertEqual(response.json(), {'offset': 2, 'task_ids': task_ids[2:4], 'total': 5})
+        response = client.get(url, {'offset': 4})
+        self.assertEqual(response.json()['task_ids'], task_ids[4:])
+        response = client.get(url, {'offset': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+
+class TestJobAdmin(django.test.TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = django.test.override_settings(
+            MEDIA_ROOT=self.media_root, TURKLE_BACKGROUND_JOBS=True)
+        self.settings_override.enable()
+        User.objects.create_superuser('admin', 'foo@bar.foo', 'secret')
+        self.client = django.test.Client()
+        self.client.login(username='admin', password='secret')
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def run_jobs(self):
+        # Keep the command from configuring logging for the rest of the test run
+        with mock.patch('logging.basicConfig'):
+            call_command('run_jobs', '--once')
+
+    def test_batch_add_job(self):
+        project = Project.objects.create(
+            name='foo', html_template='<p>${foo}: ${bar}</p><textarea>')
+        with open(os.path.abspath('turkle/tests/resources/form_1_vals.csv')) as fp:
+            response = self.client.post(
+                '/admin/turkle/batch/add/',
+                {
+                    'assignments_per_task': 1,
+                    'project': project.id,
+                    'name': 'batch_save',
+                    'csv_file': fp
+                })
+        job = Job.objects.get()
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'],
+                         reverse('admin:turkle_job_progress', kwargs={'job_id': job.id}))
+        batch = Batch.objects.get(name='batch_save')
+        self.assertEqual(job.job_type, 'create_tasks')
+        self.assertEqual(job.status, Job.QUEUED)
+        self.assertEqual(batch.total_tasks(), 0)
+
+        response = self.client.get(
+            reverse('admin:turkle_job_progress', kwargs={'job_id': job.id}))
+        self.assertEqual(response.status_code, 200)
+
+        self.run_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.SUCCEEDED)
+        self.assertFalse(job.input_file)
+        self.assertEqual(batch.total_tasks(), 1)
+
+        status = self.client.get(
+            reverse('admin:turkle_job_status_json', kwargs={'job_id': job.id})).json()
+        self.assertTrue(status['finished'])
+        self.assertEqual(status['progress'], 1)
+        self.assertEqual(status['next_url'],
+                         reverse('admin:turkle_review_batch', kwargs={'batch_id': batch.id}))
+
+    def test_review_batch_admin_job(self):
+        project = Project.objects.create(name='foo', html_template='<p>${foo}</p><textarea>')
+        batch = Batch.objects.create(project=project, name='foo')
+        task = Task.objects.create(batch=batch, input_csv_fields={'foo': 'bar'})
+        TaskAssignment.objects.create(answers={'combined': 'baz'}, completed=True, task=task)
+
+        response = self.client.get(reverse('admin:turkle_review_batch_admin',
+                                           kwargs={'batch_id': batch.id}))
+        job = Job.objects.get()
+        self.assertEqual(response['Location'],
+                         reverse('admin:turkle_job_progress', kwargs={'job_id': job.id}))
+        self.assertFalse(Batch.objects.filter(name='foo_review').exists())
+
+        self.run_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.SUCCEEDED)
+        self.assertEqual(job.message, 'Created review Batch foo_review with 1 Tasks')
+        self.assertEqual((job.progress, job.total), (1, 1))
+        self.assertEqual(Batch.objects.get(name='foo_review').task_count, 1)
+
+    def test_batch_download_job(self):
+        project = Project.objects.create(
+            name='foo', html_template='<p>${foo}: ${bar}</p><textarea>')
+        batch = Batch.objects.create(project=project, name='MY_BATCH_NAME')
+        task = Task.objects.create(batch=batch, input_csv_fields={'foo': 'fizz', 'bar': 'buzz'})
+        TaskAssignment.objects.create(answers={'combined': 'fizzbuzz'}, completed=True,
+                                      task=task)
+
+        response = self.client.get(
+            reverse('admin:turkle_download_batch', kwargs={'batch_id': batch.id}))
+        job = Job.objects.get()
+        self.assertEqual(response['Location'],
+                         reverse('admin:turkle_job_progress', kwargs={'job_id': job.id}))
+
+        self.run_jobs()
+        status = self.client.get(
+            reverse('admin:turkle_job_status_json', kwargs={'job_id': job.id})).json()
+        self.assertEqual(status['status'], Job.SUCCEEDED)
+        job.refresh_from_db()
+        self.assertEqual((job.progress, job.total), (1, 1))
+        self.assertIsNotNone(job.heartbeat_at)
+
+        response = self.client.get(status['download_url'])
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(batch.csv_results_filename(), response['Content-Disposition'])
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertIn('"Answer.combined"', content.splitlines()[0])
+        self.assertIn('"fizzbuzz"', content.splitlines()[1])
+
+    def test_export_results_job_without_review_batch(self):
+        project = Project.objects.create(
+            name='foo', html_template='<p>${foo}: ${bar}</p><textarea>')
+        Batch.objects.create(project=project, name='MY_BATCH_NAME')
+
+        self.client.get(reverse('admin:turkle_export_results', kwargs={'project_id': project.id}))
+        self.run_jobs()
+
+        job = Job.objects.get()
+        self.assertEqual(job.job_type, 'export_project_results')
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertEqual(job.message, 'Cannot find reviewed Batch')
+        status = self.client.get(
+            reverse('admin:turkle_job_status_json', kwargs={'job_id': job.id})).json()
+        self.assertIsNone(status['download_url'])
@@ -1,13 +1,19 @@
 import argparse
 import contextlib
+import csv
+import datetime
 import io
 import os
 import tempfile
 
 import django.test
+from django.utils import timezone
 import requests
 
 from scripts.client import TurkleClient
+from turkle.models import TaskAssignment
+
+from .utility import set_completion_time
 
 # Integration tests for the command line scripts
 
@@ -36,6 +42,31 @@ class TestClient(django.test.LiveServerTestCase):
             self.client.download(tmpdir)
             self.assertTrue(os.path.exists(os.path.join(tmpdir, "sent-Batch_1_results.csv")))
 
+    def test_download_since(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            watermark = self.client.download_since(tmpdir)
+            filenames = os.listdir(tmpdir)
+            self.assertEqual(len(filenames), 1)
+            self.assertTrue(filenames[0].startswith("sent-Batch_1_results_until_"))
+            self.assertEqual(watermark['assignment_ids'], [])
+
+        # Submitted before the watermark, but committed after it was taken
+        set_completion_time(TaskAssignment.objects.get(id=2),
+                            timezone.now() - datetime.timedelta(minutes=5))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            watermark = self.client.download_since(tmpdir, watermark=watermark)
+            filenames = os.listdir(tmpdir)
+            self.assertEqual(len(filenames), 1)
+            with open(os.path.join(tmpdir, filenames[0]), newline='') as fh:
+                rows = list(csv.DictReader(fh))
+            self.assertEqual([row['AssignmentId'] for row in rows], ['2'])
+            self.assertEqual(watermark['assignment_ids'], ['2'])
+
+        # The overlap with the previous download is skipped
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.assertTrue(self.client.download_since(tmpdir, watermark=watermark))
+            self.assertEqual(os.listdir(tmpdir), [])
+
     def test_upload(self):
         options = argparse.Namespace()
         options.login = 0
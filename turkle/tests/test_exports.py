@@ -0,0 +1,94 @@
+import datetime
+import gzip
+import io
+import json
+import unittest
+from unittest import mock
+
+from django.contrib.auth.models import User
+import django.test
+
+from turkle import exports
+from turkle.models import Batch, Project, Task, TaskAssignment
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+class TestExports(django.test.TestCase):
+    def setUp(self):
+        user = User.objects.create_user('joe', password='secret')
+        self.project = Project.objects.create(
+            name='foo', html_template='<p>${letter}</p><textarea>')
+        self.batch = Batch.objects.create(project=self.project, name='foo_review')
+        for i in range(3):
+            task = Task.objects.create(batch=self.batch,
+                                       input_csv_fields={'letter': 'abc'[i], 'number': str(i)})
+            TaskAssignment.objects.create(answers={'combined': str(i)}, assigned_to=user,
+                                          completed=True, task=task)
+
+    def test_jsonl_gz(self):
+        fh = io.BytesIO()
+        exports.write_results(fh, 'jsonl.gz', *exports.batch_results(self.batch))
+        lines = gzip.decompress(fh.getvalue()).decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 3)
+        record = json.loads(lines[2])
+        self.assertEqual(record['Input.letter'], 'c')
+        self.assertEqual(record['Answer.combined'], '2')
+        self.assertEqual(record['Turkle.Username'], 'joe')
+        self.assertIsInstance(record['AssignmentId'], int)
+        self.assertIsInstance(record['WorkTimeInSeconds'], int)
+        self.assertIsInstance(datetime.datetime.fromisoformat(record['SubmitTime']),
+                              datetime.datetime)
+
+    def test_project_reviewed_results(self):
+        Batch.objects.create(project=self.project, name='not reviewed')
+        fieldnames, records = exports.project_reviewed_results(self.project)
+        self.assertIn('Answer.combined', fieldnames)
+        self.assertEqual(len(list(records)), 3)
+
+        project = Project.objects.create(name='bar', html_template='<p></p><textarea>')
+        self.assertIsNone(exports.project_reviewed_results(project))
+
+    def test_results_filename(self):
+        self.assertEqual(exports.results_filename('foo-Batch_1_results.csv', 'parquet'),
+                         'foo-Batch_1_results.parquet')
+        self.assertEqual(exports.results_filename('foo-Batch_1_results.csv', 'jsonl.gz'),
+                         'foo-Batch_1_results.jsonl.gz')
+
+    def test_unavailable_format(self):
+        with mock.patch('turkle.exports.pyarrow', None):
+            self.assertFalse(exports.is_format_available('parquet'))
+            self.assertTrue(exports.is_format_available('jsonl.gz'))
+            with self.assertRaises(ValueError):
+                exports.write_results(io.BytesIO(), 'parquet',
+                                      *exports.batch_results(self.batch))
+        self.assertFalse(exports.is_format_available('xlsx'))
+
+    @unittest.skipUnless(pyarrow, 'pyarrow is not installed')
+    def test_parquet(self):
+        import pyarrow.parquet
+        fh = io.BytesIO()
+        exports.write_results(fh, 'parquet', *exports.batch_results(self.batch))
+        fh.seek(0)
+        table = pyarrow.parquet.read_table(fh)
+        self.assertEqual(table.num_rows, 3)
+        self.assertEqual(table.schema.field('AssignmentId').type, pyarrow.int64())
+        self.assertTrue(pyarrow.types.is_timestamp(table.schema.field('AcceptTime').type))
+        self.assertEqual(table.column('Input.letter').to_pylist(), ['a', 'b', 'c'])
+
+    @unittest.skipUnless(pyarrow, 'pyarrow is not installed')
+    def test_arrow(self):
+        import pyarrow.ipc
+        fh = io.BytesIO()
+        with mock.patch('turkle.exports.RESULTS_CHUNK_SIZE', 2):
+            exports.write_results(fh, 'arrow', *exports.batch_results(self.batch))
+        fh.seek(0)
+        reader = pyarrow.ipc.open_file(fh)
+        self.assertEqual(reader.num_record_batches, 2)
+        table = reader.read_all()
+        self.assertEqual(table.column('Answer.combined').to_pylist(), ['0', '1', '2'])
+        self.assertEqual(table.column('WorkerId').to_pylist(),
+                         [User.objects.get(username='joe').id] * 3)
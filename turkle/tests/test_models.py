@@ -1,17 +1,26 @@
 import datetime
 from io import StringIO
 import os.path
+import tempfile
 import time
 from unittest import mock
 
 from django.contrib.auth.models import AnonymousUser, Group, User
 from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.db.models import QuerySet
 import django.test
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from guardian.shortcuts import assign_perm, get_group_perms
+from guardian.utils import get_anonymous_user
 
-from .utility import save_model
-from turkle.models import Task, TaskAssignment, Batch, Project, ActiveProject, ActiveProjectManager
+from .utility import create_completed_assignment, save_model
+from turkle.models import (Task, TaskAssignment, Batch, Job, Project, ActiveProject,
+                           ActiveProjectManager, ActiveUser, ActivityRollup, DailyActivity,
+                           StatisticsSnapshot)
+from turkle.sketches import QuantileSketch
 from turkle.utils import get_turkle_template_limit
 
 
@@ -20,6 +29,22 @@ class TestBatch(django.test.TestCase):
     def setUp(self):
         self.admin = User.objects.create_superuser('admin', 'foo@bar.foo', 'secret')
 
+    def test_add_fieldnames(self):
+        batch = Batch.objects.create(project=Project.objects.create())
+        Batch.add_fieldnames(batch.id, input_fieldnames=['b', 'a'], answer_fieldnames=['c'])
+        batch.refresh_from_db()
+        self.assertEqual(batch.input_fieldnames, ['a', 'b'])
+        self.assertEqual(batch.answer_fieldnames, ['c'])
+
+        # Known fieldnames are checked with one read, without locking the Batch
+        with CaptureQueriesContext(connection) as queries:
+            Batch.add_fieldnames(batch.id, input_fieldnames=['a'], answer_fieldnames=['c'])
+        self.assertEqual(len(queries), 1)
+
+        Batch.add_fieldnames(batch.id, answer_fieldnames=['c', 'd'])
+        batch.refresh_from_db()
+        self.assertEqual(batch.answer_fieldnames, ['c', 'd'])
+
     def test_access_permitted_for_active_flag(self):
         user = User.objects.create_user('testuser', password='secret')
 
@@ -81,6 +106,47 @@ class TestBatch(django.test.TestCase):
         # add superusers should have access to it
         self.assertEqual(len(batch.access_permitted_for(self.admin)), 1)
 
+    def test_access_permitted_for_user_permissions(self):
+        user = User.objects.create_user('testuser', password='secret')
+        other_user = User.objects.create_user('otheruser', password='secret')
+        project = Project.objects.create(custom_permissions=True)
+        batch = Batch.objects.create(custom_permissions=True, project=project)
+        Batch.objects.create(custom_permissions=True, project=project)
+
+        assign_perm('can_work_on_batch', user, batch)
+        self.assertEqual(list(Batch.access_permitted_for(user)), [batch])
+        self.assertEqual(len(Batch.access_permitted_for(other_user)), 0)
+
+        user.is_active = False
+        user.save()
+        self.assertEqual(len(Batch.access_permitted_for(user)), 0)
+
+    def test_access_permitted_for_anonymous_user_permissions(self):
+        anonymous_user = AnonymousUser()
+        project = Project.objects.create(custom_permissions=True)
+        batch = Batch.objects.create(custom_permissions=True, login_required=False,
+                                     project=project)
+        self.assertEqual(len(Batch.access_permitted_for(anonymous_user)), 0)
+
+        assign_perm('can_work_on_batch', get_anonymous_user(), batch)
+        self.assertEqual(len(Batch.access_permitted_for(anonymous_user)), 1)
+
+    def test_access_permitted_for_single_query(self):
+        user = User.objects.create_user('testuser', password='secret')
+        group = Group.objects.create(name='testgroup')
+        user.groups.add(group)
+        project = Project.objects.create(custom_permissions=True)
+        for i in range(3):
+            assign_perm('can_work_on_batch', group,
+                        Batch.objects.create(custom_permissions=True, project=project))
+            Batch.objects.create(custom_permissions=True, project=project)
+            Batch.objects.create(project=project)
+        # Warm the ContentType cache
+        Batch.access_permitted_for(user)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(len(Batch.access_permitted_for(user)), 6)
+
     def test_available_for(self):
         user = User.objects.create_user('testuser', password='secret')
         project = Project.objects.create()
@@ -318,6 +384,131 @@ class TestBatch(django.test.TestCase):
         self.assertEqual(tasks[2].input_csv_fields['emoji'], '🤔')
         self.assertEqual(tasks[2].input_csv_fields['more_emoji'], '🤭')
 
+    def test_fieldnames_maintained(self):
+        project = Project.objects.create(html_template='<p>${letter}</p><textarea>')
+        batch = Batch.objects.create(project=project)
+        task = Task.objects.create(batch=batch, input_csv_fields={'number': '1', 'letter': 'a'})
+        Task.objects.create(batch=batch, input_csv_fields={'letter': 'b', 'extra': 'x'})
+        TaskAssignment.objects.create(answers={'guess': 'a'}, completed=False, task=task)
+        TaskAssignment.objects.create(answers={'combined': '1a'}, completed=True, task=task)
+
+        batch.refresh_from_db()
+        self.assertEqual(batch.input_fieldnames, ['extra', 'letter', 'number'])
+        self.assertEqual(batch.answer_fieldnames, ['combined'])
+
+        # The header of results files is read from the Batch instead of scanning answers
+        with self.assertNumQueries(1):
+            fieldnames = batch._get_csv_fieldnames()
+        self.assertEqual(
+            fieldnames[-5:],
+            ('Input.extra', 'Input.letter', 'Input.number', 'Answer.combined', 'Turkle.Username'))
+
+        Batch.objects.filter(id=batch.id).update(input_fieldnames=[], answer_fieldnames=[])
+        self.assertEqual(Batch.rebuild_fieldnames(Batch.objects.filter(id=batch.id)), 1)
+        batch.refresh_from_db()
+        self.assertEqual(batch.input_fieldnames, ['extra', 'letter', 'number'])
+        self.assertEqual(batch.answer_fieldnames, ['combined'])
+
+    def test_to_csv_query_count(self):
+        user = User.objects.create_user('joe', password='secret')
+        project = Project.objects.create(name='test', html_template='<p>${letter}</p><textarea>')
+        batch = Batch.objects.create(project=project)
+
+        def add_task_assignments(n):
+            for i in range(n):
+                task = Task.objects.create(batch=batch, input_csv_fields={'letter': str(i)})
+                TaskAssignment.objects.create(answers={'combined': str(i)}, assigned_to=user,
+                                              completed=True, task=task)
+
+        # The number of queries does not depend on the number of Task Assignments
+        add_task_assignments(1)
+        with CaptureQueriesContext(connection) as one_assignment:
+            batch.to_csv(StringIO())
+        add_task_assignments(20)
+        csv_output = StringIO()
+        with CaptureQueriesContext(connection) as many_assignments:
+            batch.to_csv(csv_output)
+        self.assertEqual(len(one_assignment), len(many_assignments))
+        self.assertEqual(len(csv_output.getvalue().splitlines()), 22)
+        self.assertTrue(csv_output.getvalue().splitlines()[-1].endswith('"19","19","joe"'))
+
+        progress = []
+        with mock.patch('turkle.models.RESULTS_CHUNK_SIZE', 8):
+            batch.to_csv(StringIO(), progress=progress.append)
+        self.assertEqual(progress, [8, 16, 21])
+
+    def test_create_review_batch(self):
+        user = User.objects.create_user('joe', password='secret')
+        group = Group.objects.create(name='reviewers')
+        project = Project.objects.create(
+            name='test', html_template='<p>${letter}${isUnderReview}</p><textarea>')
+        batch = Batch.objects.create(project=project, name='letters', assignments_per_task=2,
+                                     custom_permissions=True)
+        assign_perm('can_work_on_batch', group, batch)
+        for i in range(3):
+            task = Task.objects.create(batch=batch,
+                                       input_csv_fields={'letter': 'a' + str(i),
+                                                         'isUnderReview': 'false'})
+            TaskAssignment.objects.create(answers={'combined': "'{}'".format(i)},
+                                          assigned_to=user, completed=True, task=task)
+        Task.objects.create(batch=batch, input_csv_fields={'letter': 'b', 'isUnderReview': ''})
+
+        progress = []
+        review_batch = batch.create_review_batch(created_by=user, chunk_size=2,
+                                                 progress=progress.append)
+        self.assertEqual(progress, [2, 3])
+        self.assertEqual(review_batch.name, 'letters_review')
+        self.assertEqual(review_batch.project_id, project.id)
+        self.assertEqual(review_batch.assignments_per_task, 2)
+        self.assertTrue(review_batch.published)
+        self.assertTrue(review_batch.login_required)
+        self.assertEqual(review_batch.created_by, user)
+        self.assertEqual(review_batch.task_count, 3)
+        self.assertTrue(review_batch.custom_permissions)
+        self.assertIn('can_work_on_batch', get_group_perms(group, review_batch))
+        self.assertEqual(review_batch.input_fieldnames,
+                         ['Annotator', 'combined', 'isUnderReview', 'letter'])
+        self.assertEqual(review_batch.task_set.order_by('id').first().input_csv_fields, {
+            'isUnderReview': 'true', 'letter': 'a0', 'combined': "\\'0\\'", 'Annotator': 'joe'})
+
+        csv_output = StringIO()
+        batch.to_csv_without_quoting(csv_output, lineterminator='\n')
+        self.assertEqual(csv_output.getvalue().splitlines()[:2], [
+            '"isUnderReview","letter","combined","Annotator"',
+            '"true","a0","\\\'0\\\'","joe"'])
+
+    def test_create_tasks_from_csv_chunks(self):
+        project = Project.objects.create(html_template='<p>${letter}</p><textarea>')
+        batch = Batch.objects.create(project=project)
+        csv_fh = StringIO('letter,number\n' + ''.join(
+            '{},{}\n'.format(chr(ord('a') + i), i) for i in range(7)))
+        progress = []
+
+        # One INSERT and one Batch counter UPDATE per chunk, plus a savepoint
+        # and the five queries that check and save the new header fieldnames
+        with self.assertNumQueries(2 * 3 + 2 + 5):
+            num_created = batch.create_tasks_from_csv(
+                csv_fh, chunk_size=3, progress=progress.append)
+
+        self.assertEqual(num_created, 7)
+        self.assertEqual(progress, [3, 6, 7])
+        batch.refresh_from_db()
+        self.assertEqual(batch.task_count, 7)
+        self.assertFalse(batch.completed)
+        self.assertEqual(
+            [t.input_csv_fields['letter'] for t in batch.task_set.order_by('id')],
+            list('abcdefg'))
+
+    def test_create_tasks_from_csv_row_errors(self):
+        project = Project.objects.create(html_template='<p>${letter}</p><textarea>')
+        batch = Batch.objects.create(project=project)
+        csv_fh = StringIO('letter,number\na,1\nb\n\nc,3,extra\nd,4\n')
+        errors = []
+
+        self.assertEqual(batch.create_tasks_from_csv(csv_fh, errors=errors), 2)
+        self.assertEqual([line for line, _ in errors], [3, 5])
+        self.assertEqual(batch.total_tasks(), 2)
+
     def test_copy_project_permissions(self):
         project = Project.objects.create(
             custom_permissions=True,
@@ -478,6 +669,38 @@ class TestBatchAvailableTasks(django.test.TestCase):
         self.assertEqual(batch.total_available_tasks_for(other_user), 0)
         self.assertEqual(Batch.available_task_counts_for(self.batch_query, self.user)[batch.id], 0)
 
+    def test_lock_first_task_id(self):
+        batch = Batch.objects.create(assignments_per_task=1, project=self.project)
+        self.assertEqual(batch.lock_first_task_id(batch.available_task_ids_for(self.user)), None)
+
+        task_one = Task.objects.create(batch=batch)
+        task_two = Task.objects.create(batch=batch)
+        task_ids = batch.available_task_ids_for(self.user)
+        self.assertEqual(batch.lock_first_task_id(task_ids), task_one.id)
+
+        # Claimed Tasks are passed over
+        TaskAssignment.objects.create(assigned_to=self.user, task=task_one)
+        self.assertEqual(batch.lock_first_task_id(task_ids), task_two.id)
+        self.assertEqual(
+            batch.lock_first_task_id(task_ids.exclude(id=task_two.id)), None)
+
+    def test_lock_first_task_id_skipped_task(self):
+        batch = Batch.objects.create(assignments_per_task=1, project=self.project)
+        task = Task.objects.create(batch=batch)
+
+        def skip_every_task(queryset, skip_locked=False, **kwargs):
+            # SQLite cannot lock rows, so Tasks locked by a concurrent
+            # transaction are simulated by skipping every Task
+            return queryset.none() if skip_locked else queryset
+
+        features = connection.features
+        with mock.patch.object(features, 'has_select_for_update', True), \
+                mock.patch.object(features, 'has_select_for_update_skip_locked', True), \
+                mock.patch.object(QuerySet, 'select_for_update', skip_every_task):
+            # The skipped Task is locked by waiting for the concurrent transaction
+            self.assertEqual(batch.lock_first_task_id(batch.available_task_ids_for(self.user)),
+                             task.id)
+
     def test_available_tasks_for_anon_user(self):
         anon_user = AnonymousUser()
         user = User.objects.create_user('user', password='secret')
@@ -580,6 +803,25 @@ class TestBatchReportFunctions(django.test.TestCase):
         self.batch.mean_work_time_in_seconds()
         self.batch.total_work_time_in_seconds()
 
+    def test_work_time_statistics(self):
+        for i, work_time in enumerate([40, 10, 20, 35]):
+            create_completed_assignment(self.batch, self.user_1, work_time=work_time)
+            if i == 2:
+                odd_count_statistics = self.batch.work_time_statistics()
+        self.assertAlmostEqual(odd_count_statistics.pop('mean'), 70 / 3, places=5)
+        self.assertEqual(odd_count_statistics, {'count': 3, 'total': 70})
+        expected = {'count': 4, 'total': 105, 'mean': 26.25}
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.batch.work_time_statistics(), expected)
+            self.assertEqual(self.batch.mean_work_time_in_seconds(), 26.25)
+            self.assertEqual(self.batch.total_work_time_in_seconds(), 105)
+        self.assertEqual(len(queries), 3)
+        self.assertFalse([q for q in queries if 'ORDER BY' in q['sql']])
+        StatisticsSnapshot.rebuild()
+        self.assertEqual(self.batch.median_work_time_in_seconds(), 20)
+        self.assertEqual(self.batch.work_time_percentiles_in_seconds(), {50: 20, 90: 35, 99: 35})
+        self.assertEqual(self.batch.project.work_time_percentiles_in_seconds((50,)), {50: 20})
+
     def test_work_time_in_seconds_stats_with_no_completed_assignments(self):
         self.batch.median_work_time_in_seconds()
         self.batch.mean_work_time_in_seconds()
@@ -611,6 +853,21 @@ class TestProject(django.test.TestCase):
         self.assertTrue(batch.login_required)
         self.assertTrue('can_work_on_batch' in get_group_perms(group, batch))
 
+    def test_compiled_html_template(self):
+        project = Project.objects.create(html_template='<p>${foo} ${bar} ${foo}$</p>')
+        self.assertEqual(project.compiled_html_template(),
+                         ('<p>', 'foo', ' ', 'bar', ' ', 'foo', '$</p>'))
+
+        # Saving the Project changes updated_at, which invalidates the compiled template
+        project.html_template = '<p>${baz}</p>'
+        project.save()
+        project = Project.objects.get(id=project.id)
+        self.assertEqual(project.compiled_html_template(), ('<p>', 'baz', '</p>'))
+
+        batch = Batch.objects.create(project=project)
+        task = Task.objects.create(batch=batch, input_csv_fields={'foo': '${baz}'})
+        self.assertEqual(task.populate_html_template(), '<p>${baz}</p>')
+
     def test_copy_permissions_to_batches_unhydrated_project(self):
         # Verify that Project.copy_permissions_to_batches() works with
         # a Project model instance that is only "hydrated" with the
@@ -795,6 +1052,33 @@ class TestActiveProjectManager(django.test.TestCase):
         self.assertEqual(3, project.completed_assignments())
 
 
+class TestActiveUserManager(django.test.TestCase):
+    now = timezone.now()
+
+    @mock.patch("django.utils.timezone.now")
+    def test_get_queryset(self, mock_now):
+        now = self.now
+        mock_now.return_value = now
+        batch = Batch.objects.create(project=Project.objects.create())
+        users = [User.objects.create_user('user{}'.format(i), password='secret')
+                 for i in range(3)]
+        for user, days_ago, completed in ((users[0], 0, True), (users[0], 0, True),
+                                          (users[0], 5, True), (users[1], 5, True),
+                                          (users[2], 0, False)):
+            mock_now.return_value = now - datetime.timedelta(days=days_ago)
+            task = Task.objects.create(batch=batch, input_csv_fields={})
+            TaskAssignment.objects.create(assigned_to=user, completed=completed, task=task)
+        mock_now.return_value = now
+
+        active_users = ActiveUser.objects.get_queryset(n_days=1)
+        self.assertEqual([u.username for u in active_users], ['user0'])
+        self.assertEqual(active_users[0].completed_assignments(), 2)
+        active_users = ActiveUser.objects.get_queryset(n_days=7).order_by('username')
+        self.assertEqual([u.completed_assignments() for u in active_users], [3, 1])
+        self.assertEqual(active_users[1].most_recent(),
+                         TaskAssignment.objects.get(assigned_to=users[1]).completed_at)
+
+
 class TestTask(django.test.TestCase):
 
     def setUp(self):
@@ -972,6 +1256,23 @@ class TestGenerateForm(django.test.TestCase):
 
 
 class TestTaskAssignment(django.test.TestCase):
+    def test_work_time_totals(self):
+        project = Project.objects.create(name='test', html_template='<p>${letter}</p>')
+        batches = [Batch.objects.create(project=project), Batch.objects.create(project=project)]
+        for batch, work_times in zip(batches, [(10, 20.5), (30,)]):
+            for work_time in work_times:
+                create_completed_assignment(batch, work_time=work_time)
+        expected = [
+            {'task__batch_id': batches[0].id, 'total_completed': 2, 'elapsed_seconds': 30},
+            {'task__batch_id': batches[1].id, 'total_completed': 1, 'elapsed_seconds': 30},
+        ]
+
+        def totals():
+            return sorted(TaskAssignment.work_time_totals(TaskAssignment.objects.all(),
+                                                          ['task__batch_id']),
+                          key=lambda t: t['task__batch_id'])
+        self.assertEqual(totals(), expected)
+
     def test_task_marked_as_completed(self):
         # When assignment_per_task==1, completing 1 Assignment marks Task as complete
         project = Project(name='test', html_template='<p>${number} - ${letter}</p><textarea>')
@@ -1036,6 +1337,77 @@ class TestTaskAssignment(django.test.TestCase):
         self.assertTrue(task.completed)
         self.assertTrue(batch.completed)
 
+    def test_task_and_batch_counters(self):
+        project = Project.objects.create()
+        batch = Batch.objects.create(project=project)
+        task_one = Task.objects.create(batch=batch)
+        task_two = Task.objects.create(batch=batch)
+        batch.refresh_from_db()
+        self.assertEqual(batch.task_count, 2)
+        self.assertEqual(batch.completed_task_count, 0)
+
+        TaskAssignment.objects.create(completed=True, task=task_one)
+        batch.refresh_from_db()
+        self.assertEqual(batch.completed_task_count, 1)
+        self.assertFalse(batch.completed)
+
+        # Saving a stale instance does not overwrite the counters
+        batch.name = 'renamed'
+        batch.save()
+        task_two.refresh_from_db()
+        task_two.save()
+        TaskAssignment.objects.create(completed=True, task=task_two)
+        batch.refresh_from_db()
+        self.assertEqual(batch.task_count, 2)
+        self.assertEqual(batch.completed_task_count, 2)
+        self.assertTrue(batch.completed)
+
+        # Adding an unfinished Task reopens the Batch
+        Task.objects.create(batch=batch)
+        batch.refresh_from_db()
+        self.assertFalse(batch.completed)
+
+    def test_completion_only_propagates_on_transition(self):
+        project = Project.objects.create()
+        batch = Batch.objects.create(project=project)
+        task = Task.objects.create(batch=batch)
+        ta = TaskAssignment.objects.create(task=task)
+        ta.completed = True
+        ta.save()
+
+        # Updating the answers of a completed assignment is a single UPDATE
+        ta.answers = {'foo': 'bar'}
+        with self.assertNumQueries(1):
+            ta.save()
+
+    def test_delete_user_with_open_assignment(self):
+        project = Project.objects.create(login_required=False)
+        batch = Batch.objects.create(project=project)
+        task = Task.objects.create(batch=batch, input_csv_fields={})
+        user = User.objects.create_user('worker', password='secret')
+        other_user = User.objects.create_user('other', password='secret')
+        TaskAssignment.objects.create(assigned_to=user, completed=False, task=task)
+        self.assertEqual(batch.total_available_tasks_for(other_user), 0)
+
+        # Deleting the User deletes the assignment without calling TaskAssignment.delete()
+        user.delete()
+        self.assertFalse(TaskAssignment.objects.exists())
+        task.refresh_from_db()
+        self.assertEqual(task.assignment_count, 0)
+        self.assertEqual(batch.total_available_tasks_for(other_user), 1)
+
+    def test_queryset_delete_completed_assignment(self):
+        project = Project.objects.create(login_required=False)
+        batch = Batch.objects.create(project=project)
+        task = Task.objects.create(batch=batch, input_csv_fields={})
+        TaskAssignment.objects.create(completed=True, task=task)
+
+        TaskAssignment.objects.filter(task=task).delete()
+        task.refresh_from_db()
+        self.assertEqual(task.assignment_count, 0)
+        self.assertEqual(task.completed_assignment_count, 0)
+        self.assertEqual(ActivityRollup.timestamp_counts(batch_id=batch.id), {})
+
     def test_expire_all_abandoned(self):
         t = timezone.now()
         dt = datetime.timedelta(hours=2)
@@ -1061,6 +1433,32 @@ class TestTaskAssignment(django.test.TestCase):
         TaskAssignment.expire_all_abandoned()
         self.assertEqual(TaskAssignment.objects.count(), 0)
 
+    def test_expire_all_abandoned_counts(self):
+        batch = Batch.objects.create(project=Project.objects.create(), assignments_per_task=2)
+        tasks = [Task.objects.create(batch=batch) for i in range(3)]
+        for task in tasks + tasks[:1]:
+            TaskAssignment.objects.create(task=task)
+        TaskAssignment.objects.update(expires_at=timezone.now() - datetime.timedelta(hours=1))
+
+        # The lock, the grouped counts, one counter UPDATE for each distinct
+        # count, the DELETE, and two savepoints
+        with self.assertNumQueries(9):
+            self.assertEqual(TaskAssignment.expire_all_abandoned()[0], 4)
+        self.assertEqual(
+            list(Task.objects.order_by('id').values_list('assignment_count', flat=True)),
+            [0, 0, 0])
+
+    def test_delete_batch_does_not_load_assignments(self):
+        batch = Batch.objects.create(project=Project.objects.create())
+        for i in range(5):
+            TaskAssignment.objects.create(completed=True, task=Task.objects.create(batch=batch))
+
+        with CaptureQueriesContext(connection) as queries:
+            batch.delete()
+        self.assertFalse(TaskAssignment.objects.exists())
+        self.assertFalse(any('"turkle_taskassignment"."answers"' in query['sql']
+                             for query in queries))
+
     def test_expire_all_abandoned__dont_delete_completed(self):
         t = timezone.now()
         dt = datetime.timedelta(hours=2)
@@ -1111,6 +1509,56 @@ class TestTaskAssignment(django.test.TestCase):
         TaskAssignment.expire_all_abandoned()
         self.assertEqual(TaskAssignment.objects.count(), 1)
 
+    def test_assignment_counts(self):
+        project = Project.objects.create()
+        batch = Batch.objects.create(project=project)
+        task = Task.objects.create(batch=batch)
+
+        ta_one = TaskAssignment.objects.create(task=task)
+        ta_two = TaskAssignment.objects.create(task=task)
+        task.refresh_from_db()
+        self.assertEqual(task.assignment_count, 2)
+        self.assertEqual(task.completed_assignment_count, 0)
+
+        ta_one.completed = True
+        ta_one.save()
+        # Saving an already completed assignment does not change the counters
+        ta_one.save()
+        task.refresh_from_db()
+        self.assertEqual(task.assignment_count, 2)
+        self.assertEqual(task.completed_assignment_count, 1)
+
+        TaskAssignment.objects.get(id=ta_two.id).delete()
+        task.refresh_from_db()
+        self.assertEqual(task.assignment_count, 1)
+        self.assertEqual(task.completed_assignment_count, 1)
+
+    def test_assignment_counts_expire_all_abandoned(self):
+        project = Project.objects.create()
+        batch = Batch.objects.create(project=project)
+        task = Task.objects.create(batch=batch)
+        TaskAssignment.objects.create(task=task)
+        TaskAssignment.objects.create(task=task, completed=True)
+        TaskAssignment.objects.update(expires_at=timezone.now() - datetime.timedelta(hours=2))
+
+        TaskAssignment.expire_all_abandoned()
+        task.refresh_from_db()
+        self.assertEqual(task.assignment_count, 1)
+        self.assertEqual(task.completed_assignment_count, 1)
+
+    def test_rebuild_assignment_counts(self):
+        project = Project.objects.create()
+        batch = Batch.objects.create(project=project)
+        task = Task.objects.create(batch=batch)
+        TaskAssignment.objects.create(task=task)
+        TaskAssignment.objects.create(task=task, completed=True)
+        Task.objects.update(assignment_count=0, completed_assignment_count=0)
+
+        self.assertEqual(Task.rebuild_assignment_counts(), 1)
+        task.refresh_from_db()
+        self.assertEqual(task.assignment_count, 2)
+        self.assertEqual(task.completed_assignment_count, 1)
+
     def test_work_time_in_seconds(self):
         project = Project.objects.create()
         batch = Batch.objects.create(project=project)
@@ -1137,3 +1585,267 @@ class TestTaskAssignment(django.test.TestCase):
         ta.completed = True
         ta.save()
         self.assertEqual(expire_time, ta.expires_at)
+
+
+class TestJob(django.test.TestCase):
+    def test_claim_next(self):
+        first = Job.objects.create(job_type='export_batch')
+        second = Job.objects.create(job_type='export_batch')
+
+        claimed = Job.claim_next()
+        self.assertEqual(claimed.id, first.id)
+        self.assertEqual(claimed.status, Job.RUNNING)
+        self.assertIsNotNone(claimed.started_at)
+        self.assertEqual(Job.claim_next().id, second.id)
+        self.assertIsNone(Job.claim_next())
+
+    def test_claim_next_fails_stale_jobs(self):
+        stale = Job.objects.create(job_type='export_batch')
+        active = Job.objects.create(job_type='export_batch')
+        queued = Job.objects.create(job_type='export_batch')
+        self.assertEqual(Job.claim_next().id, stale.id)
+        self.assertEqual(Job.claim_next().id, active.id)
+        long_ago = timezone.now() - datetime.timedelta(hours=2)
+        Job.objects.filter(id__in=[stale.id, active.id]).update(heartbeat_at=long_ago)
+        Job.objects.get(id=active.id).update_progress(1)
+
+        self.assertEqual(Job.claim_next().id, queued.id)
+        stale = Job.objects.get(id=stale.id)
+        self.assertEqual(stale.status, Job.FAILED)
+        self.assertIsNotNone(stale.finished_at)
+        self.assertEqual(Job.objects.get(id=active.id).status, Job.RUNNING)
+
+    def test_purge_finished(self):
+        with tempfile.TemporaryDirectory() as media_root, \
+                django.test.override_settings(MEDIA_ROOT=media_root):
+            old = Job.objects.create(job_type='export_batch', status=Job.SUCCEEDED,
+                                     finished_at=timezone.now() - datetime.timedelta(days=8))
+            old.result_file.save('results.csv', ContentFile(b'a,b'))
+            recent = Job.objects.create(job_type='export_batch', status=Job.FAILED,
+                                        finished_at=timezone.now() - datetime.timedelta(days=6))
+            running = Job.objects.create(job_type='export_batch', status=Job.RUNNING)
+            self.assertTrue(os.path.exists(old.result_file.path))
+
+            self.assertEqual(Job.purge_finished(), 1)
+            self.assertEqual(set(Job.objects.values_list('id', flat=True)),
+                             {recent.id, running.id})
+            self.assertFalse(os.path.exists(old.result_file.path))
+
+    def test_update_progress_in_transaction(self):
+        job = Job.objects.create(job_type='create_tasks', status=Job.RUNNING)
+        with mock.patch.object(Job, '_update_outside_transaction') as update, \
+                mock.patch.object(connection, 'vendor', 'postgresql'):
+            # Test cases run inside a transaction
+            job.update_progress(5, 10)
+        self.assertEqual(update.call_args[0][0]['progress'], 5)
+        self.assertEqual(Job.objects.get(id=job.id).progress, 0)
+
+    def test_finish_failed_stale_job(self):
+        job = Job.objects.create(job_type='export_batch', status=Job.RUNNING,
+                                 heartbeat_at=timezone.now() - datetime.timedelta(hours=2))
+        self.assertEqual(Job.fail_stale(), 1)
+
+        # A Job that was failed while it was still running stays failed
+        self.assertFalse(job.finish(Job.SUCCEEDED, 'Done'))
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertEqual(job.message, 'The Job stopped reporting progress and was interrupted')
+
+    @django.test.override_settings(TURKLE_JOB_HEARTBEAT_TIMEOUT=180)
+    def test_fail_stale_timeout(self):
+        job = Job.objects.create(job_type='export_batch', status=Job.RUNNING,
+                                 heartbeat_at=timezone.now() - datetime.timedelta(hours=2))
+        self.assertEqual(Job.fail_stale(), 0)
+        Job.objects.filter(id=job.id).update(
+            heartbeat_at=timezone.now() - datetime.timedelta(hours=4))
+        self.assertEqual(Job.fail_stale(), 1)
+        self.assertEqual(Job.objects.get(id=job.id).status, Job.FAILED)
+
+    def test_update_progress(self):
+        job = Job.objects.create(job_type='create_tasks', status=Job.RUNNING)
+        job.update_progress(5, 10)
+        self.assertEqual(Job.objects.get(id=job.id).get_progress(), (5, 10))
+
+        job.finish(Job.SUCCEEDED, 'Done')
+        job = Job.objects.get(id=job.id)
+        self.assertTrue(job.is_finished())
+        self.assertEqual(job.get_progress(), (5, 10))
+        self.assertEqual(job.message, 'Done')
+
+
+class CompletedAssignmentTestCase(django.test.TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', password='secret')
+        self.batch = Batch.objects.create(project=Project.objects.create())
+
+    def create_completed_assignment(self, **kwargs):
+        return create_completed_assignment(self.batch, self.user, **kwargs)
+
+
+class TestActivityRollup(CompletedAssignmentTestCase):
+    def test_record_on_completion(self):
+        task = Task.objects.create(batch=self.batch, input_csv_fields={})
+        ta = TaskAssignment.objects.create(assigned_to=self.user, task=task)
+        self.assertFalse(ActivityRollup.objects.exists())
+
+        ta.completed = True
+        ta.save()
+        self.create_completed_assignment()
+        minute = int(ta.completed_at.replace(second=0, microsecond=0).timestamp())
+        counts = ActivityRollup.timestamp_counts(user_id=self.user.id)
+        self.assertEqual(sum(counts.values()), 2)
+        self.assertIn(minute, counts)
+
+        ta.delete()
+        counts = ActivityRollup.timestamp_counts(batch_id=self.batch.id)
+        self.assertEqual(sum(counts.values()), 1)
+
+    def test_resave_then_delete(self):
+        ta = self.create_completed_assignment()
+        completed_at = ta.completed_at
+        later = completed_at + datetime.timedelta(days=2)
+        with mock.patch('django.utils.timezone.now', return_value=later):
+            ta.answers = {'note': 'edited'}
+            ta.save()
+        ta.refresh_from_db()
+        self.assertEqual(ta.updated_at, later)
+        self.assertEqual(ta.completed_at, completed_at)
+
+        ta.completed = False
+        ta.save()
+        self.assertIsNone(ta.completed_at)
+        self.assertEqual(sum(ActivityRollup.timestamp_counts().values()), 0)
+        self.assertEqual(DailyActivity.objects.get(user=self.user).completed, 0)
+        self.assertEqual(StatisticsSnapshot.objects.get(user=self.user).completed, 0)
+
+        ta.completed = True
+        ta.save()
+        ta.delete()
+        self.assertEqual(sum(ActivityRollup.timestamp_counts().values()), 0)
+        self.assertEqual(sum(DailyActivity.objects.values_list('completed', flat=True)), 0)
+        self.assertEqual(StatisticsSnapshot.objects.get(user=self.user).completed, 0)
+
+    def test_rebuild(self):
+        times = [datetime.datetime(2022, 4, 1, 9, 15, 10, tzinfo=datetime.timezone.utc),
+                 datetime.datetime(2022, 4, 1, 9, 15, 50, tzinfo=datetime.timezone.utc),
+                 datetime.datetime(2022, 4, 1, 9, 45, tzinfo=datetime.timezone.utc),
+                 datetime.datetime(2022, 4, 2, 9, 45, tzinfo=datetime.timezone.utc)]
+        for completed_at in times:
+            self.create_completed_assignment(completed_at=completed_at)
+
+        self.assertEqual(ActivityRollup.rebuild(), 3)
+        self.assertEqual(ActivityRollup.timestamp_counts(), {
+            int(times[0].replace(second=0).timestamp()): 2,
+            int(times[2].timestamp()): 1,
+            int(times[3].timestamp()): 1,
+        })
+        self.assertEqual(ActivityRollup.timestamp_counts('hour', batch_id=self.batch.id), {
+            int(times[0].replace(minute=0, second=0).timestamp()): 3,
+            int(times[3].replace(minute=0).timestamp()): 1,
+        })
+        self.assertEqual(list(ActivityRollup.timestamp_counts('day').values()), [3, 1])
+        self.assertEqual(ActivityRollup.timestamp_counts('hour', start=times[3]),
+                         {int(times[3].replace(minute=0).timestamp()): 1})
+
+    def test_timestamp_counts_unknown_bucket_size(self):
+        with self.assertRaises(ValueError):
+            ActivityRollup.timestamp_counts('week')
+
+
+class TestDailyActivity(CompletedAssignmentTestCase):
+    def test_record_on_completion(self):
+        task = Task.objects.create(batch=self.batch, input_csv_fields={})
+        ta = TaskAssignment.objects.create(assigned_to=self.user, task=task)
+        ta.completed = True
+        ta.save()
+        activity = DailyActivity.objects.get(batch=self.batch, user=self.user)
+        self.assertEqual(activity.day, timezone.localdate(ta.completed_at))
+        self.assertEqual(activity.completed, 1)
+        self.assertEqual(activity.last_finished_at, ta.completed_at)
+
+        later = ta.completed_at + datetime.timedelta(seconds=5)
+        DailyActivity.record(self.batch.id, self.user.id, later)
+        DailyActivity.record(self.batch.id, self.user.id, ta.completed_at)
+        activity = DailyActivity.objects.get(batch=self.batch, user=self.user)
+        self.assertEqual(activity.completed, 3)
+        self.assertEqual(activity.last_finished_at, later)
+
+        ta.delete()
+        activity = DailyActivity.objects.get(batch=self.batch, user=self.user)
+        self.assertEqual(activity.completed, 2)
+
+    def test_rebuild_and_trailing_counts(self):
+        now = timezone.now()
+        for hours_ago in (1, 30, 30, 24 * 6 + 12, 24 * 100):
+            self.create_completed_assignment(
+                completed_at=now - datetime.timedelta(hours=hours_ago))
+        self.assertEqual(DailyActivity.rebuild(), DailyActivity.objects.count())
+        ActivityRollup.rebuild()
+
+        activity = DailyActivity.objects.filter(user=self.user).order_by('-day').first()
+        self.assertEqual(activity.day, timezone.localdate(now - datetime.timedelta(hours=1)))
+        with CaptureQueriesContext(connection) as queries:
+            counts = DailyActivity.trailing_counts((1, 2, 7, 365), now=now,
+                                                   batch__project_id=self.batch.project_id)
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(counts, {1: 1, 2: 3, 7: 4, 365: 5})
+        self.assertEqual(DailyActivity.trailing_counts((7,), now=now, user_id=0), {7: 0})
+
+
+class TestStatisticsSnapshot(CompletedAssignmentTestCase):
+    def test_record_on_completion(self):
+        task = Task.objects.create(batch=self.batch, input_csv_fields={})
+        ta = TaskAssignment.objects.create(assigned_to=self.user, task=task)
+        self.assertFalse(StatisticsSnapshot.objects.exists())
+
+        ta.completed = True
+        ta.save()
+        snapshot = StatisticsSnapshot.objects.get(batch=self.batch, user=self.user)
+        self.assertEqual(snapshot.completed, 1)
+        self.assertEqual(snapshot.last_finished_at, ta.completed_at)
+        self.assertEqual(QuantileSketch.from_json(snapshot.work_time_sketch).count, 1)
+
+        ta.delete()
+        snapshot = StatisticsSnapshot.objects.get(batch=self.batch, user=self.user)
+        self.assertEqual(snapshot.completed, 0)
+        self.assertEqual(QuantileSketch.from_json(snapshot.work_time_sketch).count, 0)
+
+    def test_median_work_time(self):
+        snapshot = StatisticsSnapshot()
+        self.assertEqual(snapshot.median_work_time(), 0)
+        for work_time in (1, 11, 14, 100):
+            snapshot.add(work_time, timezone.now())
+        self.assertEqual(snapshot.mean_work_time(), 31.5)
+        # The lower of the two middle work times
+        self.assertAlmostEqual(snapshot.median_work_time(), 11, delta=0.11)
+        snapshot.add(200000, timezone.now())
+        self.assertAlmostEqual(snapshot.median_work_time(), 14, delta=0.14)
+        self.assertAlmostEqual(snapshot.work_time_quantile(1), 200000, delta=2000)
+
+    def test_merge(self):
+        other_user = User.objects.create_user('otheruser', password='secret')
+        first = StatisticsSnapshot(batch=self.batch, user=self.user)
+        first.add(10, datetime.datetime(2022, 4, 2, tzinfo=datetime.timezone.utc))
+        second = StatisticsSnapshot(batch=self.batch, user=other_user)
+        second.add(20, datetime.datetime(2022, 4, 1, tzinfo=datetime.timezone.utc))
+        second.add(30, datetime.datetime(2022, 4, 3, tzinfo=datetime.timezone.utc))
+
+        merged = StatisticsSnapshot.merge([first, second])
+        self.assertEqual(merged.completed, 3)
+        self.assertEqual(merged.total_work_time, 60)
+        self.assertEqual(merged.first_finished_at.day, 1)
+        self.assertEqual(merged.last_finished_at.day, 3)
+        self.assertAlmostEqual(merged.work_time_quantile(0.5), 20, delta=0.2)
+        self.assertEqual(StatisticsSnapshot.merge([]).completed, 0)
+
+    def test_rebuild(self):
+        for work_time in (5, 50, 500):
+            ta = self.create_completed_assignment(work_time=work_time)
+        StatisticsSnapshot.objects.all().delete()
+
+        self.assertEqual(StatisticsSnapshot.rebuild(), 1)
+        snapshot = StatisticsSnapshot.objects.get(batch=self.batch, user=self.user)
+        self.assertEqual(snapshot.completed, 3)
+        self.assertAlmostEqual(snapshot.total_work_time, 555)
+        self.assertEqual(snapshot.last_finished_at, ta.completed_at)
+        self.assertAlmostEqual(snapshot.median_work_time(), 50, delta=0.5)
@@ -0,0 +1,70 @@
+import random
+import unittest
+
+from turkle.sketches import MAX_BINS, QuantileSketch, RELATIVE_ACCURACY
+
+
+class TestQuantileSketch(unittest.TestCase):
+    def test_empty(self):
+        sketch = QuantileSketch()
+        self.assertEqual(sketch.count, 0)
+        self.assertEqual(sketch.quantile(0.5), 0)
+
+    def test_relative_accuracy(self):
+        rng = random.Random(1234)
+        values = sorted(rng.lognormvariate(4, 1.5) for _ in range(10000))
+        sketch = QuantileSketch()
+        for value in values:
+            sketch.add(value)
+        self.assertEqual(sketch.count, len(values))
+        for q in (0, 0.5, 0.9, 0.99, 1):
+            expected = values[int(q * (len(values) - 1))]
+            self.assertAlmostEqual(sketch.quantile(q), expected,
+                                   delta=expected * RELATIVE_ACCURACY)
+
+    def test_zero_values(self):
+        sketch = QuantileSketch()
+        for value in (0, 0, 5):
+            sketch.add(value)
+        self.assertEqual(sketch.zero_count, 2)
+        self.assertEqual(sketch.quantile(0.5), 0)
+        self.assertAlmostEqual(sketch.quantile(1), 5, delta=0.05)
+
+    def test_remove(self):
+        sketch = QuantileSketch()
+        sketch.add(10)
+        sketch.add(1000)
+        sketch.add(1000, -1)
+        self.assertEqual(sketch.count, 1)
+        self.assertAlmostEqual(sketch.quantile(1), 10, delta=0.1)
+
+    def test_merge(self):
+        first = QuantileSketch()
+        second = QuantileSketch()
+        for value in range(1, 51):
+            first.add(value)
+        for value in range(51, 101):
+            second.add(value)
+        first.merge(second)
+        self.assertEqual(first.count, 100)
+        self.assertAlmostEqual(first.quantile(0.5), 50, delta=0.5)
+        self.assertAlmostEqual(first.quantile(0.9), 90, delta=0.9)
+
+    def test_json_round_trip(self):
+        sketch = QuantileSketch()
+        for value in (0, 3, 30, 300):
+            sketch.add(value)
+        restored = QuantileSketch.from_json(sketch.to_json())
+        self.assertEqual(restored.bins, sketch.bins)
+        self.assertEqual(restored.zero_count, 1)
+        # An empty JSONField evaluates to an empty string
+        self.assertEqual(QuantileSketch.from_json('').count, 0)
+
+    def test_collapse(self):
+        sketch = QuantileSketch()
+        for i in range(MAX_BINS + 10):
+            sketch.add(1.03 ** i)
+        self.assertEqual(len(sketch.bins), MAX_BINS)
+        self.assertEqual(sketch.count, MAX_BINS + 10)
+        self.assertAlmostEqual(sketch.quantile(1), 1.03 ** (MAX_BINS + 9),
+                               delta=1.03 ** (MAX_BINS + 9) * RELATIVE_ACCURACY)
@@ -1,12 +1,16 @@
+import datetime
 import django.test
 from django.contrib.auth.models import Group, User
 from django.contrib.messages import get_messages
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from guardian.shortcuts import assign_perm
-from .utility import save_model
+from guardian.shortcuts import assign_perm, remove_perm
+from .utility import create_completed_assignment, save_model
 
-from turkle.models import Task, TaskAssignment, Batch, Project
+from turkle.caching import check_shared_cache
+from turkle.models import ActivityRollup, Task, TaskAssignment, Batch, Project
 from turkle.views import parse_date_with_timezone
 
 
@@ -413,6 +417,84 @@ class TestIndex(django.test.TestCase):
         self.assertTrue(b'MY_BATCH_NAME' in response.content)
 
 
+@override_settings(TURKLE_CACHE_SHARED=True)
+class TestIndexCache(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', password='secret')
+        self.project = Project.objects.create(name='MY_TEMPLATE_NAME')
+        self.batch = Batch.objects.create(
+            custom_permissions=True,
+            name='MY_BATCH_NAME',
+            project=self.project,
+        )
+        self.task = Task.objects.create(batch=self.batch)
+        assign_perm('can_work_on_batch', self.user, self.batch)
+        self.client = django.test.Client()
+        self.client.login(username='testuser', password='secret')
+
+    def test_index_uses_cache(self):
+        with CaptureQueriesContext(connection) as uncached:
+            response = self.client.get(reverse('index'))
+        self.assertTrue(b'MY_BATCH_NAME' in response.content)
+        with CaptureQueriesContext(connection) as cached:
+            response = self.client.get(reverse('index'))
+        self.assertTrue(b'MY_BATCH_NAME' in response.content)
+        self.assertLess(len(cached), len(uncached))
+
+    def test_index_cache_invalidated_by_task_assignment(self):
+        response = self.client.get(reverse('index'))
+        self.assertTrue(b'MY_BATCH_NAME' in response.content)
+
+        TaskAssignment.objects.create(assigned_to=self.user, completed=True, task=self.task)
+        response = self.client.get(reverse('index'))
+        self.assertFalse(b'MY_BATCH_NAME' in response.content)
+
+    def test_index_cache_invalidated_by_permission_change(self):
+        response = self.client.get(reverse('index'))
+        self.assertTrue(b'MY_BATCH_NAME' in response.content)
+
+        remove_perm('can_work_on_batch', self.user, self.batch)
+        response = self.client.get(reverse('index'))
+        self.assertFalse(b'MY_BATCH_NAME' in response.content)
+
+    def test_index_cache_invalidated_by_deactivation(self):
+        response = self.client.get(reverse('index'))
+        self.assertTrue(b'MY_BATCH_NAME' in response.content)
+
+        self.project.active = False
+        self.project.save()
+        response = self.client.get(reverse('index'))
+        self.assertFalse(b'MY_BATCH_NAME' in response.content)
+
+    def test_index_cache_invalidated_by_user_access_change(self):
+        response = self.client.get(reverse('index'))
+        self.assertTrue(b'MY_BATCH_NAME' in response.content)
+
+        self.user.is_superuser = True
+        self.user.save(update_fields=['last_login'])
+        self.user.is_superuser = False
+        self.user.last_name = 'Changed'
+        self.user.save()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('index'))
+        self.assertFalse([q for q in queries if 'FROM "turkle_batch"' in q['sql']])
+
+        self.user.is_superuser = True
+        self.user.save()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('index'))
+        self.assertTrue([q for q in queries if 'FROM "turkle_batch"' in q['sql']])
+
+    @override_settings(TURKLE_CACHE_SHARED=None)
+    def test_index_not_cached_in_local_memory_cache(self):
+        self.assertEqual([w.id for w in check_shared_cache(None)], ['turkle.W001'])
+        with CaptureQueriesContext(connection) as first:
+            self.client.get(reverse('index'))
+        with CaptureQueriesContext(connection) as second:
+            self.client.get(reverse('index'))
+        self.assertEqual(len(second), len(first))
+
+
 class TestIndexAbandonedAssignments(TestCase):
     def setUp(self):
         self.user = User.objects.create_user('testuser', password='secret')
@@ -709,6 +791,26 @@ class TestPreview(TestCase):
         response = client.get(reverse('preview_iframe', kwargs={'task_id': self.task.id}))
         self.assertEqual(response.status_code, 200)
 
+    def test_get_preview_iframe_conditional(self):
+        client = django.test.Client()
+        url = reverse('preview_iframe', kwargs={'task_id': self.task.id})
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response['Cache-Control'])
+        etag = response['ETag']
+
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+        # Updating the Project template changes the ETag
+        self.project.html_template = '<p>${foo}</p><textarea>'
+        self.project.save()
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertIn(b'<p>fufu</p>', response.content)
+
     def test_get_preview_iframe_bad_task_id(self):
         client = django.test.Client()
         response = client.get(reverse('preview_iframe', kwargs={'task_id': 666}))
@@ -1029,6 +1131,59 @@ class TestStats(django.test.TestCase):
         self.assertTrue(b'error' not in response.content)
         self.assertEqual(response.status_code, 200)
 
+    def test_stats_for_user_totals(self):
+        projects = [Project.objects.create(name='project{}'.format(i)) for i in range(2)]
+        batches = [Batch.objects.create(project=projects[0], name='batch0'),
+                   Batch.objects.create(project=projects[0], name='batch1'),
+                   Batch.objects.create(project=projects[1], name='batch2')]
+        for batch, work_times in zip(batches, [(60, 120), (3600,), (30,)]):
+            for work_time in work_times:
+                create_completed_assignment(batch, self.user, work_time=work_time)
+        task = Task.objects.create(batch=batches[2], input_csv_fields={})
+        TaskAssignment.objects.create(assigned_to=self.user, completed=False, task=task)
+
+        client = django.test.Client()
+        client.login(username='mr.user', password='secret')
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(reverse('stats'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len([q for q in queries if 'turkle_taskassignment' in q['sql']]), 1)
+        self.assertEqual(response.context['total_completed'], 4)
+        self.assertEqual(response.context['total_elapsed_time'], '1h 3m')
+        project_stats = response.context['project_stats']
+        self.assertEqual([p['project_name'] for p in project_stats], ['project1', 'project0'])
+        self.assertEqual(project_stats[1]['total_completed_project'], 3)
+        self.assertEqual(project_stats[1]['elapsed_time_project'], '1h 3m')
+        self.assertEqual(project_stats[1]['batch_stats'], [
+            {'batch_name': 'batch1', 'elapsed_time_batch': '1h 0m', 'total_completed_batch': 1},
+            {'batch_name': 'batch0', 'elapsed_time_batch': '0h 3m', 'total_completed_batch': 2},
+        ])
+
+    def test_user_activity_json(self):
+        batch = Batch.objects.create(project=Project.objects.create())
+        completed_at = datetime.datetime(2022, 4, 1, 9, 15, 30, tzinfo=datetime.timezone.utc)
+        for _ in range(2):
+            create_completed_assignment(batch, self.user, completed_at=completed_at)
+        ActivityRollup.rebuild()
+
+        client = django.test.Client()
+        client.login(username='mr.user', password='secret')
+        url = reverse('user_activity_json', kwargs={'user_id': self.user.id})
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {str(int(completed_at.timestamp()) - 30): 2})
+        hour = int(completed_at.timestamp()) - 15 * 60 - 30
+        response = client.get(url, {'bucket': 'hour', 'start': hour, 'end': hour + 3600})
+        self.assertEqual(response.json(), {str(hour): 2})
+        response = client.get(url, {'bucket': 'hour', 'start': hour + 3600})
+        self.assertEqual(response.json(), {})
+
+        response = client.get(url, {'bucket': 'week'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', response.json())
+        response = client.get(url, {'start': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
     def test_stats_for_user_other_as_not_staff(self):
         client = django.test.Client()
         client.login(username='mr.user', password='secret')
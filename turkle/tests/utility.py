@@ -1,3 +1,8 @@
+import datetime
+
+from turkle.models import Task, TaskAssignment
+
+
 def save_model(obj):
     """
     Imitates Django saving the model from a form.
@@ -6,3 +11,29 @@ def save_model(obj):
     """
     obj.full_clean(validate_unique=False)
     obj.save()
+
+
+def create_completed_assignment(batch, user=None, completed_at=None, work_time=None):
+    """
+    Creates a completed Task Assignment for a new Task in the Batch.
+    If completed_at or work_time (in seconds) is given, the Task Assignment
+    is backdated with set_completion_time().
+    """
+    task = Task.objects.create(batch=batch, input_csv_fields={})
+    task_assignment = TaskAssignment.objects.create(assigned_to=user, completed=True, task=task)
+    if work_time is not None:
+        completed_at = task_assignment.created_at + datetime.timedelta(seconds=work_time)
+    if completed_at is not None:
+        set_completion_time(task_assignment, completed_at)
+    return task_assignment
+
+
+def set_completion_time(task_assignment, completed_at):
+    """
+    Sets when a completed Task Assignment was submitted, bypassing the
+    auto_now of updated_at.  The activity rollups and statistics snapshots
+    still hold the original time until they are rebuilt.
+    """
+    TaskAssignment.objects.filter(id=task_assignment.id).update(
+        updated_at=completed_at, completed_at=completed_at)
+    task_assignment.updated_at = task_assignment.completed_at = completed_at
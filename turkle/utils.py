@@ -1,4 +1,6 @@
 from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
 
 from . import __version__
 
@@ -15,6 +17,43 @@ def get_turkle_template_limit(in_bytes=False):
     return template_size_limit
 
 
+def get_turkle_task_chunk_size():
+    """get number of Tasks inserted per query when creating a Batch"""
+    return getattr(settings, 'TURKLE_TASK_CHUNK_SIZE', 1000)
+
+
+def get_job_heartbeat_timeout():
+    """get minutes after which a running Job that reports no progress is failed"""
+    return getattr(settings, 'TURKLE_JOB_HEARTBEAT_TIMEOUT', 60)
+
+
+def get_job_retention_days():
+    """get days after which finished Jobs and their files are deleted"""
+    return getattr(settings, 'TURKLE_JOB_RETENTION_DAYS', 7)
+
+
+def get_turkle_cache():
+    """get the Django cache used for Turkle's cached queries"""
+    return caches[getattr(settings, 'TURKLE_CACHE', 'default')]
+
+
+def is_turkle_cache_shared():
+    """get whether the Turkle cache is shared by all web server processes
+
+    Unless TURKLE_CACHE_SHARED is set, any backend other than the
+    per-process in-memory cache is assumed to be shared.
+    """
+    shared = getattr(settings, 'TURKLE_CACHE_SHARED', None)
+    if shared is None:
+        shared = not isinstance(get_turkle_cache(), LocMemCache)
+    return shared
+
+
+def get_turkle_cache_timeout():
+    """get timeout in seconds for Turkle's cached queries"""
+    return getattr(settings, 'TURKLE_CACHE_TIMEOUT', 60)
+
+
 def turkle_vars(request):
     """add variables to the template context"""
     return {
@@ -28,3 +67,8 @@ def turkle_vars(request):
 
 def are_anonymous_tasks_allowed():
     return getattr(settings, 'TURKLE_ANONYMOUS_TASKS', True)
+
+
+def are_background_jobs_enabled():
+    """get whether long-running admin operations are queued for the run_jobs command"""
+    return getattr(settings, 'TURKLE_BACKGROUND_JOBS', False)
@@ -1,4 +1,3 @@
-from collections import defaultdict
 from datetime import datetime, timedelta
 from functools import wraps
 import logging
@@ -8,16 +7,20 @@ from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import connection, transaction
+from django.db import transaction
 from django.db.utils import OperationalError
 from django.http import JsonResponse
 from django.shortcuts import redirect, render
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.utils.dateparse import parse_date
 from django.utils.datastructures import MultiValueDictKeyError
+from django.utils.http import http_date, quote_etag
 
-from .models import Task, TaskAssignment, Batch, Project
+from . import __version__
+from .caching import get_available_task_counts, get_batch_list, get_task_html
+from .models import ActivityRollup, Task, TaskAssignment, Batch
 
 User = get_user_model()
 
@@ -58,13 +61,21 @@ def index(request):
                 'task_assignment_id': ha.id
             })
 
-    batch_list = Batch.access_permitted_for(request.user)
-    batch_query = Batch.objects.filter(id__in=[b.id for b in batch_list])
+    def _batch_list():
+        batch_query = Batch.access_permitted_for(request.user)
+        return list(batch_query.values(
+            'assignments_per_task', 'created_at', 'id', 'name', 'project__name'))
 
-    available_task_counts = Batch.available_task_counts_for(batch_query, request.user)
+    def _available_task_counts(batch_ids):
+        batch_query = Batch.objects.filter(id__in=batch_ids)
+        return Batch.available_task_counts_for(batch_query, request.user)
+
+    batch_list = get_batch_list(request.user, _batch_list)
+    available_task_counts = get_available_task_counts(
+        batch_list, request.user, _available_task_counts)
 
     batch_rows = []
-    for batch in batch_query.values('created_at', 'id', 'name', 'project__name'):
+    for batch in batch_list:
         total_tasks_available = available_task_counts[batch['id']]
 
         if total_tasks_available > 0:
@@ -144,16 +155,8 @@ def accept_next_task(request, batch_id):
         with transaction.atomic():
             batch = Batch.objects.get(id=batch_id)
 
-            # Lock access to all Tasks available to current user in the batch
-            # Force evaluation of the query set with len()
-            # But postgres does not support select_for_update() with outer join
-            if connection.vendor != "postgresql":
-                len(batch.available_task_ids_for(request.user).select_for_update())
-            else:
-                # Locks a few more tasks for multiple annotation batches than above
-                len(batch.unfinished_tasks().select_for_update())
-
-            task_id = _skip_aware_next_available_task_id(request, batch)
+            # Lock only the Task being claimed, not every available Task in the Batch
+            task_id = _skip_aware_next_available_task_id(request, batch, lock=True)
 
             if task_id:
                 ha = TaskAssignment()
@@ -287,6 +290,7 @@ def task_assignment_iframe(request, task_id, task_assignment_id):
         {
             'task': task,
             'task_assignment': task_assignment,
+            'task_html': get_task_html(task, task.batch.project),
         },
     )
 
@@ -327,11 +331,28 @@ def preview_iframe(request, task_id):
         messages.error(request, 'Cannot find Task with ID {}'.format(task_id))
         return redirect(index)
 
-    if not task.batch.project.available_for(request.user):
+    batch = task.batch
+    project = batch.project
+    if not project.available_for(request.user):
         messages.error(request, 'You do not have permission to view this Task')
         return redirect(index)
 
-    return render(request, 'turkle/preview_iframe.html', {'task': task})
+    # The preview only changes when the Project is updated, so browsers can
+    # revalidate their cached copy instead of downloading the page again.
+    # The ETag is weak because the CSRF token differs between responses.
+    etag = 'W/' + quote_etag('{}-{}-{}'.format(
+        __version__, task.id, project.updated_at.timestamp()))
+    last_modified = int(max(batch.created_at, project.updated_at).timestamp())
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = render(request, 'turkle/preview_iframe.html', {
+            'task': task,
+            'task_html': get_task_html(task, project),
+        })
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 
 def preview_next_task(request, batch_id):
@@ -453,38 +474,38 @@ def stats_for_user(request, user_id):
         # adds a day to include assignments completed on the selected end date
         tas = tas.filter(updated_at__lte=end_date + timedelta(days=1))
 
-    projects = Project.objects.filter(batch__task__taskassignment__assigned_to=user).\
-        distinct()
-    batches = Batch.objects.filter(task__taskassignment__assigned_to=user).distinct()
+    batch_totals = TaskAssignment.work_time_totals(
+        tas, ['task__batch__project_id', 'task__batch__project__name',
+              'task__batch_id', 'task__batch__name'])
+    # Newest Projects first, and newest Batches first within each Project
+    batch_totals.sort(key=lambda t: (-t['task__batch__project_id'], -t['task__batch_id']))
 
+    total_completed = 0
     elapsed_seconds_overall = 0
     project_stats = []
-    for project in projects:
-        project_batches = [b for b in batches if b.project_id == project.id]
-
-        batch_stats = []
-        elapsed_seconds_project = 0
-        total_completed_project = 0
-        for batch in project_batches:
-            batch_tas = tas.filter(task__batch=batch)
-            total_completed_batch = batch_tas.count()
-            total_completed_project += total_completed_batch
-            elapsed_seconds_batch = sum([ta.work_time_in_seconds() for ta in batch_tas])
-            elapsed_seconds_project += elapsed_seconds_batch
-            elapsed_seconds_overall += elapsed_seconds_batch
-            if total_completed_batch > 0:
-                batch_stats.append({
-                    'batch_name': batch.name,
-                    'elapsed_time_batch': format_seconds(elapsed_seconds_batch),
-                    'total_completed_batch': total_completed_batch,
-                })
-        if total_completed_project > 0:
+    for batch_total in batch_totals:
+        if not project_stats or \
+                project_stats[-1]['project_id'] != batch_total['task__batch__project_id']:
             project_stats.append({
-                'project_name': project.name,
-                'batch_stats': batch_stats,
-                'elapsed_time_project': format_seconds(elapsed_seconds_project),
-                'total_completed_project': total_completed_project,
+                'project_id': batch_total['task__batch__project_id'],
+                'project_name': batch_total['task__batch__project__name'],
+                'batch_stats': [],
+                'elapsed_seconds_project': 0,
+                'total_completed_project': 0,
             })
+        project_stat = project_stats[-1]
+        project_stat['batch_stats'].append({
+            'batch_name': batch_total['task__batch__name'],
+            'elapsed_time_batch': format_seconds(batch_total['elapsed_seconds']),
+            'total_completed_batch': batch_total['total_completed'],
+        })
+        project_stat['elapsed_seconds_project'] += batch_total['elapsed_seconds']
+        project_stat['total_completed_project'] += batch_total['total_completed']
+        elapsed_seconds_overall += batch_total['elapsed_seconds']
+        total_completed += batch_total['total_completed']
+    for project_stat in project_stats:
+        project_stat['elapsed_time_project'] = format_seconds(
+            project_stat.pop('elapsed_seconds_project'))
 
     if start_date:
         start_date = start_date.strftime('%Y-%m-%d')
@@ -502,7 +523,7 @@ def stats_for_user(request, user_id):
             'project_stats': project_stats,
             'end_date': end_date,
             'start_date': start_date,
-            'total_completed': tas.count(),
+            'total_completed': total_completed,
             'total_elapsed_time': format_seconds(elapsed_seconds_overall),
             'full_name': name,
             'user_id': user.id
@@ -531,16 +552,37 @@ def user_activity_json(request, user_id):
     except ObjectDoesNotExist:
         return JsonResponse({})
 
-    # Create dictionary mapping timestamp (in seconds) to number of TaskAssignments
-    # completed at that timestamp
-    completed_at = TaskAssignment.objects.\
-        filter(completed=True).\
-        filter(assigned_to=user).\
-        values_list('updated_at', flat=True)
-    timestamp_counts = defaultdict(int)
-    for ca in completed_at:
-        timestamp_counts[int(ca.timestamp())] += 1
+    return activity_json_response(request, user_id=user.id)
+
+
+def activity_json_response(request, **filters):
+    """Return the number of Task Assignments completed in each time bucket as JSON
 
+    The JSON object maps the start of each bucket, as a Unix timestamp in
+    seconds, to the number of Task Assignments completed in the bucket.
+    The request parameters are:
+
+    - bucket: 'minute' (the default), 'hour' or 'day'
+    - start, end: Unix timestamps in seconds that limit the time range
+
+    Args:
+        request (HttpRequest):
+        **filters: Lookups passed to ActivityRollup.timestamp_counts()
+    """
+    times = {}
+    for name in ('start', 'end'):
+        try:
+            if request.GET.get(name):
+                times[name] = datetime.fromtimestamp(int(float(request.GET[name])),
+                                                     tz=timezone.utc)
+        except (OverflowError, ValueError):
+            return JsonResponse({'error': 'Invalid {} time: {}'.format(name, request.GET[name])},
+                                status=400)
+    try:
+        timestamp_counts = ActivityRollup.timestamp_counts(
+            request.GET.get('bucket', 'minute'), **times, **filters)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
     return JsonResponse(timestamp_counts)
 
 
@@ -604,7 +646,7 @@ def _delete_task_assignment(request, task_id, task_assignment_id):
     task_assignment.delete()
 
 
-def _skip_aware_next_available_task_id(request, batch):
+def _skip_aware_next_available_task_id(request, batch, lock=False):
     """Get next available Task for user, taking into account previously skipped Tasks
 
     This function will first look for an available Task that the user
@@ -612,6 +654,9 @@ def _skip_aware_next_available_task_id(request, batch):
     that the user has skipped, this function will return the first
     such Task.
 
+    If `lock` is True, the returned Task is locked for the rest of the
+    current transaction (see Batch.lock_first_task_id()).
+
     Returns:
         Task ID (int), or None if no more Tasks are available
     """
@@ -623,13 +668,18 @@ def _skip_aware_next_available_task_id(request, batch):
         else:
             return None
 
+    def _first_task_id(task_ids):
+        if lock:
+            return batch.lock_first_task_id(task_ids)
+        return task_ids.first()
+
     available_task_ids = batch.available_task_ids_for(request.user)
     skipped_ids = _get_skipped_task_ids_for_batch(request.session, batch.id)
 
     if skipped_ids:
-        task_id = available_task_ids.exclude(id__in=skipped_ids).first()
+        task_id = _first_task_id(available_task_ids.exclude(id__in=skipped_ids))
         if not task_id:
-            task_id = available_task_ids.filter(id__in=skipped_ids).first()
+            task_id = _first_task_id(available_task_ids.filter(id__in=skipped_ids))
             if task_id:
                 messages.info(request, 'Only previously skipped Tasks are available')
 
@@ -639,6 +689,6 @@ def _skip_aware_next_available_task_id(request, batch):
                 request.session['skipped_tasks_in_batch'][str(batch.id)] = []
                 request.session.modified = True
     else:
-        task_id = available_task_ids.first()
+        task_id = _first_task_id(available_task_ids)
 
     return task_id
@@ -5,6 +5,9 @@ import os
 import sys
 import types
 
+# Directory that contains manage.py
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
 DEBUG = False
 ALLOWED_HOSTS = ['*']
 X_FRAME_OPTIONS = 'SAMEORIGIN'
@@ -116,13 +119,34 @@ AUTHENTICATION_BACKENDS = (
 )
 
 
-# Set max size for file uploads and POST requests to 100MB
+# Set max size for POST request data, excluding uploaded files, to 100MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 104857600
-FILE_UPLOAD_MAX_MEMORY_SIZE = 104857600
+# Uploaded files larger than 2.5MB are streamed to a temporary file
+# instead of being held in memory
+FILE_UPLOAD_MAX_MEMORY_SIZE = 2621440
 
 # max size of template in KB
 TURKLE_TEMPLATE_LIMIT = 64
 
+# number of Tasks inserted per query when creating a Batch from a CSV file
+TURKLE_TASK_CHUNK_SIZE = 1000
+
+# If True, Batch creation and results exports in the admin are queued as
+# background jobs, which are run by the "run_jobs" management command
+TURKLE_BACKGROUND_JOBS = False
+
+# Minutes after which a running background job that has not reported
+# progress is marked as failed, such as when its worker was killed
+TURKLE_JOB_HEARTBEAT_TIMEOUT = 60
+
+# Days after which finished background jobs and their files are deleted
+# by the "run_jobs" management command
+TURKLE_JOB_RETENTION_DAYS = 7
+
+# Directory where background jobs store uploaded input and results files.
+# It must be the same directory for the web server and the job worker.
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
 LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'index'
 LOGOUT_REDIRECT_URL = 'index'